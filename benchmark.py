@@ -0,0 +1,455 @@
+"""
+Microbenchmarks for TRACER modules on randomly initialized weights (no checkpoints needed).
+
+e.g.
+    python benchmark.py fem --archs 0 7 --batch_size 1
+    python benchmark.py fft --batch_size 4
+    python benchmark.py fuse --archs 0 7 --repeat 5
+    python benchmark.py branches --archs 0 7 --repeat 5
+    python benchmark.py channels_last --archs 0 7 --repeat 5
+    python benchmark.py bf16 --archs 0 7 --repeat 5
+    python benchmark.py uam --batch_size 4 --repeat 200
+    python benchmark.py decoder --archs 0 7 --repeat 5
+    python benchmark.py padding --archs 0 --img_sizes 352 321 --repeat 5
+    python benchmark.py swish --archs 0 7 --batch_size 4 --repeat 5
+    python benchmark.py tiled --archs 0 --img_sizes 960 1920 --batch_size 4 --repeat 2
+    python benchmark.py letterbox --archs 0 7 --batch_size 4 --repeat 2
+    python benchmark.py cache --archs 0 7 --repeat 5
+    python benchmark.py video --archs 0 --batch_size 4
+    python benchmark.py batch --archs 0 7 --batch_sizes 1 2 4 8 --repeat 2
+"""
+import cv2
+import time
+import argparse
+import tempfile
+import numpy as np
+import copy
+import torch
+import torch.nn.functional as F
+import inference_demo_helper
+from torch.profiler import profile, ProfilerActivity
+from config import DummyArgs
+from util.utils import autocast
+from util.effi_utils import get_model_shape
+from model_tracer.EfficientNet import EfficientNet
+from model_tracer.tiling import TiledPredictor, salient_object
+from model_tracer.video import VideoPredictor
+from util.result_cache import ResultCache, encode_png
+from dataloader import get_test_augmentation, get_letterbox_augmentation, letterbox_size, padded_size, group_by_shape
+from modules.att_modules import Frequency_Edge_Module, UnionAttentionModule
+from tests.legacy import (random_tracer, legacy_mask_radial, legacy_high_pass, legacy_masking, legacy_tracer,
+                          legacy_padding)
+
+
+def measure(fn, repeat, warmup=2):
+    """Returns the median latency of fn() in milliseconds."""
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            fn()
+            times.append((time.perf_counter() - t) * 1000)
+    return float(np.median(times))
+
+
+def peak_memory(fn):
+    """Returns the peak memory allocated while running fn() in MiB."""
+    with torch.no_grad():
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+            start = torch.cuda.memory_allocated()
+            fn()
+            return (torch.cuda.max_memory_allocated() - start) / 2 ** 20
+
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            fn()
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak / 2 ** 20
+
+
+def first_block_input(arch, batch_size):
+    """Random feature map at the resolution and width of the first TRACER block of an arch."""
+    _, channels = get_model_shape(arch)
+    size = DummyArgs(arch).img_size // 4
+    return torch.randn(batch_size, channels[0], size, size)
+
+
+def count_modules(model, module_type):
+    return sum(isinstance(module, module_type) for module in model.modules())
+
+
+ASPECT_RATIOS = [(1, 1), (4, 3), (3, 4), (16, 9), (9, 16), (3, 1), (1, 3)]  # (width, height)
+
+
+def mixed_aspect_images(long_side, per_ratio):
+    """Random RGB images with a long side of long_side, per_ratio of each of ASPECT_RATIOS, interleaved."""
+    return [np.random.randint(0, 256, (round(long_side * h / max(w, h)), round(long_side * w / max(w, h)), 3),
+                              dtype=np.uint8) for _ in range(per_ratio) for w, h in ASPECT_RATIOS]
+
+
+def bench_fem(args):
+    print(f'{"arch":>4} {"input":>18} {"before(ms)":>11} {"after(ms)":>10} {"speedup":>8}')
+    for arch in args.archs:
+        x = first_block_input(arch, args.batch_size)
+        fem = Frequency_Edge_Module(radius=16, channel=x.size(1)).eval()
+
+        after = measure(lambda: fem(x), args.repeat)
+        fem.mask_radial = legacy_mask_radial
+        fem.high_pass = lambda x: legacy_high_pass(fem, x)
+        before = measure(lambda: fem(x), args.repeat)
+
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {before:>11.2f} {after:>10.2f} {before / after:>7.2f}x')
+
+
+def bench_fft(args):
+    print(f'{"arch":>4} {"input":>18} {"max|diff|":>10} {"fft2(ms)":>9} {"rfft2(ms)":>10} '
+          f'{"fft2(MiB)":>10} {"rfft2(MiB)":>11}')
+    for arch in args.archs:
+        x = first_block_input(arch, args.batch_size)
+        fem = Frequency_Edge_Module(radius=16, channel=x.size(1)).eval()
+
+        with torch.no_grad():
+            diff = (fem.high_pass(x) - legacy_high_pass(fem, x)).abs().max().item()
+        before = measure(lambda: legacy_high_pass(fem, x), args.repeat)
+        after = measure(lambda: fem.high_pass(x), args.repeat)
+        before_mem = peak_memory(lambda: legacy_high_pass(fem, x))
+        after_mem = peak_memory(lambda: fem.high_pass(x))
+
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {diff:>10.2e} {before:>9.2f} {after:>10.2f} '
+              f'{before_mem:>10.1f} {after_mem:>11.1f}')
+
+
+def bench_fuse(args):
+    print(f'{"arch":>4} {"input":>18} {"BN before":>9} {"BN after":>8} {"max|diff|":>10} '
+          f'{"before(ms)":>11} {"after(ms)":>10} {"speedup":>8}')
+    for arch in args.archs:
+        model = random_tracer(arch)
+        size = DummyArgs(arch).img_size
+        x = torch.randn(args.batch_size, 3, size, size)
+        fused = copy.deepcopy(model).fuse_for_inference()
+
+        with torch.no_grad():
+            diff = (model(x, return_aux=False) - fused(x, return_aux=False)).abs().max().item()
+        before = measure(lambda: model(x, return_aux=False), args.repeat)
+        after = measure(lambda: fused(x, return_aux=False), args.repeat)
+        bn_before = count_modules(model, torch.nn.BatchNorm2d)
+        bn_after = count_modules(fused, torch.nn.BatchNorm2d)
+
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {bn_before:>9} {bn_after:>8} {diff:>10.2e} '
+              f'{before:>11.2f} {after:>10.2f} {before / after:>7.2f}x')
+
+
+def bench_branches(args):
+    print(f'{"arch":>4} {"input":>18} {"convs before":>12} {"convs after":>11} {"max|diff|":>10} '
+          f'{"before(ms)":>11} {"after(ms)":>10} {"speedup":>8}')
+    for arch in args.archs:
+        model = random_tracer(arch).fuse_for_inference(branches=False)
+        size = DummyArgs(arch).img_size
+        x = torch.randn(args.batch_size, 3, size, size)
+        merged = copy.deepcopy(model).fuse_for_inference()
+
+        with torch.no_grad():
+            diff = (model(x, return_aux=False) - merged(x, return_aux=False)).abs().max().item()
+        before = measure(lambda: model(x, return_aux=False), args.repeat)
+        after = measure(lambda: merged(x, return_aux=False), args.repeat)
+        convs_before = count_modules(model, torch.nn.Conv2d)
+        convs_after = count_modules(merged, torch.nn.Conv2d)
+
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {convs_before:>12} {convs_after:>11} {diff:>10.2e} '
+              f'{before:>11.2f} {after:>10.2f} {before / after:>7.2f}x')
+
+
+def bench_channels_last(args):
+    print(f'{"arch":>4} {"input":>18} {"max|diff|":>10} {"NCHW(ms)":>9} {"NHWC(ms)":>9} {"speedup":>8}')
+    for arch in args.archs:
+        model = random_tracer(arch).fuse_for_inference()
+        size = DummyArgs(arch).img_size
+        x = torch.randn(args.batch_size, 3, size, size)
+        nhwc = copy.deepcopy(model).to(memory_format=torch.channels_last)
+        x_nhwc = x.contiguous(memory_format=torch.channels_last)
+
+        with torch.no_grad():
+            diff = (model(x, return_aux=False) - nhwc(x_nhwc, return_aux=False)).abs().max().item()
+        before = measure(lambda: model(x, return_aux=False), args.repeat)
+        after = measure(lambda: nhwc(x_nhwc, return_aux=False), args.repeat)
+
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {diff:>10.2e} {before:>9.2f} {after:>9.2f} {before / after:>7.2f}x')
+
+
+def bench_bf16(args):
+    print(f'{"arch":>4} {"input":>18} {"max|diff|":>10} {"mean|diff|":>10} {"fp32(ms)":>9} {"bf16(ms)":>9} '
+          f'{"speedup":>8}')
+    device = torch.device('cpu')
+    for arch in args.archs:
+        model = random_tracer(arch).fuse_for_inference()
+        size = DummyArgs(arch).img_size
+        x = torch.randn(args.batch_size, 3, size, size)
+
+        def bf16():
+            with autocast(device, 'bf16'):
+                return model(x, return_aux=False).float()
+
+        with torch.no_grad():
+            diff = (model(x, return_aux=False) - bf16()).abs()
+        before = measure(lambda: model(x, return_aux=False), args.repeat)
+        after = measure(bf16, args.repeat)
+
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {diff.max().item():>10.2e} {diff.mean().item():>10.2e} '
+              f'{before:>9.2f} {after:>9.2f} {before / after:>7.2f}x')
+
+
+def bench_uam(args):
+    print(f'{"arch":>4} {"UAM":>4} {"input":>20} {"equal":>6} {"before(us)":>11} {"after(us)":>10} {"speedup":>8}')
+    rfb_channels = sum(int(channel) for channel in DummyArgs().RFB_aggregated_channel)
+    for arch in args.archs:
+        size = DummyArgs(arch).img_size
+        # Frequency Edge Module UAM on the first block (img/4), aggregation UAM on the RFB outputs (img/8)
+        for name, channels, resolution in [('FEM', get_model_shape(arch)[1][0], size // 4),
+                                           ('agg', rfb_channels, size // 8)]:
+            uam = UnionAttentionModule(channels).eval()
+            x = torch.randn(args.batch_size, channels, resolution, resolution)
+            mask = torch.rand(args.batch_size, channels, 1, 1)
+
+            with torch.no_grad():
+                equal = torch.equal(uam.masking(x, mask), legacy_masking(uam, x, mask))
+            before = measure(lambda: legacy_masking(uam, x, mask), args.repeat) * 1000
+            after = measure(lambda: uam.masking(x, mask), args.repeat) * 1000
+
+            print(f'{arch:>4} {name:>4} {str(tuple(x.shape)):>20} {str(equal):>6} {before:>11.1f} {after:>10.1f} '
+                  f'{before / after:>7.2f}x')
+
+
+def bench_decoder(args):
+    print(f'{"arch":>4} {"input":>18} {"decoder":>15} {"max|diff|":>10} {"latency(ms)":>12} {"peak(MiB)":>10}')
+    for arch in args.archs:
+        cfg = DummyArgs(arch)
+        model = random_tracer(arch).fuse_for_inference()
+        x = torch.randn(args.batch_size, 3, cfg.img_size, cfg.img_size)
+        low_res = copy.deepcopy(model)
+        low_res.low_res_average = True
+
+        runs = {'before': lambda: legacy_tracer(model, x, cfg.denoise),
+                'reuse': lambda: model(x, return_aux=False),
+                'low_res_average': lambda: low_res(x, return_aux=False)}
+        with torch.no_grad():
+            reference = runs['before']()
+            for name, run in runs.items():
+                diff = (run() - reference).abs().max().item()
+                latency = measure(run, args.repeat)
+                print(f'{arch:>4} {str(tuple(x.shape)):>18} {name:>15} {diff:>10.2e} {latency:>12.2f} '
+                      f'{peak_memory(run):>10.1f}')
+
+
+def bench_padding(args):
+    print(f'{"arch":>4} {"padding":>8} {"input":>18} {"max|diff|":>10} {"before(ms)":>11} {"after(ms)":>10} '
+          f'{"speedup":>8} {"before(MiB)":>12} {"after(MiB)":>11}')
+    for arch in args.archs:
+        size = DummyArgs(arch).img_size
+        for name, image_size in [('dynamic', None), ('static', 'default')]:
+            override = {} if image_size == 'default' else {'image_size': image_size}
+            backbone = EfficientNet.from_name(f'efficientnet-b{arch}', **override).eval()
+            legacy = legacy_padding(backbone)
+            for img_size in args.img_sizes or [size + 32, size + 1]:
+                x = torch.randn(args.batch_size, 3, img_size, img_size)
+
+                def run(model):
+                    return model.get_blocks(model.initial_conv(x), img_size, img_size, return_edge=False)[0][-1]
+
+                with torch.no_grad():
+                    diff = (run(legacy) - run(backbone)).abs().max().item()
+                before = measure(lambda: run(legacy), args.repeat)
+                after = measure(lambda: run(backbone), args.repeat)
+
+                print(f'{arch:>4} {name:>8} {str(tuple(x.shape)):>18} {diff:>10.2e} {before:>11.2f} {after:>10.2f} '
+                      f'{before / after:>7.2f}x {peak_memory(lambda: run(legacy)):>12.1f} '
+                      f'{peak_memory(lambda: run(backbone)):>11.1f}')
+
+
+def bench_swish(args):
+    print(f'{"arch":>4} {"input":>18} {"mode":>6} {"max|diff|":>10} {"custom(ms)":>11} {"SiLU(ms)":>9} {"speedup":>8}')
+    for arch in args.archs:
+        model = random_tracer(arch)
+        size = DummyArgs(arch).img_size
+        x = torch.randn(args.batch_size, 3, size, size)
+        custom = copy.deepcopy(model).set_swish(memory_efficient=True)
+        native = copy.deepcopy(model).set_swish(memory_efficient=False)
+
+        def train_step(trial):
+            with torch.enable_grad():  # measure() runs under no_grad
+                outputs, edge, ds_map = trial(x)
+                (outputs.mean() + edge.mean() + sum(ds.mean() for ds in ds_map)).backward()
+
+        with torch.no_grad():
+            diff = (custom(x, return_aux=False) - native(x, return_aux=False)).abs().max().item()
+        before = measure(lambda: custom(x, return_aux=False), args.repeat)
+        after = measure(lambda: native(x, return_aux=False), args.repeat)
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {"eval":>6} {diff:>10.2e} {before:>11.2f} {after:>9.2f} '
+              f'{before / after:>7.2f}x')
+
+        custom.train(), native.train()
+        x = torch.randn(max(args.batch_size, 2), 3, size, size)  # BatchNorm of the channel attention needs 2 images
+        before = measure(lambda: train_step(custom), args.repeat)
+        after = measure(lambda: train_step(native), args.repeat)
+        print(f'{arch:>4} {str(tuple(x.shape)):>18} {"train":>6} {"":>10} {before:>11.2f} {after:>9.2f} '
+              f'{before / after:>7.2f}x')
+
+
+def bench_tiled(args):
+    print(f'{"arch":>4} {"image":>12} {"tiles":>6} {"full res(ms)":>13} {"tiled(ms)":>10} {"full res(MiB)":>14} '
+          f'{"tiled(MiB)":>11}')
+    for arch in args.archs:
+        size = DummyArgs(arch).img_size
+        model = random_tracer(arch).fuse_for_inference()
+        # every tile is predicted (band None), args.batch_size tiles per forward pass
+        tiler = TiledPredictor(model, get_test_augmentation(size), size, torch.device('cpu'), band=None,
+                               batch_size=args.batch_size)
+        for img_size in args.img_sizes or [2 * size, 4 * size]:
+            image = np.random.randint(0, 256, (img_size, img_size, 3), dtype=np.uint8)
+            x = torch.randn(1, 3, img_size, img_size)
+            full = measure(lambda: model(x, return_aux=False), args.repeat)
+            tiled = measure(lambda: tiler.predict(image), args.repeat)
+            tiles = tiler.counters['tiles'] // (args.repeat + 2)
+
+            print(f'{arch:>4} {str(image.shape[:2]):>12} {tiles:>6} {full:>13.2f} {tiled:>10.2f} '
+                  f'{peak_memory(lambda: model(x, return_aux=False)):>14.1f} '
+                  f'{peak_memory(lambda: tiler.predict(image)):>11.1f}')
+            tiler.counters['tiles'] = 0
+
+
+def bench_letterbox(args):
+    print(f'{"arch":>4} {"images":>7} {"shapes":>7} {"pixels":>7} {"squashed(img/s)":>16} {"letterbox(img/s)":>17} '
+          f'{"speedup":>8}')
+    for arch in args.archs:
+        size = DummyArgs(arch).img_size
+        model = random_tracer(arch).fuse_for_inference()
+        images = mixed_aspect_images(2 * size, args.batch_size)
+        sizes = [image.shape[:2] for image in images]
+        square_batches = [range(start, min(start + args.batch_size, len(images)))
+                          for start in range(0, len(images), args.batch_size)]
+        letterbox_batches = group_by_shape(sizes, size, args.batch_size)
+
+        def run(transform, batches, letterbox):
+            # transform, forward pass and resizing back, as in Inference.test
+            for batch in batches:
+                inputs = torch.stack([transform(image=images[idx])['image'] for idx in batch])
+                outputs = model(inputs, return_aux=False)
+                for i, idx in enumerate(batch):
+                    h, w = sizes[idx]
+                    output = outputs[i]
+                    if letterbox:
+                        rows, cols = letterbox_size(h, w, size)
+                        output = output[:, :rows, :cols]
+                    F.interpolate(output.unsqueeze(0), size=(h, w), mode='bilinear')
+
+        squashed = measure(lambda: run(get_test_augmentation(size), square_batches, False), args.repeat)
+        letterboxed = measure(lambda: run(get_letterbox_augmentation(size), letterbox_batches, True), args.repeat)
+        # input pixels of the letterbox batches relative to img_size x img_size per image
+        pixels = sum(np.prod(padded_size(h, w, size)) for h, w in sizes) / (len(images) * size ** 2)
+        shapes = len({padded_size(h, w, size) for h, w in sizes})
+
+        print(f'{arch:>4} {len(images):>7} {shapes:>7} {pixels:>7.2f} {len(images) / squashed * 1000:>16.2f} '
+              f'{len(images) / letterboxed * 1000:>17.2f} {squashed / letterboxed:>7.2f}x')
+
+
+def synthetic_clip(num_frames=48, size=(360, 640)):
+    """RGB frames of a smooth random scene with a square moving 2 px per frame and a cut halfway."""
+    scenes = [cv2.resize(np.random.randint(0, 256, (9, 16, 3), dtype=np.uint8), size[::-1]) for _ in range(2)]
+    frames = []
+    for i in range(num_frames):
+        frame = scenes[2 * i // num_frames].copy()
+        cv2.rectangle(frame, (100 + 2 * i, 100), (220 + 2 * i, 220), (255, 0, 0), -1)
+        frames.append(frame)
+    return frames
+
+
+def bench_video(args):
+    print(f'{"arch":>4} {"tolerance":>9} {"frames":>7} {"predicted":>10} {"skipped":>8} {"fps":>7} {"speedup":>8} '
+          f'{"mask MAE":>9}')
+    frames = synthetic_clip()
+    for arch in args.archs:
+        size = DummyArgs(arch).img_size
+        model = random_tracer(arch).fuse_for_inference().set_swish(memory_efficient=False)
+        reference, base_fps = None, None
+        for tolerance in [0, 1, 2, 4, 8]:
+            predictor = VideoPredictor(model, get_test_augmentation(size), size, torch.device('cpu'),
+                                       batch_size=args.batch_size, tolerance=tolerance)
+            masks = [mask.astype(np.float32) for _, mask in predictor.predict(frames)]
+            reference = reference or masks  # every frame is predicted with tolerance 0
+            fps = predictor.counters['frames'] / predictor.counters['time']
+            base_fps = base_fps or fps
+            skipped = 1 - predictor.counters['keyframes'] / predictor.counters['frames']
+            mae = np.mean([np.abs(mask - ref).mean() / 255 for mask, ref in zip(masks, reference)])
+            print(f'{arch:>4} {tolerance:>9} {len(frames):>7} {predictor.counters["keyframes"]:>10} {skipped:>8.1%} '
+                  f'{fps:>7.2f} {fps / base_fps:>7.2f}x {mae:>9.4f}')
+
+
+def bench_cache(args):
+    print(f'{"arch":>4} {"image":>12} {"miss(ms)":>9} {"memory hit(ms)":>15} {"disk hit(ms)":>13} {"speedup":>8}')
+    for arch in args.archs:
+        size = DummyArgs(arch).img_size
+        model = random_tracer(arch).fuse_for_inference().set_swish(memory_efficient=False)
+        transform = get_test_augmentation(size)
+        image = cv2.imencode('.jpg', np.random.randint(0, 256, (768, 1024, 3), dtype=np.uint8))[1].tobytes()
+
+        def miss(cache):
+            # decoding, forward pass, resizing back, salient object and PNG encoding, as in Inference.test
+            rgb = cv2.cvtColor(cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+            output = model(transform(image=rgb)['image'].unsqueeze(0), return_aux=False)
+            mask = (F.interpolate(output, size=rgb.shape[:2], mode='bilinear')[0, 0].numpy() * 255.0).astype(np.uint8)
+            cache.put(ResultCache.key(image, arch), encode_png(mask), encode_png(salient_object(rgb, mask)))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResultCache(cache_dir=cache_dir)
+            disk_cache = ResultCache(max_bytes=0, cache_dir=cache_dir)  # every lookup reads the PNG files
+            missed = measure(lambda: miss(cache), args.repeat)
+            memory = measure(lambda: cache.get(ResultCache.key(image, arch)), args.repeat)
+            disk = measure(lambda: disk_cache.get(ResultCache.key(image, arch)), args.repeat)
+
+        print(f'{arch:>4} {"1024x768":>12} {missed:>9.2f} {memory:>15.3f} {disk:>13.3f} {missed / disk:>7.0f}x')
+
+
+
+def bench_batch(args):
+    print(f'{"arch":>4} {"images":>7} {"batch_size":>11} {"latency(ms)":>12} {"images/s":>9} {"speedup":>8}')
+    images = mixed_aspect_images(1024, 2)
+    for arch in args.archs:
+        state_dict = random_tracer(arch).state_dict()
+        inference_demo_helper.load_pretrained = lambda name, device, weights_dir=None: state_dict  # no checkpoint
+        demo = inference_demo_helper.Inference(DummyArgs(arch))
+        baseline = None
+        for batch_size in args.batch_sizes:
+            latency = measure(lambda: demo.test_batch(images, batch_size), args.repeat, warmup=1)
+            baseline = baseline or latency
+            print(f'{arch:>4} {len(images):>7} {batch_size:>11} {latency:>12.2f} {len(images) / latency * 1000:>9.2f} '
+                  f'{baseline / latency:>7.2f}x')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TRACER microbenchmarks')
+    parser.add_argument('target', choices=['fem', 'fft', 'fuse', 'branches', 'channels_last', 'bf16', 'uam',
+                                           'decoder', 'padding', 'swish',
+                                           'tiled', 'letterbox', 'cache', 'video', 'batch'])
+    parser.add_argument('--archs', nargs='+', default=[str(arch) for arch in range(8)])
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='letterbox: also the number of images of each aspect ratio')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 2, 4, 8],
+                        help='batch: test_batch batch sizes (speedup against the first)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--img_sizes', nargs='+', type=int, default=None,
+                        help='padding: input sizes (default: the arch input size + 32 and + 1), '
+                             'tiled: image sizes (default: 2 and 4 times the arch input size)')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    {'fem': bench_fem, 'fft': bench_fft, 'fuse': bench_fuse, 'branches': bench_branches,
+     'channels_last': bench_channels_last,
+     'bf16': bench_bf16, 'uam': bench_uam, 'decoder': bench_decoder, 'padding': bench_padding,
+     'swish': bench_swish, 'tiled': bench_tiled, 'letterbox': bench_letterbox,
+     'cache': bench_cache, 'video': bench_video, 'batch': bench_batch}[args.target](args)
@@ -11,6 +11,30 @@ class DummyArgs():
         self.gamma = 0.1
         self.multi_gpu = False
         self.img_size = d[int(arch)] # image_size is based on architecture
+        self.weights_dir = None # offline weight store directory (falls back to $TRACER_WEIGHTS_DIR)
+        self.model_file = None # exported TorchScript (.pt) or ONNX (.onnx) artifact (export.py) used instead of the eager model
+        self.num_threads = None # intra-op threads of the onnxruntime backend (default: onnxruntime's choice)
+        self.channels_last = False # run the eager model and its inputs in NHWC (faster depthwise/1x1 convs on CPU)
+        self.precision = 'fp32' # inference precision: 'fp32' or 'bf16' (bfloat16 autocast, FFT/quantile/softmax in fp32)
+        self.low_res_average = False # average the decoder maps at 1/4 resolution and upsample once in inference
+        self.swish = 'memory_efficient' # training swish: 'memory_efficient', 'native' (SiLU) or 'auto' (timed trial, faster one)
+        self.cascade_arch = None # large arch re-running the low-confidence images of arch in inference (None: off)
+        self.cascade_band = 0.15 # half width of the uncertain band around the post-processing threshold
+        self.cascade_max_uncertain = 0.05 # images with a larger fraction of uncertain pixels are escalated
+        self.tile = False # full-resolution inference: global pass plus overlapping img_size tiles of the original image
+        self.tile_overlap = 0.25 # minimum overlap fraction of neighbouring tiles
+        self.tile_batch_size = 4 # tiles per forward pass (bounds the memory of the forward passes)
+        self.tile_band = 0.15 # only tiles with global map pixels within this band of the threshold (None: all tiles)
+        self.letterbox = False # keep the aspect ratio in inference: long side to img_size, padded to the stride, batched by shape
+        self.cache_size = 0 # MiB of the in-memory tier of the result cache of repeated images (0: no in-memory tier)
+        self.cache_dir = None # directory of the on-disk tier of the result cache (None: no on-disk tier)
+        self.cache_disk_size = 1024 # MiB bound of the on-disk tier, least recently used results deleted first (0: unbounded)
+        self.video = None # video file or directory of frames predicted in inference instead of the dataset images
+        self.video_output = None # mask video (.mp4/.avi) or directory of PNG masks (default: mask/<video name>.mp4)
+        self.video_tolerance = 2.0 # frames within this mean absolute difference (0-255) of the last keyframe reuse its mask
+        self.pipeline = False # overlap decoding, forward, post-processing and writing in inference
+        self.queue_size = 4 # bounded queue size between pipeline stages
+        self.num_writers = 2 # PNG writer threads in the inference pipeline
 
 
 def getConfig():
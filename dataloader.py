@@ -1,11 +1,13 @@
 import cv2
 import glob
+import math
 import torch
 import numpy as np
 import albumentations as albu
+from PIL import Image
 from pathlib import Path
 from albumentations.pytorch.transforms import ToTensorV2
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from sklearn.model_selection import train_test_split
 
 
@@ -54,13 +56,16 @@ class DatasetGenerate(Dataset):
 
 
 class Test_DatasetGenerate(Dataset):
-    def __init__(self, img_folder, gt_folder=None, transform=None):
-        self.images = sorted(glob.glob(img_folder + '/*'))
+    def __init__(self, img_folder, gt_folder=None, transform=None, images=None, return_path=False):
+        # images: paths of a subset of the images of img_folder (without gt_folder)
+        # return_path: full image path instead of the file stem as image_name (unique when stems are shared)
+        self.images = sorted(glob.glob(img_folder + '/*')) if images is None else images
         self.gts = sorted(glob.glob(gt_folder + '/*')) if gt_folder is not None else None
         self.transform = transform
+        self.return_path = return_path
 
     def __getitem__(self, idx):
-        image_name = Path(self.images[idx]).stem
+        image_name = self.images[idx] if self.return_path else Path(self.images[idx]).stem
         image = cv2.imread(self.images[idx])
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         original_size = image.shape[:2]
@@ -79,9 +84,9 @@ class Test_DatasetGenerate(Dataset):
 
 
 def get_loader(img_folder, gt_folder, edge_folder, phase: str, batch_size, shuffle,
-               num_workers, transform, seed=None):
+               num_workers, transform, seed=None, images=None, return_path=False):
     if phase == 'test':
-        dataset = Test_DatasetGenerate(img_folder, gt_folder, transform)
+        dataset = Test_DatasetGenerate(img_folder, gt_folder, transform, images, return_path)
         data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
     else:
         dataset = DatasetGenerate(img_folder, gt_folder, edge_folder, phase, transform, seed)
@@ -93,6 +98,35 @@ def get_loader(img_folder, gt_folder, edge_folder, phase: str, batch_size, shuff
     return data_loader
 
 
+class ShapeBatchSampler(Sampler):
+    """
+    Batches of the indices of images with the same letterbox input shape (padded_size), so that images of different
+    aspect ratios are stacked without padding them to a common size. Shapes come in the order of their first image.
+    """
+    def __init__(self, sizes, img_size, batch_size, stride=32):
+        self.batches = group_by_shape(sizes, img_size, batch_size, stride)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def get_letterbox_loader(img_folder, gt_folder, batch_size, num_workers, img_size, stride=32, images=None,
+                         return_path=False):
+    dataset = Test_DatasetGenerate(img_folder, gt_folder, get_letterbox_augmentation(img_size, stride), images,
+                                   return_path)
+    sizes = [image_size(path) for path in dataset.images]
+    sampler = ShapeBatchSampler(sizes, img_size, batch_size, stride)
+    data_loader = DataLoader(dataset, batch_sampler=sampler, num_workers=num_workers)
+
+    shapes = len({padded_size(*size, img_size, stride) for size in sizes})
+    print(f'test length : {len(dataset)}, letterbox shapes : {shapes}, batches : {len(sampler)}')
+
+    return data_loader
+
+
 def get_train_augmentation(img_size, ver):
     if ver == 1:
         transforms = albu.Compose([
@@ -137,11 +171,53 @@ def get_test_augmentation(img_size):
     return transforms
 
 
-def gt_to_tensor(gt):
+def get_letterbox_augmentation(img_size, stride=32):
+    # the long side is resized to img_size and the normalized image is zero padded at the bottom and right
+    # to a multiple of the network stride: the image is the top-left letterbox_size region of the input
+    transforms = albu.Compose([
+        albu.LongestMaxSize(img_size, always_apply=True),
+        albu.Normalize([0.485, 0.456, 0.406],
+                       [0.229, 0.224, 0.225]),
+        albu.PadIfNeeded(min_height=None, min_width=None, pad_height_divisor=stride, pad_width_divisor=stride,
+                         position='top_left', border_mode=cv2.BORDER_CONSTANT, value=0),
+        ToTensorV2(),
+    ])
+    return transforms
+
+
+def letterbox_size(height, width, img_size):
+    """(height, width) of an image resized by albu.LongestMaxSize(img_size), i.e. without the stride padding."""
+    scale = img_size / max(height, width)
+    return round(height * scale), round(width * scale)
+
+
+def padded_size(height, width, img_size, stride=32):
+    """Input shape (height, width) of an image in letterbox mode: letterbox_size rounded up to the stride."""
+    return tuple(math.ceil(dim / stride) * stride for dim in letterbox_size(height, width, img_size))
+
+
+def group_by_shape(sizes, img_size, batch_size, stride=32):
+    """Batches (lists of at most batch_size indices) of image sizes [(height, width)] with the same padded_size."""
+    groups = {}
+    for idx, (height, width) in enumerate(sizes):
+        groups.setdefault(padded_size(height, width, img_size, stride), []).append(idx)
+    return [group[start:start + batch_size] for group in groups.values() for start in range(0, len(group), batch_size)]
+
+
+def image_size(path):
+    """(height, width) of an image file as cv2.imread decodes it, from the file header."""
+    with Image.open(path) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):  # cv2.imread applies the EXIF rotation
+            width, height = height, width
+    return height, width
+
+
+def gt_to_tensor(gt, device='cuda'):
     gt = cv2.imread(gt)
     gt = cv2.cvtColor(gt, cv2.COLOR_BGR2GRAY) / 255.0
     gt = np.where(gt > 0.5, 1.0, 0.0)
-    gt = torch.tensor(gt, device='cuda', dtype=torch.float32)
+    gt = torch.tensor(gt, device=device, dtype=torch.float32)
     gt = gt.unsqueeze(0).unsqueeze(1)
 
     return gt
@@ -0,0 +1,145 @@
+"""
+Accuracy gate for optimized TRACER models (int8, exported, reduced precision).
+
+Computes MAE, max-F, avg-F and S-measure (util.metrics.Evaluation_metrics) of a candidate model and of the fp32
+eager model on a labelled test set, and reports the deltas.
+
+e.g.
+    python evaluate.py --arch 7 --image_dir data/DUTS/Test/images --mask_dir data/DUTS/Test/masks \
+                       --model_file TE-7_640_int8.pt
+    python evaluate.py --arch 7 --image_dir data/DUTS/Test/images --mask_dir data/DUTS/Test/masks --precision bf16
+
+With --cascade_arch, the candidate is a cascade of --arch (small) and --cascade_arch (large), compared with the large
+model alone; the small model alone and the per-stage counters and throughput of the cascade are reported too.
+    python evaluate.py --arch 0 --cascade_arch 7 --image_dir data/DUTS/Test/images --mask_dir data/DUTS/Test/masks
+
+With --letterbox, the candidate is the eager model on aspect-preserving inputs batched by shape; the throughput of
+both input modes is reported too.
+    python evaluate.py --arch 7 --letterbox --image_dir data/DUTS/Test/images --mask_dir data/DUTS/Test/masks
+"""
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from config import DummyArgs
+from dataloader import get_test_augmentation, get_loader, get_letterbox_loader, letterbox_size, gt_to_tensor
+from export import build_eager_model
+from model_tracer.exported import load_exported
+from model_tracer.cascade import CascadeTRACER
+from util.utils import AvgMeter, autocast
+from util.metrics import Evaluation_metrics
+
+METRICS = ['mae', 'max_f', 'avg_f', 's_measure']
+
+
+def get_eval_loader(image_dir, mask_dir, img_size, batch_size, num_workers=4):
+    return get_loader(image_dir, mask_dir, edge_folder=None, phase='test', batch_size=batch_size, shuffle=False,
+                      num_workers=num_workers, transform=get_test_augmentation(img_size=img_size))
+
+
+def evaluate(model, loader, device, precision='fp32', letterbox=None):
+    """
+    Returns the average metrics of model over (images, masks, original_size, image_name) batches.
+    letterbox: img_size of a letterbox loader (dataloader.get_letterbox_loader), the stride padding of the outputs
+               is cropped off before resizing them back.
+    """
+    meters = {metric: AvgMeter() for metric in METRICS}
+    eval_tool = Evaluation_metrics('evaluation', device)
+
+    with torch.no_grad():
+        for images, masks, original_size, image_name in tqdm(loader):
+            images = images.to(device, dtype=torch.float32)
+            with autocast(device, precision):
+                outputs = model(images, return_aux=False).float()
+            H, W = original_size
+
+            for i in range(images.size(0)):
+                h, w = H[i].item(), W[i].item()
+                mask = gt_to_tensor(masks[i], device)
+                output = outputs[i]
+                if letterbox is not None:
+                    rows, cols = letterbox_size(h, w, letterbox)
+                    output = output[:, :rows, :cols]
+                output = F.interpolate(output.unsqueeze(0), size=(h, w), mode='bilinear')
+                for metric, value in zip(METRICS, eval_tool.cal_total_metrics(output, mask)):
+                    meters[metric].update(value, n=1)
+
+    return {metric: meter.avg for metric, meter in meters.items()}
+
+
+def report(results, reference='fp32'):
+    """Prints the metrics of each model in results ({name: metrics}) and their deltas from the reference model."""
+    print(f'{"model":>12} ' + ' '.join(f'{metric:>10} {"delta":>8}' for metric in METRICS))
+    for name, metrics in results.items():
+        print(f'{name:>12} ' + ' '.join(f'{metrics[metric]:>10.4f} {metrics[metric] - results[reference][metric]:>+8.4f}'
+                                        for metric in METRICS))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare an optimized TRACER model with the fp32 model')
+    parser.add_argument('--arch', type=str, default='7')
+    parser.add_argument('--img_size', type=int, default=None, help='default: the arch input size')
+    parser.add_argument('--image_dir', type=str, required=True)
+    parser.add_argument('--mask_dir', type=str, required=True)
+    parser.add_argument('--model_file', type=str, default=None,
+                        help='artifact of export.py or quantize.py (default: the eager model)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='precision of the candidate model')
+    parser.add_argument('--checkpoint', type=str, default=None, help='local TRACER checkpoint (default: TE-x)')
+    parser.add_argument('--weights_dir', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_threads', type=int, default=None, help='onnxruntime intra-op threads')
+    parser.add_argument('--cascade_arch', type=str, default=None, help='large arch of a cascade with --arch')
+    parser.add_argument('--cascade_band', type=float, default=0.15)
+    parser.add_argument('--cascade_max_uncertain', type=float, default=0.05)
+    parser.add_argument('--letterbox', action='store_true', help='aspect-preserving inputs batched by shape')
+    cli = parser.parse_args()
+    if cli.letterbox and (cli.model_file is not None or cli.cascade_arch is not None):
+        parser.error('--letterbox evaluates the eager model (exported models have a fixed input size)')
+
+    args = DummyArgs(arch=cli.arch)
+    args.img_size = cli.img_size or args.img_size
+    args.checkpoint, args.weights_dir = cli.checkpoint, cli.weights_dir
+    device = torch.device('cpu')
+
+    if cli.cascade_arch is None:
+        loader = get_eval_loader(cli.image_dir, cli.mask_dir, args.img_size, cli.batch_size)
+        eager = build_eager_model(args, device)
+        candidate = eager if cli.model_file is None else load_exported(cli.model_file, device, cli.num_threads).eval()
+        if cli.letterbox:
+            letterbox_loader = get_letterbox_loader(cli.image_dir, cli.mask_dir, cli.batch_size, num_workers=4,
+                                                    img_size=args.img_size)
+            results, times = {}, {}
+            for name, run in [('fp32', lambda: evaluate(eager, loader, device)),
+                              ('letterbox', lambda: evaluate(eager, letterbox_loader, device, cli.precision,
+                                                             letterbox=args.img_size))]:
+                t = time.perf_counter()
+                results[name] = run()
+                times[name] = time.perf_counter() - t
+            report(results)
+            images = len(loader.dataset)
+            print(f'throughput (with metrics): squashed {images / times["fp32"]:.2f} images/s, '
+                  f'letterbox {images / times["letterbox"]:.2f} images/s, '
+                  f'speedup: {times["fp32"] / times["letterbox"]:.2f}x')
+        else:
+            results = {'fp32': evaluate(eager, loader, device),
+                       'candidate': evaluate(candidate, loader, device, cli.precision)}
+            report(results)
+    else:
+        large_args = DummyArgs(arch=cli.cascade_arch)
+        large_args.checkpoint, large_args.weights_dir = None, cli.weights_dir
+        large = build_eager_model(large_args, device)
+        small = build_eager_model(args, device) if cli.model_file is None else \
+            load_exported(cli.model_file, device, cli.num_threads).eval()
+        small_only = CascadeTRACER(small, large, small_size=args.img_size, max_uncertain=1.0)  # never escalates
+        cascade = CascadeTRACER(small, large, small_size=args.img_size, band=cli.cascade_band,
+                                max_uncertain=cli.cascade_max_uncertain)
+
+        # images at the large input size, the small model runs on them resized to --img_size
+        loader = get_eval_loader(cli.image_dir, cli.mask_dir, large_args.img_size, cli.batch_size)
+        results = {'fp32': evaluate(large, loader, device, cli.precision),
+                   'small': evaluate(small_only, loader, device, cli.precision),
+                   'cascade': evaluate(cascade, loader, device, cli.precision)}
+        report(results)
+        cascade.report()
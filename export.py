@@ -0,0 +1,131 @@
+"""
+Export TRACER to a frozen TorchScript or an ONNX artifact for CPU serving.
+
+TorchScript: tracing inlines the small conv modules, and freezing folds the parameters as constants and BatchNorm
+into the preceding convolutions.
+ONNX: the FFT high-pass of the Frequency Edge Module has no ONNX operator, so it is exported as its matmul DFT
+equivalent (TRACER.set_onnx_compatible); the Union Attention Modules threshold with TopK. The graph has a dynamic
+batch axis and a fixed input size, and runs with onnxruntime's CPU provider (OnnxTRACER).
+The artifact is checked against the eager model on the sample images, and the export fails (non-zero exit) when
+the saliency maps differ by more than --tolerance.
+
+e.g.
+    python export.py --arch 7 --output TE-7_640.pt
+    python export.py --arch 7 --format onnx --num_threads 8
+    python main.py inference ... --model_file TE-7_640.pt
+"""
+import time
+import argparse
+import warnings
+import cv2
+import numpy as np
+import torch
+from config import DummyArgs
+from dataloader import get_test_augmentation
+from model_tracer.TRACER import TRACER
+from model_tracer.exported import TRACERPredictor, load_exported
+from util.utils import load_pretrained, strip_module_prefix
+
+SAMPLE_IMAGES = ['test_image.png', 'test_image.jpeg']
+
+
+def build_eager_model(args, device):
+    model = TRACER(args, pretrained_backbone=False).to(device)
+    if args.checkpoint is not None:
+        state_dict = torch.load(args.checkpoint, map_location=device)
+    else:
+        state_dict = load_pretrained(f'TE-{args.arch}', device, args.weights_dir)
+    model.load_state_dict(strip_module_prefix(state_dict))
+    return model.set_swish(memory_efficient=False).eval()
+
+
+def sample_inputs(img_size, device):
+    transform = get_test_augmentation(img_size=img_size)
+    images = []
+    for path in SAMPLE_IMAGES:
+        image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+        images.append(transform(image=image)['image'])
+    return torch.stack(images).to(device, dtype=torch.float32)
+
+
+def export_torchscript(model, img_size, output, device):
+    model.model.set_swish(memory_efficient=False)  # the custom autograd Function cannot be serialized
+    example = torch.randn(1, 3, img_size, img_size, device=device)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(TRACERPredictor(model).eval(), example)
+    frozen = torch.jit.freeze(traced)
+    frozen.save(output)
+    print(f'Saved TorchScript TRACER to {output}')
+
+
+def export_onnx(model, img_size, output, device, opset_version=17):
+    model.model.set_swish(memory_efficient=False)
+    model.set_onnx_compatible(True)
+    example = torch.randn(1, 3, img_size, img_size, device=device)
+    with torch.no_grad(), warnings.catch_warnings():
+        model(example, return_aux=False)  # builds the DFT bases eagerly so that they are exported as constants
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        torch.onnx.export(TRACERPredictor(model).eval(), example, output, opset_version=opset_version,
+                          input_names=['images'], output_names=['saliency'],
+                          dynamic_axes={'images': {0: 'batch'}, 'saliency': {0: 'batch'}}, dynamo=False)
+    model.set_onnx_compatible(False)
+    print(f'Saved ONNX TRACER to {output}')
+
+
+def check_parity(eager, exported, inputs, tolerance=None):
+    """Prints the max and mean |diff| of the saliency maps and raises a RuntimeError when the max exceeds tolerance
+    (None: report only). Returns the max |diff|."""
+    with torch.no_grad():
+        diff = (eager(inputs, return_aux=False) - exported(inputs)).abs()
+    print(f'Parity on {inputs.size(0)} images: max |diff| {diff.max().item():.2e}, '
+          f'mean |diff| {diff.mean().item():.2e}')
+    if tolerance is not None and not diff.max().item() <= tolerance:  # NaN fails too
+        raise RuntimeError(f'Exported TRACER differs from the eager model: max |diff| {diff.max().item():.2e} > '
+                           f'{tolerance:.2e}')
+    return diff.max().item()
+
+
+def compare_latency(models, inputs, repeat):
+    with torch.no_grad():
+        for name, model in models.items():
+            model(inputs, return_aux=False)  # warm up
+            times = []
+            for _ in range(repeat):
+                t = time.perf_counter()
+                model(inputs, return_aux=False)
+                times.append((time.perf_counter() - t) * 1000)
+            print(f'{name:>12}: {np.median(times):.1f} ms / batch of {inputs.size(0)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export TRACER for CPU serving')
+    parser.add_argument('--arch', type=str, default='7')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--img_size', type=int, default=None, help='default: the arch input size')
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--checkpoint', type=str, default=None, help='local TRACER checkpoint (default: TE-x)')
+    parser.add_argument('--weights_dir', type=str, default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--num_threads', type=int, default=None, help='onnxruntime intra-op threads')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='max |diff| of the saliency maps allowed against the eager model')
+    cli = parser.parse_args()
+
+    args = DummyArgs(arch=cli.arch)
+    args.img_size = cli.img_size or args.img_size
+    args.checkpoint, args.weights_dir = cli.checkpoint, cli.weights_dir
+    extension = {'torchscript': 'pt', 'onnx': 'onnx'}[cli.format]
+    output = cli.output or f'TE-{args.arch}_{args.img_size}.{extension}'
+    device = torch.device('cpu')
+
+    eager = build_eager_model(args, device)
+    if cli.format == 'onnx':
+        export_onnx(eager, args.img_size, output, device)
+    else:
+        export_torchscript(eager, args.img_size, output, device)
+
+    exported = load_exported(output, device, cli.num_threads).eval()
+    inputs = sample_inputs(args.img_size, device)
+    check_parity(eager, exported, inputs, cli.tolerance)
+    compare_latency({'eager': eager, cli.format: exported}, inputs, cli.repeat)
@@ -3,70 +3,276 @@ author: Min Seok Lee and Wooseok Shin
 """
 import os
 import cv2
+import copy
 import time
+import queue
+import threading
 import numpy as np
 import torch
+from pathlib import Path
 import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.transforms import transforms
 from tqdm import tqdm
-from dataloader import get_test_augmentation, get_loader
-from model.TRACER import TRACER
-from util.utils import load_pretrained
+from torch.utils.data import DataLoader
+from dataloader import get_test_augmentation, get_letterbox_augmentation, get_loader, get_letterbox_loader, letterbox_size, \
+    Test_DatasetGenerate
+from model_tracer.TRACER import TRACER
+from model_tracer.exported import load_exported
+from model_tracer.cascade import CascadeTRACER
+from model_tracer.tiling import TiledPredictor, salient_object
+from model_tracer.video import VideoPredictor, MaskWriter, read_frames
+from config import DummyArgs
+from util.utils import load_pretrained, strip_module_prefix, autocast
+from util.result_cache import ResultCache, cache_settings, encode_png
 
 class Inference():
     def __init__(self, args, save_path):
         super(Inference, self).__init__()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.test_transform = get_test_augmentation(img_size=args.img_size)
+        self.input_size = args.img_size
+        self.test_transform = get_test_augmentation(img_size=self.input_size)
         self.args = args
         self.save_path = save_path
+        self.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+        if args.letterbox and (args.model_file is not None or args.cascade_arch is not None or args.tile):
+            raise ValueError('letterbox inference runs the eager model (exported models have a fixed input size) '
+                             'without cascade_arch or tile')
+        if args.video is not None and args.tile:
+            raise ValueError('video inference predicts whole frames, tile is not supported')
 
         # Network
-        self.model = TRACER(args).to(self.device)
-        if args.multi_gpu or self.device.type == 'cpu': # original code does not infer with CPU conditions because it was saved with nn.DataParallel
-            self.model = nn.DataParallel(self.model).to(self.device)
-
-        path = load_pretrained(f'TE-{args.arch}', self.device)
-        self.model.load_state_dict(path)
+        if args.model_file is not None: # exported artifact (export.py)
+            self.model = load_exported(args.model_file, self.device, args.num_threads)
+        else:
+            self.model = self.load_model(args)
+        if args.cascade_arch is not None: # small arch first, low-confidence images again with cascade_arch
+            large_args = copy.copy(args)
+            large_args.arch = args.cascade_arch
+            self.model = CascadeTRACER(self.model, self.load_model(large_args), small_size=args.img_size,
+                                       band=args.cascade_band, max_uncertain=args.cascade_max_uncertain)
+            self.input_size = DummyArgs(args.cascade_arch).img_size
+            self.test_transform = get_test_augmentation(img_size=self.input_size)
         print('###### pre-trained Model restored #####')
 
-        te_img_folder = os.path.join(args.data_path, args.dataset)
-        te_gt_folder = None
+        # results of repeated images by their file bytes (args.cache_size, args.cache_dir)
+        self.cache = ResultCache.from_config(args)
+        self.cache_settings = cache_settings(args, self.input_size) if self.cache is not None else None
+        self.cache_keys, self.duplicates = {}, {} # by image path (images may share a file stem)
 
-        self.test_loader = get_loader(te_img_folder, te_gt_folder, edge_folder=None, phase='test',
-                                      batch_size=args.batch_size, shuffle=False,
-                                      num_workers=args.num_workers, transform=self.test_transform)
+        self.te_img_folder = os.path.join(args.data_path, args.dataset)
+        self.test_loader = self.get_test_loader() if args.video is None else None
 
-        if args.save_map is not None:
+        if args.save_map is not None and args.video is None:
             os.makedirs(os.path.join('mask', self.args.dataset), exist_ok=True)
             os.makedirs(os.path.join('object', self.args.dataset), exist_ok=True)
 
+    def get_test_loader(self, images=None):
+        if self.args.letterbox: # aspect ratio kept, images batched by their padded shape
+            return get_letterbox_loader(self.te_img_folder, None, batch_size=self.args.batch_size,
+                                        num_workers=self.args.num_workers, img_size=self.input_size, images=images,
+                                        return_path=True)
+        return get_loader(self.te_img_folder, None, edge_folder=None, phase='test',
+                          batch_size=self.args.batch_size, shuffle=False,
+                          num_workers=self.args.num_workers, transform=self.test_transform, images=images,
+                          return_path=True)
+
+    def uncached_images(self):
+        """
+        Writes the results of the test images found in the result cache, keyed by their file bytes (no decoding and
+        no forward pass), and returns the paths of the other images, each content once (its duplicates are written
+        with it by save_results). Returns None (all images) without a cache or without saved results.
+        """
+        if self.cache is None or self.args.save_map is None:
+            return None
+        images, first = [], {}
+        for path in self.test_loader.dataset.images:
+            with open(path, 'rb') as f:
+                key = self.cache.key(f.read(), *self.cache_settings)
+            if key in first:
+                self.duplicates[first[key]].append(path)
+                continue
+            cached = self.cache.get(key)
+            if cached is None:
+                images.append(path)
+                first[key] = path
+                self.cache_keys[path], self.duplicates[path] = key, []
+            else:
+                self.write_results(path, *cached)
+        return images
+
+    def load_model(self, args):
+        model = TRACER(args, pretrained_backbone=False).to(self.device, memory_format=self.memory_format)
+        path = load_pretrained(f'TE-{args.arch}', self.device, args.weights_dir)
+        model.load_state_dict(strip_module_prefix(path)) # released checkpoints come from nn.DataParallel
+        model.fuse_for_inference() # fold BatchNorm into the convolutions
+        model.set_swish(memory_efficient=False) # native SiLU
+        if args.multi_gpu:
+            model = nn.DataParallel(model).to(self.device)
+        return model
+
     def test(self):
+        if self.args.video is not None:
+            return self.test_video()
+        if self.args.tile:
+            return self.test_tiled()
+        if self.args.pipeline:
+            return self.test_pipeline()
+
         self.model.eval()
         t = time.time()
+        uncached = self.uncached_images()
+        test_loader = self.test_loader if uncached is None else self.get_test_loader(uncached)
 
         with torch.no_grad():
-            for i, (images, original_size, image_name) in enumerate(tqdm(self.test_loader)):
+            for i, (images, original_size, image_path) in enumerate(tqdm(test_loader)):
                 images = torch.tensor(images, device=self.device, dtype=torch.float32)
 
-                outputs, edge_mask, ds_map = self.model(images)
+                with autocast(self.device, self.args.precision):
+                    outputs = self.model(images.contiguous(memory_format=self.memory_format), return_aux=False).float()
                 H, W = original_size
 
                 for i in range(images.size(0)):
                     h, w = H[i].item(), W[i].item()
-                    output = F.interpolate(outputs[i].unsqueeze(0), size=(h, w), mode='bilinear')
 
                     # Save prediction map
                     if self.args.save_map is not None:
-                        output = (output.squeeze().detach().cpu().numpy() * 255.0).astype \
-                            (np.uint8)  # convert uint8 type
-                        
-                        salient_object = self.post_processing(images[i], output, H, W)
-                        cv2.imwrite(os.path.join('mask', self.args.dataset, image_name[i] + '.png'), output)
-                        cv2.imwrite(os.path.join('object', self.args.dataset, image_name[i] + '.png'), salient_object)
+                        output, salient_object = self.resize_and_post_process(images[i], outputs[i], h, w)
+                        self.save_results(image_path[i], output, salient_object)
 
         print(f'time: {time.time() - t:.3f}s')
+        if self.args.cascade_arch is not None:
+            self.model.report()
+        if self.cache is not None:
+            self.cache.report()
+
+    def test_pipeline(self):
+        """
+        Runs decoding, forward pass, resize/post-processing and PNG writing as concurrent stages connected
+        by bounded queues, so a slow stage applies backpressure instead of stalling the others.
+        Decoding is done by the DataLoader workers (args.num_workers).
+        """
+        self.model.eval()
+        t = time.time()
+        save_map = self.args.save_map is not None
+        uncached = self.uncached_images()
+        test_loader = self.test_loader if uncached is None else self.get_test_loader(uncached)
+        progress = tqdm(total=len(test_loader.dataset))
+
+        def forward(batch):
+            images, original_size, image_path = batch
+            with torch.no_grad():
+                images = torch.as_tensor(images, device=self.device, dtype=torch.float32)
+                with autocast(self.device, self.args.precision):
+                    outputs = self.model(images.contiguous(memory_format=self.memory_format), return_aux=False).float()
+            yield images, outputs, original_size, image_path
+
+        def post_process(batch):
+            images, outputs, (H, W), image_path = batch
+            with torch.no_grad():
+                for i in range(images.size(0)):
+                    if save_map:
+                        output, salient_object = self.resize_and_post_process(images[i], outputs[i],
+                                                                              H[i].item(), W[i].item())
+                        yield image_path[i], output, salient_object
+                    else:
+                        progress.update(1)
+
+        def write(sample):
+            self.save_results(*sample)
+            progress.update(1)
+            return ()
+
+        pipeline = Pipeline(iter(test_loader), [(forward, 1), (post_process, 1), (write, self.args.num_writers)],
+                            queue_size=self.args.queue_size)
+        pipeline.run()
+        progress.close()
+
+        print(f'time: {time.time() - t:.3f}s')
+        if self.args.cascade_arch is not None:
+            self.model.report()
+        if self.cache is not None:
+            self.cache.report()
+
+    def test_tiled(self):
+        """
+        Predicts each image at its original resolution (model_tracer.tiling.TiledPredictor): a global pass at the
+        model input size plus overlapping tiles in batches of args.tile_batch_size, blended with weights.
+        """
+        self.model.eval()
+        t = time.time()
+        tiler = TiledPredictor(self.model, self.test_transform, self.input_size, self.device,
+                               self.memory_format, self.args.precision, overlap=self.args.tile_overlap,
+                               batch_size=self.args.tile_batch_size, band=self.args.tile_band)
+        # undecoded images are loaded by the workers at their original size
+        dataset = Test_DatasetGenerate(self.te_img_folder, images=self.uncached_images(), return_path=True)
+        loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=self.args.num_workers)
+
+        for image, original_size, image_path in tqdm(loader):
+            output = tiler.predict_mask(np.asarray(image))
+            if self.args.save_map is not None:
+                rgba_image = salient_object(np.asarray(image), output)
+                self.save_results(image_path, output, cv2.cvtColor(rgba_image, cv2.COLOR_RGBA2BGRA))
+
+        print(f'time: {time.time() - t:.3f}s, tiles: {tiler.counters["tiles"]} '
+              f'(skipped: {tiler.counters["skipped_tiles"]}) for {tiler.counters["images"]} images')
+        if self.args.cascade_arch is not None:
+            self.model.report()
+        if self.cache is not None:
+            self.cache.report()
+
+    def test_video(self):
+        """
+        Predicts the frames of args.video (a video file or a directory of frames) in batches of args.batch_size
+        keyframes (model_tracer.video.VideoPredictor): frames within args.video_tolerance of the last keyframe reuse
+        its mask. Masks are written to args.video_output, a video file or a directory of PNG masks.
+        """
+        self.model.eval()
+        t = time.time()
+        transform = get_letterbox_augmentation(self.input_size) if self.args.letterbox else self.test_transform
+        predictor = VideoPredictor(self.model, transform, self.input_size, self.device, self.memory_format,
+                                   self.args.precision, letterbox=self.args.letterbox, batch_size=self.args.batch_size,
+                                   tolerance=self.args.video_tolerance)
+        frames, fps = read_frames(self.args.video)
+        name = Path(self.args.video.rstrip('/\\')).stem
+        writer = MaskWriter(self.args.video_output or os.path.join('mask', name + '.mp4'), fps)
+
+        try:
+            for frame, mask in tqdm(predictor.predict(frames)):
+                writer.write(mask)
+        finally:
+            writer.close()
+
+        elapsed = time.time() - t
+        print(f'time: {elapsed:.3f}s, {predictor.counters["frames"] / elapsed:.2f} fps (with writing) to {writer.path}')
+        predictor.report()
+        if self.args.cascade_arch is not None:
+            self.model.report()
+
+    def resize_and_post_process(self, image, output, height, width):
+        if self.args.letterbox: # crop the stride padding off before resizing back
+            rows, cols = letterbox_size(height, width, self.input_size)
+            image, output = image[:, :rows, :cols], output[:, :rows, :cols]
+        output = F.interpolate(output.unsqueeze(0), size=(height, width), mode='bilinear')
+        output = (output.squeeze().detach().cpu().numpy() * 255.0).astype(np.uint8)  # convert uint8 type
+
+        salient_object = self.post_processing(image, output, height, width)
+        return output, salient_object
+
+    def save_results(self, image_path, output, salient_object):
+        output, salient_object = encode_png(output), encode_png(salient_object)
+        if self.cache is not None:
+            self.cache.put(self.cache_keys.pop(image_path), output, salient_object)
+        for path in [image_path] + self.duplicates.pop(image_path, []):
+            self.write_results(path, output, salient_object)
+
+    def write_results(self, image_path, output, salient_object):
+        """Writes the PNG encoded mask and salient object of an image as <file stem>.png."""
+        image_name = Path(image_path).stem
+        with open(os.path.join('mask', self.args.dataset, image_name + '.png'), 'wb') as f:
+            f.write(output)
+        with open(os.path.join('object', self.args.dataset, image_name + '.png'), 'wb') as f:
+            f.write(salient_object)
 
     def post_processing(self, original_image, output_image, height, width, threshold=200):
         invTrans = transforms.Compose([ transforms.Normalize(mean = [ 0., 0., 0. ],
@@ -87,3 +293,68 @@ class Inference():
         
         rgba_image[edge_y, edge_x, 3] = 0
         return cv2.cvtColor(rgba_image, cv2.COLOR_RGBA2BGRA)
+
+
+class Pipeline():
+    """
+    Chain of worker stages connected by bounded queues.
+    Each stage is (fn, num_workers), where fn maps one item to an iterable of items for the next stage.
+    Throughput is limited by the slowest stage rather than by the sum of all stages.
+    """
+    _END = object()
+
+    def __init__(self, source, stages, queue_size=4):
+        self.source = source
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages))]
+        self.errors = []
+
+    def run(self):
+        threads = []
+        for idx, (fn, num_workers) in enumerate(self.stages):
+            in_queue = self.queues[idx]
+            out_queue = self.queues[idx + 1] if idx + 1 < len(self.queues) else None
+            remaining = [num_workers]
+            lock = threading.Lock()
+            for _ in range(num_workers):
+                threads.append(threading.Thread(target=self._work, args=(fn, in_queue, out_queue, remaining, lock),
+                                                daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in self.source:
+                if self.errors:
+                    break
+                self.queues[0].put(item)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.queues[0].put(self._END)
+
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def _work(self, fn, in_queue, out_queue, remaining, lock):
+        while True:
+            item = in_queue.get()
+            if item is self._END:
+                break
+            if self.errors:
+                continue  # drain the queue so that upstream stages never block
+            try:
+                for result in fn(item):
+                    if out_queue is not None:
+                        out_queue.put(result)
+            except Exception as e:
+                self.errors.append(e)
+
+        in_queue.put(self._END)  # let sibling workers finish too
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and out_queue is not None:
+            out_queue.put(self._END)
@@ -5,10 +5,17 @@ from PIL import Image
 import cv2
 import numpy as np
 import torch
+import copy
 import torch.nn.functional as F
-from dataloader import get_test_augmentation
+from config import DummyArgs
+from dataloader import get_test_augmentation, get_letterbox_augmentation, letterbox_size, group_by_shape
 from model_tracer.TRACER import TRACER
-from util.utils import load_pretrained
+from model_tracer.exported import load_exported
+from model_tracer.cascade import CascadeTRACER
+from model_tracer.tiling import TiledPredictor, salient_object
+from model_tracer.video import VideoPredictor, read_frames
+from util.utils import load_pretrained, strip_module_prefix, autocast
+from util.result_cache import ResultCache, cache_settings, encode_png, decode_png
 import torch.nn as nn
 import urllib
 from torchvision.transforms import transforms
@@ -40,8 +47,15 @@ class Inference():
     def __init__(self, args):
         super(Inference, self).__init__()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.transform = get_test_augmentation(img_size=args.img_size)
+        self.input_size = args.img_size
+        self.transform = get_test_augmentation(img_size=self.input_size)
         self.args = args
+        self.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+        if args.letterbox and (args.model_file is not None or args.cascade_arch is not None or args.tile):
+            raise ValueError('letterbox inference runs the eager model (exported models have a fixed input size) '
+                             'without cascade_arch or tile')
+        if args.letterbox: # aspect ratio kept, images batched by their padded shape
+            self.transform = get_letterbox_augmentation(img_size=self.input_size)
 
         self.invTrans = transforms.Compose([ transforms.Normalize(mean=[0., 0., 0.],
                                                                  std=[1/0.229, 1/0.224, 1/0.225]),
@@ -50,21 +64,71 @@ class Inference():
                                           ])
 
         # Network
-        self.model = TRACER(args).to(self.device)
-        model_state_dict = load_pretrained(f'TE-{args.arch}', self.device)
-        
-        if 'module.' in list(model_state_dict.keys())[0]:
-            model_state_dict = {k.replace('module.', ''): v for k, v in model_state_dict.items()}
-        self.model.load_state_dict(model_state_dict)
+        if args.model_file is not None: # exported artifact (export.py)
+            self.model = load_exported(args.model_file, self.device, args.num_threads)
+        else:
+            self.model = self.load_model(args)
+        if args.cascade_arch is not None: # small arch first, low-confidence images again with cascade_arch
+            large_args = copy.copy(args)
+            large_args.arch = args.cascade_arch
+            self.model = CascadeTRACER(self.model, self.load_model(large_args), small_size=args.img_size,
+                                       band=args.cascade_band, max_uncertain=args.cascade_max_uncertain)
+            self.input_size = DummyArgs(args.cascade_arch).img_size
+            self.transform = get_test_augmentation(img_size=self.input_size)
         
         self.model.eval()
+        self.tiler = None
+        if args.tile: # full-resolution masks from a global pass and overlapping tiles
+            self.tiler = TiledPredictor(self.model, self.transform, self.input_size, self.device, self.memory_format,
+                                        args.precision, overlap=args.tile_overlap, batch_size=args.tile_batch_size,
+                                        band=args.tile_band)
+        # results of repeated images by their encoded bytes or pixels (args.cache_size, args.cache_dir)
+        self.cache = ResultCache.from_config(args)
+        self.cache_settings = cache_settings(args, self.input_size, object_format='RGBA') if self.cache is not None else None
         print('###### pre-trained Model restored #####')
 
 
-    def test(self, image):
+    def load_model(self, args):
+        model = TRACER(args, pretrained_backbone=False).to(self.device, memory_format=self.memory_format)
+        model_state_dict = load_pretrained(f'TE-{args.arch}', self.device, args.weights_dir)
+        model.load_state_dict(strip_module_prefix(model_state_dict))
+        model.fuse_for_inference() # fold BatchNorm into the convolutions
+        model.set_swish(memory_efficient=False) # native SiLU
+        return model
+
+
+    def read_image(self, image):
+        """
+        Args:
+            image: PIL image, RGB numpy array, encoded image bytes, path in directory or URL.
+        Returns:
+            encoded image bytes of paths and URLs (not decoded), RGB numpy array of PIL images, other inputs as they are.
+        """
+        if isinstance(image, Image.Image):
+            return np.array(image.convert('RGB'))
+
+        elif isinstance(image, str): # if path or URL
+            if "http" in image or "https" in image:
+                return urllib.request.urlopen(image).read()
+            with open(image, 'rb') as f:
+                return f.read()
+
+        return image
+
+
+    def load_image(self, image):
+        """
+        Args:
+            image: PIL image, RGB numpy array, encoded image bytes, path in directory or URL.
+        Returns:
+            RGB image as a numpy array (H, W, 3).
+        """
         if isinstance(image, Image.Image):
-            image = np.array(image)
-            h, w = image.shape[:2]
+            image = np.array(image.convert('RGB'))
+
+        elif isinstance(image, (bytes, bytearray)): # encoded image
+            image = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
         elif isinstance(image, str): # if path or URL
             if "http" in image or "https" in image:
@@ -76,19 +140,96 @@ class Inference():
                 image = cv2.imread(image)
             
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            h, w = image.shape[:2]
 
-        image = self.transform(image=image)['image']
-       
-        with torch.no_grad():
-                image = torch.tensor(image.unsqueeze(0), device=self.device, dtype=torch.float32)
+        return image
 
-                output, edge_mask, ds_map = self.model(image)
-                output = F.interpolate(output, size=(h, w), mode='bilinear')
-                output = (output.squeeze().detach().cpu().numpy() * 255.0).astype(np.uint8)  # convert uint8 type
 
-                salient_object = self.post_processing(image, output, h, w)
-                return output, salient_object
+    def test(self, image):
+        outputs, salient_objects = self.test_batch([image])
+        return outputs[0], salient_objects[0]
+
+
+    def test_batch(self, images, batch_size=None):
+        """
+        Args:
+            images: list of PIL images, RGB numpy arrays, encoded image bytes, paths or URLs.
+            batch_size: maximum number of images per forward pass (default: all images at once;
+                        in letterbox mode, all images of the same padded shape).
+        Returns:
+            masks: list of predicted masks (H, W) at the original image sizes.
+            salient_objects: list of RGBA salient objects (H, W, 4) at the original image sizes.
+        """
+        if self.cache is None:
+            return self.predict_batch([self.load_image(image) for image in images], batch_size)
+
+        # encoded images are keyed by their bytes and only decoded on a cache miss, repeated images are predicted once
+        images = [self.read_image(image) for image in images]
+        keys = [self.cache.key(image, *self.cache_settings) for image in images]
+        outputs, salient_objects, misses = [None] * len(images), [None] * len(images), {}
+        for idx, key in enumerate(keys):
+            cached = None if key in misses else self.cache.get(key)
+            if cached is None:
+                misses.setdefault(key, []).append(idx)
+            else:
+                outputs[idx], salient_objects[idx] = decode_png(cached[0]), decode_png(cached[1])
+
+        masks, objects = self.predict_batch([self.load_image(images[idx[0]]) for idx in misses.values()], batch_size)
+        for (key, indices), mask, rgba_image in zip(misses.items(), masks, objects):
+            self.cache.put(key, encode_png(mask), encode_png(rgba_image))
+            for idx in indices:
+                outputs[idx], salient_objects[idx] = mask, rgba_image
+        return outputs, salient_objects
+
+
+    def predict_batch(self, images, batch_size=None):
+        """test_batch of decoded RGB images (H, W, 3), without the result cache."""
+        if self.tiler is not None: # one image at a time, tiles in batches of args.tile_batch_size
+            outputs = [self.tiler.predict_mask(image) for image in images]
+            return outputs, [salient_object(image, output) for image, output in zip(images, outputs)]
+        batch_size = batch_size or max(len(images), 1)
+        if self.args.letterbox:
+            batches = group_by_shape([image.shape[:2] for image in images], self.input_size, batch_size)
+        else:
+            batches = [range(start, min(start + batch_size, len(images))) for start in range(0, len(images), batch_size)]
+
+        outputs, salient_objects = [None] * len(images), [None] * len(images)
+        for batch in batches:
+            inputs = torch.stack([self.transform(image=images[idx])['image'] for idx in batch])
+
+            with torch.no_grad():
+                inputs = inputs.to(self.device, dtype=torch.float32, memory_format=self.memory_format)
+                with autocast(self.device, self.args.precision):
+                    output_maps = self.model(inputs, return_aux=False).float()
+
+                for i, idx in enumerate(batch):
+                    h, w = images[idx].shape[:2]
+                    image, output = inputs[i], output_maps[i]
+                    if self.args.letterbox: # crop the stride padding off before resizing back
+                        rows, cols = letterbox_size(h, w, self.input_size)
+                        image, output = image[:, :rows, :cols], output[:, :rows, :cols]
+                    output = F.interpolate(output.unsqueeze(0), size=(h, w), mode='bilinear')
+                    output = (output.squeeze().detach().cpu().numpy() * 255.0).astype(np.uint8)  # convert uint8 type
+
+                    outputs[idx] = output
+                    salient_objects[idx] = self.post_processing(image.unsqueeze(0), output, h, w)
+
+        return outputs, salient_objects
+
+
+    def test_video(self, source, batch_size=4):
+        """
+        Args:
+            source: video file or directory of frames.
+            batch_size: keyframes per forward pass.
+        Yields:
+            (RGB frame, predicted mask) of each frame in order. Frames within args.video_tolerance of the last keyframe
+            reuse its mask; the counters are in self.video_predictor (report()).
+        """
+        self.video_predictor = VideoPredictor(self.model, self.transform, self.input_size, self.device,
+                                              self.memory_format, self.args.precision, letterbox=self.args.letterbox,
+                                              batch_size=batch_size, tolerance=self.args.video_tolerance)
+        frames, _ = read_frames(source)
+        yield from self.video_predictor.predict(frames)
 
     
     def post_processing(self, original_image, output_image, height, width, threshold=200):
@@ -2,9 +2,17 @@
 author: Min Seok Lee and Wooseok Shin
 """
 
+import os
 import re
 import math
+import copy
+import time
+import hashlib
+import zipfile
+import threading
 import collections
+import contextlib
+from urllib.parse import urlparse
 from functools import partial
 from torch.utils import model_zoo
 from torch import nn
@@ -12,8 +20,9 @@ from PIL import Image
 import cv2
 import numpy as np
 import torch
-from torch.fft import fft2, fftshift, ifft2, ifftshift
+from torch.fft import fft2, ifft2, ifftshift, rfft2, irfft2
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 # from dataloader import get_test_augmentation
 # from model_tracer.TRACER import TRACER
 # from util.utils import load_pretrained
@@ -38,11 +47,44 @@ def get_test_augmentation(img_size):
     ])
     return transforms
 
+def get_letterbox_augmentation(img_size, stride=32):
+    # the long side is resized to img_size and the normalized image is zero padded at the bottom and right
+    # to a multiple of the network stride: the image is the top-left letterbox_size region of the input
+    transforms = albu.Compose([
+        albu.LongestMaxSize(img_size, always_apply=True),
+        albu.Normalize([0.485, 0.456, 0.406],
+                       [0.229, 0.224, 0.225]),
+        albu.PadIfNeeded(min_height=None, min_width=None, pad_height_divisor=stride, pad_width_divisor=stride,
+                         position='top_left', border_mode=cv2.BORDER_CONSTANT, value=0),
+        ToTensorV2(),
+    ])
+    return transforms
+
+def letterbox_size(height, width, img_size):
+    """(height, width) of an image resized by albu.LongestMaxSize(img_size), i.e. without the stride padding."""
+    scale = img_size / max(height, width)
+    return round(height * scale), round(width * scale)
+
+def padded_size(height, width, img_size, stride=32):
+    """Input shape (height, width) of an image in letterbox mode: letterbox_size rounded up to the stride."""
+    return tuple(math.ceil(dim / stride) * stride for dim in letterbox_size(height, width, img_size))
+
+def group_by_shape(sizes, img_size, batch_size, stride=32):
+    """Batches (lists of at most batch_size indices) of image sizes [(height, width)] with the same padded_size."""
+    groups = {}
+    for idx, (height, width) in enumerate(sizes):
+        groups.setdefault(padded_size(height, width, img_size, stride), []).append(idx)
+    return [group[start:start + batch_size] for group in groups.values() for start in range(0, len(group), batch_size)]
+
 class TRACER(nn.Module):
-    def __init__(self, cfg):
+    def __init__(self, cfg, pretrained_backbone=True):
         super().__init__()
-        self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True)
-        self.block_idx, self.channels = get_model_shape()
+        if pretrained_backbone:
+            self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True,
+                                                      weights_dir=cfg.weights_dir, cfg=cfg)
+        else: # a full TRACER checkpoint is loaded afterwards anyway
+            self.model = EfficientNet.from_name(f'efficientnet-b{cfg.arch}', cfg=cfg)
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
 
         # Receptive Field Blocks
         channels = [int(arg_c) for arg_c in cfg.RFB_aggregated_channel]
@@ -51,39 +93,73 @@ class TRACER(nn.Module):
         self.rfb4 = RFB_Block(self.channels[3], channels[2])
 
         # Multi-level aggregation
-        self.agg = aggregation(channels)
+        self.agg = aggregation(channels, gamma=cfg.gamma)
 
         # Object Attention
-        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3)
-        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3)
+        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3, denoise=cfg.denoise)
+        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3, denoise=cfg.denoise)
+        self.low_res_average = cfg.low_res_average
 
-    def forward(self, inputs):
+    def forward(self, inputs, return_aux=True):
+        """
+        Args:
+            inputs: (B, 3, H, W)
+            return_aux: also return the edge map and the deep supervision maps (training and validation).
+                        When False, only the final saliency map (B, 1, H, W) is computed and returned
+                        (averaged at 1/4 resolution with cfg.low_res_average).
+        """
         B, C, H, W = inputs.size()
 
-        # EfficientNet backbone Encoder
-        x = self.model.initial_conv(inputs)
-        features, edge = self.model.get_blocks(x, H, W)
+        # EfficientNet backbone Encoder (the stem output is not kept alive through the blocks)
+        features, edge = self.model.get_blocks(self.model.initial_conv(inputs), H, W, return_aux)
 
         x3_rfb = self.rfb2(features[1])
         x4_rfb = self.rfb3(features[2])
         x5_rfb = self.rfb4(features[3])
 
         D_0 = self.agg(x5_rfb, x4_rfb, x3_rfb)
-
-        ds_map0 = F.interpolate(D_0, scale_factor=8, mode='bilinear')
-
         D_1 = self.ObjectAttention2(D_0, features[1])
-        ds_map1 = F.interpolate(D_1, scale_factor=8, mode='bilinear')
-
         ds_map = F.interpolate(D_1, scale_factor=2, mode='bilinear')
         D_2 = self.ObjectAttention1(ds_map, features[0])
-        ds_map2 = F.interpolate(D_2, scale_factor=4, mode='bilinear')
 
+        if not return_aux:
+            if self.low_res_average:  # average at 1/4 resolution and upsample once (approximation)
+                low_res_map = (F.interpolate(D_0, scale_factor=2, mode='bilinear') + ds_map + D_2) / 3
+                return torch.sigmoid(F.interpolate(low_res_map, scale_factor=4, mode='bilinear'))
+            # bilinear upsampling is linear, so D_0 and D_1 (both at 1/8 resolution) are upsampled together
+            final_map = (F.interpolate(D_2, scale_factor=4, mode='bilinear')
+                         + F.interpolate(D_0 + D_1, scale_factor=8, mode='bilinear')) / 3
+            return torch.sigmoid(final_map)
+
+        ds_map0 = F.interpolate(D_0, scale_factor=8, mode='bilinear')
+        ds_map1 = F.interpolate(D_1, scale_factor=8, mode='bilinear')
+        ds_map2 = F.interpolate(D_2, scale_factor=4, mode='bilinear')
         final_map = (ds_map2 + ds_map1 + ds_map0) / 3
 
         return torch.sigmoid(final_map), torch.sigmoid(edge), \
                (torch.sigmoid(ds_map0), torch.sigmoid(ds_map1), torch.sigmoid(ds_map2))
 
+    def fuse_for_inference(self, branches=True):
+        """Folds every BatchNorm that follows a convolution (backbone stem and MBConvBlocks, BasicConv2d, DWConv,
+        DWSConv) into the convolution weights and bias, in place. With branches, the parallel 1x1 convolutions at the
+        input of each RFB block are then merged into one (RFB_Block.fuse_branches).
+        The model is put in eval mode and can no longer be trained. Returns self."""
+        self.eval()
+        for module in list(self.modules()):
+            if hasattr(module, 'fuse_bn'):
+                module.fuse_bn()
+        if branches:
+            for module in list(self.modules()):
+                if hasattr(module, 'fuse_branches'):
+                    module.fuse_branches()
+        return self
+
+    def set_swish(self, memory_efficient=True):
+        """Sets the backbone swish as memory efficient (custom autograd Function, training only) or native SiLU,
+        which is faster in inference and can be traced. Returns self."""
+        self.model.set_swish(memory_efficient)
+        return self
+
 
 class DummyArgs():
     def __init__(self, arch = 7):
@@ -95,13 +171,471 @@ class DummyArgs():
         self.denoise = 0.93
         self.gamma = 0.1
         self.multi_gpu = False
+        self.weights_dir = None # offline weight store directory (falls back to $TRACER_WEIGHTS_DIR)
         self.img_size = d[int(arch)] # image_size is based on architecture
+        self.model_file = None # exported TorchScript (.pt) or ONNX (.onnx) artifact (export.py) used instead of the eager model
+        self.num_threads = None # intra-op threads of the onnxruntime backend (default: onnxruntime's choice)
+        self.channels_last = False # run the eager model and its inputs in NHWC (faster depthwise/1x1 convs on CPU)
+        self.precision = 'fp32' # inference precision: 'fp32' or 'bf16' (bfloat16 autocast, FFT/quantile/softmax in fp32)
+        self.low_res_average = False # average the decoder maps at 1/4 resolution and upsample once in inference
+        self.cascade_arch = None # large arch re-running the low-confidence images of arch in inference (None: off)
+        self.cascade_band = 0.15 # half width of the uncertain band around the post-processing threshold
+        self.cascade_max_uncertain = 0.05 # images with a larger fraction of uncertain pixels are escalated
+        self.tile = False # full-resolution inference: global pass plus overlapping img_size tiles of the original image
+        self.tile_overlap = 0.25 # minimum overlap fraction of neighbouring tiles
+        self.tile_batch_size = 4 # tiles per forward pass (bounds the memory of the forward passes)
+        self.tile_band = 0.15 # only tiles with global map pixels within this band of the threshold (None: all tiles)
+        self.letterbox = False # keep the aspect ratio in inference: long side to img_size, padded to the stride, batched by shape
+        self.cache_size = 0 # MiB of the in-memory tier of the result cache of repeated images (0: no in-memory tier)
+        self.cache_dir = None # directory of the on-disk tier of the result cache (None: no on-disk tier)
+        self.cache_disk_size = 1024 # MiB bound of the on-disk tier, least recently used results deleted first (0: unbounded)
+
+
+QUANTIZED_ENGINE_FILE = 'quantized_engine'  # extra file of int8 TorchScript artifacts (quantize.py)
+
+
+class ScriptedTRACER(nn.Module):
+    """Runs a frozen TorchScript artifact as a drop-in for TRACER(inputs, return_aux=False)."""
+    def __init__(self, path, device):
+        super().__init__()
+        engine = read_extra_file(path, QUANTIZED_ENGINE_FILE)
+        previous_engine = torch.backends.quantized.engine
+        if engine is not None:
+            # int8 weights are packed for the quantized engine when the artifact is loaded and keep it afterwards,
+            # so the process-wide engine is only switched while loading
+            torch.backends.quantized.engine = engine
+        try:
+            self.model = torch.jit.load(path, map_location=device)
+        finally:
+            torch.backends.quantized.engine = previous_engine
+        if device.type == 'cpu' and engine is None:
+            # oneDNN weight layouts; applied after loading because they are not serializable
+            self.model = torch.jit.optimize_for_inference(self.model)
+
+    def forward(self, inputs, return_aux=False):
+        if return_aux:
+            raise ValueError('exported TRACER models only return the final saliency map')
+        return self.model(inputs)
+
+
+class OnnxTRACER(nn.Module):
+    """Runs an ONNX artifact with onnxruntime's CPU provider as a drop-in for TRACER(inputs, return_aux=False)."""
+    def __init__(self, path, num_threads=None):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, inputs, return_aux=False):
+        if return_aux:
+            raise ValueError('exported TRACER models only return the final saliency map')
+        outputs = self.session.run(None, {self.input_name: inputs.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(outputs).to(inputs.device)
+
+
+def read_extra_file(path, name):
+    """Reads an extra file of a TorchScript archive without deserializing the model, or returns None."""
+    with zipfile.ZipFile(path) as archive:
+        for entry in archive.namelist():
+            if entry.endswith(f'/extra/{name}'):
+                return archive.read(entry).decode()
+    return None
+
 
+POST_PROCESSING_THRESHOLD = 200 / 255  # alpha cut of Inference.post_processing
+
+
+def uncertain_fraction(maps, threshold=POST_PROCESSING_THRESHOLD, band=0.15):
+    """Per-image fraction of the pixels of saliency maps (B, 1, H, W) within band of threshold."""
+    return ((maps.float() - threshold).abs() < band).flatten(1).float().mean(1)
+
+
+class CascadeTRACER(nn.Module):
+    """
+    Runs small on every image and large on the images whose uncertain fraction exceeds max_uncertain, as a drop-in
+    for TRACER(inputs, return_aux=False). Inputs come at the input size of large; the small model runs on them
+    resized to small_size (None: as they are). Counts images, escalations and the time of each stage (see report).
+    """
+    def __init__(self, small, large, small_size=None, band=0.15, max_uncertain=0.05,
+                 threshold=POST_PROCESSING_THRESHOLD):
+        super().__init__()
+        self.small = small
+        self.large = large
+        self.small_size = small_size
+        self.band = band
+        self.max_uncertain = max_uncertain
+        self.threshold = threshold
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {'images': 0, 'escalated': 0, 'small_time': 0.0, 'large_time': 0.0}
+
+    def forward(self, inputs, return_aux=False):
+        if return_aux:
+            raise ValueError('cascade TRACER models only return the final saliency map')
+        H, W = inputs.shape[-2:]
+
+        t = self._clock(inputs)
+        small_inputs = inputs
+        if self.small_size is not None and (H, W) != (self.small_size, self.small_size):
+            small_inputs = F.interpolate(inputs, size=(self.small_size, self.small_size), mode='bilinear',
+                                         antialias=True)
+        outputs = self.small(small_inputs, return_aux=False)
+        if outputs.shape[-2:] != (H, W):
+            outputs = F.interpolate(outputs, size=(H, W), mode='bilinear')
+        escalate = uncertain_fraction(outputs, self.threshold, self.band) > self.max_uncertain
+        self.counters['small_time'] += self._clock(inputs) - t
+
+        if escalate.any():
+            t = self._clock(inputs)
+            outputs[escalate] = self.large(inputs[escalate], return_aux=False).to(outputs.dtype)
+            self.counters['large_time'] += self._clock(inputs) - t
+
+        self.counters['images'] += inputs.size(0)
+        self.counters['escalated'] += int(escalate.sum())
+        return outputs
+
+    @staticmethod
+    def _clock(inputs):
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def report(self):
+        """Prints the per-stage counters and the throughput against running the large model on every image
+        (estimated from the per-image time of the large stage)."""
+        images, escalated = self.counters['images'], self.counters['escalated']
+        small_time, large_time = self.counters['small_time'], self.counters['large_time']
+        if images == 0:
+            print('cascade: no images')
+            return
+        total = small_time + large_time
+        print(f'{"stage":>8} {"images":>7} {"share":>7} {"time(s)":>8} {"ms/image":>9}')
+        print(f'{"small":>8} {images:>7} {1:>7.1%} {small_time:>8.2f} {small_time / images * 1000:>9.2f}')
+        large_per_image = large_time / escalated if escalated else float('nan')
+        print(f'{"large":>8} {escalated:>7} {escalated / images:>7.1%} {large_time:>8.2f} '
+              f'{large_per_image * 1000:>9.2f}')
+        print(f'{"cascade":>8} {images:>7} {"":>7} {total:>8.2f} {total / images * 1000:>9.2f}')
+        if escalated:
+            large_only = large_per_image * images
+            print(f'throughput: {images / total:.2f} images/s, large model only (estimated): '
+                  f'{images / large_only:.2f} images/s, cascade speedup: {large_only / total:.2f}x')
+
+
+def tile_starts(length, size, overlap):
+    """Start offsets of tiles of size covering [0, length) with at least the overlap fraction between neighbours."""
+    stride = max(int(size * (1 - overlap)), 1)
+    starts = list(range(0, length - size + 1, stride))
+    if starts[-1] != length - size:
+        starts.append(length - size)
+    return starts
+
+
+def blend_ramp(start, size, length, ramp):
+    """1-D blending weights of a tile: linear ramps of ramp pixels on the sides that are not on the image border."""
+    weight = torch.ones(size)
+    ramp = min(ramp, size // 2)
+    if ramp > 0:
+        up = torch.arange(1, ramp + 1, dtype=torch.float32) / (ramp + 1)
+        if start > 0:
+            weight[:ramp] = up
+        if start + size < length:
+            weight[-ramp:] = up.flip(0)
+    return weight
+
+
+def salient_object(image, mask, threshold=200):
+    """RGBA salient object (H, W, 4) of an RGB image: transparent where the uint8 mask is <= threshold."""
+    rgba = np.concatenate([image, np.full(image.shape[:2] + (1,), 255, dtype=np.uint8)], axis=2)
+    rgba[mask <= threshold, 3] = 0
+    return rgba
+
+
+class TiledPredictor():
+    """
+    Saliency maps at the original resolution of RGB images (H, W, 3), from any TRACER(inputs, return_aux=False).
+
+    Args:
+        transform: test transform of the model (dataloader.get_test_augmentation(img_size)).
+        img_size: input size of the model, used for the global pass and as the tile size.
+        overlap: minimum overlap fraction of neighbouring tiles.
+        batch_size: tiles per forward pass.
+        band: only tiles where the global map has pixels within band of the post-processing threshold are predicted
+              (None: every tile).
+        global_weight: blending weight of the global map against the weight 1 of a tile centre.
+    """
+    def __init__(self, model, transform, img_size, device, memory_format=torch.contiguous_format, precision='fp32',
+                 overlap=0.25, batch_size=4, band=0.15, global_weight=0.25):
+        self.model = model
+        self.img_size = img_size
+        self.device = device
+        self.memory_format = memory_format
+        self.precision = precision
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.band = band
+        self.global_weight = global_weight
+        self.transform = transform
+        self.counters = {'images': 0, 'tiles': 0, 'skipped_tiles': 0}
+
+    def forward(self, crops):
+        """Saliency maps (h, w) on the CPU of RGB crops, each resized to img_size for the model and back."""
+        inputs = torch.stack([self.transform(image=crop)['image'] for crop in crops])
+        with torch.no_grad():
+            inputs = inputs.to(self.device, dtype=torch.float32, memory_format=self.memory_format)
+            with autocast(self.device, self.precision):
+                outputs = self.model(inputs, return_aux=False).float()
+            return [F.interpolate(outputs[i].unsqueeze(0), size=crop.shape[:2], mode='bilinear')[0, 0].cpu()
+                    for i, crop in enumerate(crops)]
+
+    def boxes(self, height, width, global_map):
+        """(top, left, tile height, tile width) of the tiles to predict."""
+        tile_h, tile_w = min(self.img_size, height), min(self.img_size, width)
+        boxes = [(top, left, tile_h, tile_w) for top in tile_starts(height, tile_h, self.overlap)
+                 for left in tile_starts(width, tile_w, self.overlap)]
+        if self.band is None:
+            return boxes
+        uncertain = (global_map - POST_PROCESSING_THRESHOLD).abs() < self.band
+        selected = [box for box in boxes if uncertain[box[0]:box[0] + box[2], box[1]:box[1] + box[3]].any()]
+        self.counters['skipped_tiles'] += len(boxes) - len(selected)
+        return selected
+
+    def predict(self, image):
+        """Saliency map (H, W) in [0, 1] of an RGB image (H, W, 3)."""
+        height, width = image.shape[:2]
+        global_map = self.forward([image])[0]
+        self.counters['images'] += 1
+        if height <= self.img_size and width <= self.img_size:  # the global pass is already at full resolution
+            return global_map
+
+        blended = global_map * self.global_weight
+        weights = torch.full_like(global_map, self.global_weight)
+        ramp = int(self.img_size * self.overlap)
+        boxes = self.boxes(height, width, global_map)
+        for start in range(0, len(boxes), self.batch_size):
+            batch = boxes[start:start + self.batch_size]
+            maps = self.forward([image[top:top + h, left:left + w] for top, left, h, w in batch])
+            for (top, left, h, w), tile_map in zip(batch, maps):
+                weight = torch.outer(blend_ramp(top, h, height, ramp), blend_ramp(left, w, width, ramp))
+                blended[top:top + h, left:left + w] += weight * tile_map
+                weights[top:top + h, left:left + w] += weight
+        self.counters['tiles'] += len(boxes)
+        return blended / weights
+
+    def predict_mask(self, image):
+        """uint8 mask (H, W) of an RGB image (H, W, 3)."""
+        return (self.predict(image).numpy() * 255.0).astype(np.uint8)
+
+# options of DummyArgs that change the mask of an image
+CACHE_OPTIONS = ('arch', 'model_file', 'precision', 'low_res_average', 'cascade_arch', 'cascade_band',
+                 'cascade_max_uncertain', 'tile', 'tile_overlap', 'tile_band', 'letterbox')
+
+
+def weights_fingerprint(args):
+    """
+    Identity of the weights behind the results: SHA-256 of the model_file artifact, or of the TE-x checkpoints (arch
+    and cascade_arch) in the weight store (weights_dir or $TRACER_WEIGHTS_DIR). Without a weight store, the release
+    URLs of the checkpoints, which model_zoo downloads once.
+    """
+    if args.model_file is not None:
+        return sha256sum(args.model_file)
+    store = WeightStore.from_config(args.weights_dir)
+    urls = [url_TRACER[f'TE-{arch}'] for arch in [args.arch, args.cascade_arch] if arch is not None]
+    return tuple(url if store is None else store.checksum(url) for url in urls)
+
+
+def cache_settings(args, img_size, threshold=200, object_format='BGRA'):
+    """
+    Settings of a cache key.
+    Args:
+        img_size: model input size (the large arch input size of a cascade).
+        threshold: alpha cut of the salient object (post_processing).
+        object_format: channel order of the cached salient objects ('BGRA': inference.py, 'RGBA': the helpers).
+    """
+    return (img_size, threshold, object_format, weights_fingerprint(args)) + \
+        tuple(getattr(args, option) for option in CACHE_OPTIONS)
+
+
+def encode_png(image):
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def decode_png(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+class ResultCache():
+    """
+    Two-tier cache of (mask PNG, salient object PNG or None) by key, safe to share between threads.
+
+    Args:
+        max_bytes: size bound of the in-memory tier (0: no in-memory tier).
+        cache_dir: directory of the on-disk tier (None: no on-disk tier).
+        max_disk_bytes: size bound of the on-disk tier (None: unbounded). The size is tracked by each process from
+                        its own writes and the directory is scanned again when the bound is exceeded.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20, cache_dir=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.disk_size = None  # scanned on the first write
+        self.lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+
+    @classmethod
+    def from_config(cls, args):
+        """
+        Returns the cache of args.cache_size (MiB), args.cache_dir and args.cache_disk_size (MiB, 0: unbounded), or
+        None when both tiers are off.
+        """
+        if not args.cache_size and args.cache_dir is None:
+            return None
+        max_disk_bytes = int(args.cache_disk_size * 2 ** 20) if args.cache_disk_size else None
+        return cls(int(args.cache_size * 2 ** 20), args.cache_dir, max_disk_bytes)
+
+    @staticmethod
+    def key(image, *settings):
+        """Key of encoded image bytes or of a decoded image array, under settings (cache_settings)."""
+        digest = hashlib.sha256()
+        if isinstance(image, np.ndarray):
+            digest.update(f'{image.shape}{image.dtype.str}'.encode())
+            image = np.ascontiguousarray(image)
+        digest.update(memoryview(image).cast('B'))
+        digest.update(repr(settings).encode())
+        return digest.hexdigest()
+
+    def get(self, key, need_object=True):
+        """
+        Returns the cached (mask PNG, salient object PNG) of key, or None on a miss (also when need_object and only
+        the mask was cached). Disk hits are moved into the in-memory tier.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is not None or not need_object):
+                self.entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return entry
+
+        entry = self._read(key, need_object)
+        with self.lock:
+            self.counters['disk_hits' if entry is not None else 'misses'] += 1
+        if entry is not None:
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key, mask, salient_object=None):
+        """Caches the PNG encoded mask (and salient object) of key in both tiers."""
+        entry = (mask, salient_object)
+        self._insert(key, entry)
+        if self.cache_dir is not None:
+            os.makedirs(os.path.join(self.cache_dir, key[:2]), exist_ok=True)
+            for suffix, data in zip(('mask', 'object'), entry):
+                if data is not None:
+                    path = self._path(key, suffix)
+                    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)  # readers never see a partial file
+            if self.max_disk_bytes is not None:
+                self._evict_disk(sum(len(data) for data in entry if data is not None))
+
+    def _insert(self, key, entry):
+        size = sum(len(data) for data in entry if data is not None)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= sum(len(data) for data in old if data is not None)
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= sum(len(data) for data in evicted if data is not None)
+                self.counters['evictions'] += 1
+
+    def _evict_disk(self, written):
+        """Deletes the least recently used results of the on-disk tier down to 90% of max_disk_bytes, so that the
+        directory is not scanned on every write once the bound is reached."""
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for _, size, _ in self._disk_files())
+            else:
+                self.disk_size += written
+            if self.disk_size <= self.max_disk_bytes:
+                return
+
+            results = {}  # key -> (last use, size, paths)
+            for mtime, size, path in self._disk_files():
+                key = os.path.basename(path).split('.')[0]
+                last_use, total, paths = results.get(key, (0, 0, []))
+                results[key] = (max(last_use, mtime), total + size, paths + [path])
+            self.disk_size = sum(total for _, total, _ in results.values())
+            for last_use, total, paths in sorted(results.values(), key=lambda result: result[0]):
+                if self.disk_size <= 0.9 * self.max_disk_bytes:
+                    break
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:  # evicted by another process
+                        pass
+                self.disk_size -= total
+                self.counters['disk_evictions'] += 1
+
+    def _disk_files(self):
+        """(modification time, size, path) of the PNG files of the on-disk tier."""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.png'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:  # evicted by another process
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{suffix}.png')
+
+    def _read(self, key, need_object):
+        if self.cache_dir is None or not os.path.exists(self._path(key, 'mask')):
+            return None
+        object_path = self._path(key, 'object')
+        if need_object and not os.path.exists(object_path):
+            return None
+        try:
+            with open(self._path(key, 'mask'), 'rb') as f:
+                mask = f.read()
+            salient_object = None
+            if os.path.exists(object_path):
+                with open(object_path, 'rb') as f:
+                    salient_object = f.read()
+            if self.max_disk_bytes is not None:  # last use of the LRU eviction
+                for path in (self._path(key, 'mask'), object_path):
+                    if os.path.exists(path):
+                        os.utime(path)
+        except FileNotFoundError:  # evicted meanwhile
+            return None
+        return mask, salient_object
+
+    def report(self):
+        hits = self.counters['memory_hits'] + self.counters['disk_hits']
+        lookups = hits + self.counters['misses']
+        print(f'cache: {hits}/{lookups} hits ({hits / max(lookups, 1):.1%}; memory: {self.counters["memory_hits"]}, '
+              f'disk: {self.counters["disk_hits"]}), misses: {self.counters["misses"]}, '
+              f'evictions: {self.counters["evictions"]}, in memory: {len(self.entries)} results '
+              f'({self.size / 2 ** 20:.1f} MiB), disk evictions: {self.counters["disk_evictions"]}')
 
-def getConfig():
-    return DummyArgs()
 
-cfg = getConfig()
 
 
 
@@ -214,24 +748,32 @@ class MBConvBlock(nn.Module):
         return x
 
     def set_swish(self, memory_efficient=True):
-        """Sets swish function as memory efficient (for training) or standard (for export).
+        """Sets swish function as memory efficient (custom autograd Function) or native SiLU (inference and export).
 
         Args:
             memory_efficient (bool): Whether to use memory-efficient version of swish.
         """
         self._swish = MemoryEfficientSwish() if memory_efficient else Swish()
 
+    def fuse_bn(self):
+        """Folds the eval-mode batch norms into the expansion, depthwise and pointwise convolutions."""
+        if self._block_args.expand_ratio != 1:
+            self._expand_conv, self._bn0 = fuse_conv_bn(self._expand_conv, self._bn0)
+        self._depthwise_conv, self._bn1 = fuse_conv_bn(self._depthwise_conv, self._bn1)
+        self._project_conv, self._bn2 = fuse_conv_bn(self._project_conv, self._bn2)
+
 
 class EfficientNet(nn.Module):
-    def __init__(self, blocks_args=None, global_params=None):
+    def __init__(self, blocks_args=None, global_params=None, cfg=None):
         super().__init__()
         assert isinstance(blocks_args, list), 'blocks_args should be a list'
         assert len(blocks_args) > 0, 'block args must be greater than 0'
+        assert cfg is not None, 'cfg (arch, frequency_radius, gamma) must be given'
         self._global_params = global_params
         self._blocks_args = blocks_args
-        self.block_idx, self.channels = get_model_shape()
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
         self.Frequency_Edge_Module1 = Frequency_Edge_Module(radius=cfg.frequency_radius,
-                                                            channel=self.channels[0])
+                                                            channel=self.channels[0], gamma=cfg.gamma)
         # Batch norm parameters
         bn_mom = 1 - self._global_params.batch_norm_momentum
         bn_eps = self._global_params.batch_norm_epsilon
@@ -270,7 +812,7 @@ class EfficientNet(nn.Module):
         self._swish = MemoryEfficientSwish()
 
     def set_swish(self, memory_efficient=True):
-        """Sets swish function as memory efficient (for training) or standard (for export).
+        """Sets swish function as memory efficient (custom autograd Function) or native SiLU (inference and export).
 
         Args:
             memory_efficient (bool): Whether to use memory-efficient version of swish.
@@ -280,29 +822,9 @@ class EfficientNet(nn.Module):
         for block in self._blocks:
             block.set_swish(memory_efficient)
 
-    def extract_endpoints(self, inputs):
-        endpoints = dict()
-
-        # Stem
-        x = self._swish(self._bn0(self._conv_stem(inputs)))
-        prev_x = x
-
-        # Blocks
-        for idx, block in enumerate(self._blocks):
-            drop_connect_rate = self._global_params.drop_connect_rate
-            if drop_connect_rate:
-                drop_connect_rate *= float(idx) / len(self._blocks)  # scale drop connect_rate
-            x = block(x, drop_connect_rate=drop_connect_rate)
-            if prev_x.size(2) > x.size(2):
-                endpoints['reduction_{}'.format(len(endpoints) + 1)] = prev_x
-            prev_x = x
-
-        # Head
-        x = self._swish(self._bn1(self._conv_head(x)))
-        endpoints['reduction_{}'.format(len(endpoints) + 1)] = x
-
-        return endpoints
-
+    def fuse_bn(self):
+        """Folds the eval-mode batch norm of the stem into its convolution (the blocks fuse their own)."""
+        self._conv_stem, self._bn0 = fuse_conv_bn(self._conv_stem, self._bn0)
 
     def initial_conv(self, inputs):
         # Stem
@@ -311,7 +833,12 @@ class EfficientNet(nn.Module):
         return x
 
 
-    def get_blocks(self, x, H, W):
+    def get_blocks(self, x, H, W, return_edge=True):
+        """
+        Returns the four TRACER feature maps and the edge map upsampled to (H, W).
+        With return_edge=False (inference) the edge map is not upsampled. The feature maps are not copied: no later
+        operation modifies them in place.
+        """
         # Blocks
         for idx, block in enumerate(self._blocks):
             drop_connect_rate = self._global_params.drop_connect_rate
@@ -322,25 +849,29 @@ class EfficientNet(nn.Module):
 
             if idx == self.block_idx[0]:
                 x, edge = self.Frequency_Edge_Module1(x)
-                edge = F.interpolate(edge, size=(H, W), mode='bilinear')
-                x1 = x.clone()
+                if return_edge:
+                    edge = F.interpolate(edge, size=(H, W), mode='bilinear')
+                x1 = x
             if idx == self.block_idx[1]:
-                x2 = x.clone()
+                x2 = x
             if idx == self.block_idx[2]:
-                x3 = x.clone()
+                x3 = x
             if idx == self.block_idx[3]:
-                x4 = x.clone()
+                x4 = x
 
         return (x1, x2, x3, x4), edge
 
 
     @classmethod
-    def from_name(cls, model_name, in_channels=3, **override_params):
+    def from_name(cls, model_name, in_channels=3, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
             model_name (str): Name for efficientnet.
             in_channels (int): Input data's channel number.
+            cfg (None or DummyArgs):
+                TRACER configuration (arch, frequency_radius, gamma).
+                None: the default configuration of the model's scale.
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -355,13 +886,13 @@ class EfficientNet(nn.Module):
         """
         cls._check_model_name_is_valid(model_name)
         blocks_args, global_params = get_model_params(model_name, override_params)
-        model = cls(blocks_args, global_params)
+        model = cls(blocks_args, global_params, cfg if cfg is not None else DummyArgs(model_name[-1]))
         model._change_in_channels(in_channels)
         return model
 
     @classmethod
     def from_pretrained(cls, model_name, weights_path=None, advprop=False,
-                        in_channels=3, num_classes=1000, **override_params):
+                        in_channels=3, num_classes=1000, weights_dir=None, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
@@ -376,6 +907,9 @@ class EfficientNet(nn.Module):
             num_classes (int):
                 Number of categories for classification.
                 It controls the output size for final linear layer.
+            weights_dir (None or str):
+                Local weight store directory (falls back to $TRACER_WEIGHTS_DIR), see load_pretrained_weights.
+            cfg (None or DummyArgs): TRACER configuration, see from_name.
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -388,8 +922,9 @@ class EfficientNet(nn.Module):
         Returns:
             A pretrained TRACER-EfficientNet model.
         """
-        model = cls.from_name(model_name, num_classes=num_classes, **override_params)
-        load_pretrained_weights(model, model_name, weights_path=weights_path, advprop=advprop)
+        model = cls.from_name(model_name, num_classes=num_classes, cfg=cfg, **override_params)
+        load_pretrained_weights(model, model_name, weights_path=weights_path, advprop=advprop,
+                                weights_dir=weights_dir)
         model._change_in_channels(in_channels)
         return model
 
@@ -433,29 +968,30 @@ class EfficientNet(nn.Module):
 
 
 
-def get_model_shape():
-    if cfg.arch == '0':
+def get_model_shape(arch):
+    arch = str(arch)
+    if arch == '0':
         block_idx = [2, 4, 10, 15]
         channels = [24, 40, 112, 320]
-    elif cfg.arch == '1':
+    elif arch == '1':
         block_idx = [4, 7, 15, 22]
         channels = [24, 40, 112, 320]
-    elif cfg.arch == '2':
+    elif arch == '2':
         block_idx = [4, 7, 15, 22]
         channels = [24, 48, 120, 352]
-    elif cfg.arch == '3':
+    elif arch == '3':
         block_idx = [4, 7, 17, 25]
         channels = [32, 48, 136, 384]
-    elif cfg.arch == '4':
+    elif arch == '4':
         block_idx = [5, 9, 21, 31]
         channels = [32, 56, 160, 448]
-    elif cfg.arch == '5':
+    elif arch == '5':
         block_idx = [7, 12, 26, 38]
         channels = [40, 64, 176, 512]
-    elif cfg.arch == '6':
+    elif arch == '6':
         block_idx = [8, 14, 30, 44]
         channels = [40, 72, 200, 576]
-    elif cfg.arch == '7':
+    elif arch == '7':
         block_idx = [10, 17, 37, 54]
         channels = [48, 80, 224, 640]
 
@@ -499,7 +1035,7 @@ BlockArgs.__new__.__defaults__ = (None,) * len(BlockArgs._fields)
 # An ordinary implementation of Swish function
 class Swish(nn.Module):
     def forward(self, x):
-        return x * torch.sigmoid(x)
+        return F.silu(x)  # native fused kernel, traceable
 
 
 # A memory-efficient implementation of Swish function
@@ -653,9 +1189,29 @@ def get_same_padding_conv2d(image_size=None):
         return partial(Conv2dStaticSamePadding, image_size=image_size)
 
 
+def same_padding(input_size, kernel_size, stride, dilation):
+    """TensorFlow 'SAME' padding (left, right, top, bottom) of a convolution over an input of input_size (H, W)."""
+    ih, iw = input_size
+    kh, kw = kernel_size
+    sh, sw = stride
+    oh, ow = math.ceil(ih / sh), math.ceil(iw / sw) # change the output size according to stride ! ! !
+    pad_h = max((oh - 1) * sh + (kh - 1) * dilation[0] + 1 - ih, 0)
+    pad_w = max((ow - 1) * sw + (kw - 1) * dilation[1] + 1 - iw, 0)
+    return pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2
+
+
+def split_same_padding(pad):
+    """(convolution padding, explicit F.pad amounts or None) of a 'SAME' padding. Symmetric padding is left to the
+    convolution, which pads without allocating a padded copy of its input."""
+    left, right, top, bottom = pad
+    if left == right and top == bottom:
+        return (top, left), None
+    return (0, 0), list(pad)
+
+
 class Conv2dDynamicSamePadding(nn.Conv2d):
     """2D Convolutions like TensorFlow, for a dynamic image size.
-       The padding is operated in forward function by calculating dynamically.
+       The padding is calculated in forward function and memoized per input size.
     """
 
     # Tips for 'SAME' mode padding.
@@ -673,17 +1229,18 @@ class Conv2dDynamicSamePadding(nn.Conv2d):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, groups=1, bias=True):
         super().__init__(in_channels, out_channels, kernel_size, stride, 0, dilation, groups, bias)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
+        self.padding_cache = {}  # (ih, iw) -> (convolution padding, explicit F.pad amounts or None)
 
     def forward(self, x):
         ih, iw = x.size()[-2:]
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw) # change the output size according to stride ! ! !
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            x = F.pad(x, [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2])
-        return F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+        key = (int(ih), int(iw))  # sizes are traced as tensors during ONNX export
+        if key not in self.padding_cache:
+            pad = same_padding(key, self.weight.size()[-2:], self.stride, self.dilation)
+            self.padding_cache[key] = split_same_padding(pad)
+        padding, pad = self.padding_cache[key]
+        if pad is not None:
+            x = F.pad(x, pad)
+        return F.conv2d(x, self.weight, self.bias, self.stride, padding, self.dilation, self.groups)
 
 
 class Conv2dStaticSamePadding(nn.Conv2d):
@@ -697,17 +1254,13 @@ class Conv2dStaticSamePadding(nn.Conv2d):
         super().__init__(in_channels, out_channels, kernel_size, stride, **kwargs)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
 
-        # Calculate padding based on image size and save it
+        # Calculate padding based on image size and save it (symmetric padding is done by the convolution itself)
         assert image_size is not None
         ih, iw = (image_size, image_size) if isinstance(image_size, int) else image_size
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            self.static_padding = nn.ZeroPad2d((pad_w // 2, pad_w - pad_w // 2,
-                                                pad_h // 2, pad_h - pad_h // 2))
+        pad = same_padding((ih, iw), self.weight.size()[-2:], self.stride, self.dilation)
+        self.padding, pad = split_same_padding(pad)
+        if pad is not None:
+            self.static_padding = nn.ZeroPad2d(tuple(pad))
         else:
             self.static_padding = nn.Identity()
 
@@ -1018,7 +1571,7 @@ url_map_advprop = {
     'efficientnet-b8': 'https://github.com/lukemelas/EfficientNet-PyTorch/releases/download/1.0/adv-efficientnet-b8-22a8fe65.pth',
 }
 
-def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True, advprop=False):
+def load_pretrained_weights(model, model_name, weights_path=None, advprop=False, weights_dir=None):
     """Loads pretrained weights from weights path or download using url.
 
     Args:
@@ -1027,39 +1580,42 @@ def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True,
         weights_path (None or str):
             str: path to pretrained weights file on the local disk.
             None: use pretrained weights downloaded from the Internet.
-        load_fc (bool): Whether to load pretrained weights for fc layer at the end of the model.
         advprop (bool): Whether to load pretrained weights
                         trained with advprop (valid when weights_path is None).
+        weights_dir (None or str): Local weight store directory (falls back to $TRACER_WEIGHTS_DIR).
+                                   When set, weights are read from there instead of being downloaded.
+    Only the tensors of the model are kept: the ImageNet head (_conv_head, _bn1, _fc) is dropped right after loading.
     """
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    store = WeightStore.from_config(weights_dir)
     if isinstance(weights_path, str):
-        state_dict = torch.load(weights_path, strict=False, map_location = device)
+        state_dict = torch.load(weights_path, map_location = device)
     else:
         # AutoAugment or Advprop (different preprocessing)
         url_map_ = url_map_advprop if advprop else url_map
-        state_dict = model_zoo.load_url(url_map_[model_name], map_location=device)
-
-    if load_fc:
-        ret = model.load_state_dict(state_dict, strict=False)
-        # assert not ret.missing_keys, 'Missing keys when loading pretrained weights: {}'.format(ret.missing_keys)
-    else:
-        state_dict.pop('_fc.weight')
-        state_dict.pop('_fc.bias')
-        ret = model.load_state_dict(state_dict, strict=False)
-        # assert set(ret.missing_keys) == set(
-        #     ['_fc.weight', '_fc.bias']), 'Missing keys when loading pretrained weights: {}'.format(ret.missing_keys)
-    # assert not ret.unexpected_keys, 'Missing keys when loading pretrained weights: {}'.format(ret.unexpected_keys)
+        if store is not None:
+            state_dict = store.load(url_map_[model_name], map_location=device)
+        else:
+            state_dict = model_zoo.load_url(url_map_[model_name], map_location=device)
 
-    print('Loaded pretrained weights for {}'.format(model_name))
+    model_keys = model.state_dict().keys()
+    unused = [key for key in state_dict if key not in model_keys]
+    for key in unused:
+        del state_dict[key]
+    # strict=False: the Frequency Edge Module is not part of the ImageNet backbone
+    model.load_state_dict(state_dict, strict=False)
 
+    print('Loaded pretrained weights for {} ({} unused tensors dropped)'.format(model_name, len(unused)))
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 class Frequency_Edge_Module(nn.Module):
-    def __init__(self, radius, channel):
+    def __init__(self, radius, channel, gamma=0.1):
         super(Frequency_Edge_Module, self).__init__()
         self.radius = radius
-        self.UAM = UnionAttentionModule(channel, only_channel_tracing=True)
+        self.mask_cache = {}  # (rows, cols, radius, device) -> radial mask
+        self.high_pass_cache = {}  # (rows, cols, radius, device, rfft) -> high-pass filter in unshifted frequency order
+        self.real_fft = True
+        self.UAM = UnionAttentionModule(channel, only_channel_tracing=True, gamma=gamma)
 
         # DWS + DWConv
         self.DWSConv = DWSConv(channel, channel, kernel=3, padding=1, kernels_per_layer=1)
@@ -1081,20 +1637,46 @@ class Frequency_Edge_Module(nn.Module):
         )
         self.conv = BasicConv2d(channel, 1, 1)
 
-    def distance(self, i, j, imageSize, r):
-        dis = np.sqrt((i - imageSize / 2) ** 2 + (j - imageSize / 2) ** 2)
-        if dis < r:
-            return 1.0
-        else:
-            return 0
-
     def mask_radial(self, img, r):
+        """Radial mask (1 inside radius r around the centre of the shifted spectrum), cached per shape and device."""
+        batch, channels, rows, cols = img.shape
+        key = (rows, cols, r, img.device)
+        if key not in self.mask_cache:
+            i = torch.arange(rows, dtype=torch.float64).unsqueeze(1)
+            j = torch.arange(cols, dtype=torch.float64).unsqueeze(0)
+            dis = torch.sqrt((i - rows / 2) ** 2 + (j - rows / 2) ** 2)
+            self.mask_cache[key] = (dis < r).to(device=img.device, dtype=torch.float32)
+        return self.mask_cache[key]
+
+    def rfft_applicable(self, rows, cols):
+        # The radial mask is centred on rows / 2 along both axes, so it is symmetric under f -> -f (and the filtered
+        # spectrum of a real input stays Hermitian) only for square maps of even size.
+        return self.real_fft and rows == cols and rows % 2 == 0
+
+    def high_pass_filter(self, img, r):
+        """(1 - radial mask) moved to unshifted frequency order, so neither fftshift nor ifftshift is needed.
+        Only the non-redundant half (cols // 2 + 1) is kept when the rfft path applies."""
         batch, channels, rows, cols = img.shape
-        mask = torch.zeros((rows, cols), dtype=torch.float32)
-        for i in range(rows):
-            for j in range(cols):
-                mask[i, j] = self.distance(i, j, imageSize=rows, r=r)
-        return mask
+        key = (rows, cols, r, img.device, self.rfft_applicable(rows, cols))
+        if key not in self.high_pass_cache:
+            high_pass = ifftshift(1 - self.mask_radial(img, r))
+            if self.rfft_applicable(rows, cols):
+                high_pass = high_pass[:, :cols // 2 + 1].contiguous()
+            self.high_pass_cache[key] = high_pass
+        return self.high_pass_cache[key]
+
+    def high_pass(self, x):
+        """|IFFT(FFT(x) * high-pass filter)| over the spatial dimensions."""
+        rows, cols = x.shape[-2:]
+        high_pass = self.high_pass_filter(x, self.radius)
+        if self.rfft_applicable(rows, cols):
+            x_fft = rfft2(x, dim=(-2, -1))
+            x_fft.mul_(high_pass)
+            return torch.abs(irfft2(x_fft, s=(rows, cols), dim=(-2, -1)))
+
+        x_fft = fft2(x, dim=(-2, -1))
+        x_fft.mul_(high_pass)
+        return torch.abs(ifft2(x_fft, dim=(-2, -1)))
 
     def forward(self, x):
         """
@@ -1103,19 +1685,13 @@ class Frequency_Edge_Module(nn.Module):
         Returns:
             Edge refined representation: X + edge (B, C, H, W)
         """
-        x_fft = fft2(x, dim=(-2, -1))
-        x_fft = fftshift(x_fft)
-
         # Mask -> low, high separate
-        mask = self.mask_radial(img=x, r=self.radius).to(device)
-        high_frequency = x_fft * (1 - mask)
-        x_fft = ifftshift(high_frequency)
-        x_fft = ifft2(x_fft, dim=(-2, -1))
-        x_H = torch.abs(x_fft)
+        x_H = self.high_pass(x.float())  # fp32 under bfloat16 autocast
+        x_H = x_H.to(x.dtype, memory_format=memory_format_of(x))  # the FFT returns NCHW for channels_last inputs
 
         x_H, _ = self.UAM.Channel_Tracer(x_H)
         edge_maks = self.DWSConv(x_H)
-        skip = edge_maks.clone()
+        skip = edge_maks
 
         edge_maks = torch.cat([self.DWConv1(edge_maks), self.DWConv2(edge_maks),
                                self.DWConv3(edge_maks), self.DWConv4(edge_maks)], dim=1) + skip
@@ -1126,6 +1702,7 @@ class Frequency_Edge_Module(nn.Module):
         return x, edge
 
 
+
 class RFB_Block(nn.Module):
     def __init__(self, in_channel, out_channel):
         super(RFB_Block, self).__init__()
@@ -1153,18 +1730,34 @@ class RFB_Block(nn.Module):
         )
         self.conv_cat = BasicConv2d(4 * out_channel, out_channel, 3, padding=1)
         self.conv_res = BasicConv2d(in_channel, out_channel, 1)
+        self.out_channel = out_channel
+        self.heads = None  # first 1x1 convolutions of the branches and conv_res in one, see fuse_branches
 
     def forward(self, x):
-        x0 = self.branch0(x)
-        x1 = self.branch1(x)
-        x2 = self.branch2(x)
-        x3 = self.branch3(x)
+        if self.heads is None:
+            x0 = x1 = x2 = x3 = x_res = x
+        else:
+            x0, x1, x2, x3, x_res = torch.split(self.heads(x), self.out_channel, dim=1)
+        x0 = self.branch0(x0)
+        x1 = self.branch1(x1)
+        x2 = self.branch2(x2)
+        x3 = self.branch3(x3)
         x_cat = torch.cat((x0, x1, x2, x3), 1)
         x_cat = self.conv_cat(x_cat)
 
-        x = self.relu(x_cat + self.conv_res(x))
+        x = self.relu(x_cat + self.conv_res(x_res))
         return x
 
+    def fuse_branches(self):
+        """Runs the five 1x1 convolutions over the block input (first layer of each branch and conv_res) as one
+        wider convolution whose output is split between the branches. Requires fuse_bn."""
+        if self.heads is not None:
+            return
+        self.heads = merge_basic_convs([self.branch0[0], self.branch1[0], self.branch2[0], self.branch3[0],
+                                        self.conv_res])
+        self.branch0[0], self.branch1[0], self.branch2[0], self.branch3[0] = (nn.Identity() for _ in range(4))
+        self.conv_res = nn.Identity()
+
 
 class GlobalAvgPool(nn.Module):
     def __init__(self, flatten=False):
@@ -1180,10 +1773,10 @@ class GlobalAvgPool(nn.Module):
 
 
 class UnionAttentionModule(nn.Module):
-    def __init__(self, n_channels, only_channel_tracing=False):
+    def __init__(self, n_channels, only_channel_tracing=False, gamma=0.1):
         super(UnionAttentionModule, self).__init__()
         self.GAP = GlobalAvgPool()
-        self.confidence_ratio = cfg.gamma
+        self.confidence_ratio = gamma
         self.bn = nn.BatchNorm2d(n_channels)
         self.norm = nn.Sequential(
             nn.BatchNorm2d(n_channels),
@@ -1208,13 +1801,21 @@ class UnionAttentionModule(nn.Module):
                                        padding=0, bias=False)
         self.sigmoid = nn.Sigmoid()
 
+    def quantile_threshold(self, mask):
+        """torch.quantile(mask, confidence_ratio, dim=-1, keepdim=True) from a partial selection of the smallest
+        values (TopK) instead of a full sort, bit-identical to quantile and exportable to ONNX."""
+        # same rank and weight rounding as torch.quantile: q in the input dtype, rank in double precision
+        rank = torch.tensor(self.confidence_ratio, dtype=mask.dtype).item() * (mask.size(-1) - 1)
+        below, above = int(math.floor(rank)), int(math.ceil(rank))
+        values = torch.topk(mask, above + 1, dim=-1, largest=False, sorted=True).values
+        weight = torch.tensor(rank - below, dtype=mask.dtype, device=mask.device)
+        return torch.lerp(values[..., below:below + 1], values[..., above:above + 1], weight)
+
     def masking(self, x, mask):
-        mask = mask.squeeze(3).squeeze(2)
-        threshold = torch.quantile(mask, self.confidence_ratio, dim=-1, keepdim=True)
-        mask[mask <= threshold] = 0.0
-        mask = mask.unsqueeze(2).unsqueeze(3)
-        mask = mask.expand(-1, x.shape[1], x.shape[2], x.shape[3]).contiguous()
-        masked_x = x * mask
+        mask = mask.squeeze(3).squeeze(2).float()  # fp32 threshold under bfloat16 autocast
+        threshold = self.quantile_threshold(mask)
+        mask = mask.masked_fill(mask <= threshold, 0.0).unsqueeze(2).unsqueeze(3)
+        masked_x = x * mask.to(x.dtype)  # broadcast over (H, W) keeps the memory format of x
 
         return masked_x
 
@@ -1228,7 +1829,7 @@ class UnionAttentionModule(nn.Module):
 
         # softmax(Q*K^T)
         QK_T = torch.matmul(q, k.transpose(1, 2))
-        alpha = F.softmax(QK_T, dim=-1)
+        alpha = F.softmax(QK_T.float(), dim=-1)  # fp32 under bfloat16 autocast
 
         # a*v
         att = torch.matmul(alpha, v).unsqueeze(-1)
@@ -1236,9 +1837,8 @@ class UnionAttentionModule(nn.Module):
         att = self.sigmoid(att)
 
         output = (x * att) + x
-        alpha_mask = att.clone()
 
-        return output, alpha_mask
+        return output, att  # masking does not modify the mask in place
 
     def forward(self, x):
         X_c, alpha_mask = self.Channel_Tracer(x)
@@ -1251,7 +1851,7 @@ class UnionAttentionModule(nn.Module):
 
         # softmax(Q*K^T)
         QK_T = torch.matmul(q, k.transpose(1, 2))
-        alpha = F.softmax(QK_T, dim=-1)
+        alpha = F.softmax(QK_T.float(), dim=-1)  # fp32 under bfloat16 autocast
 
         output = torch.matmul(alpha, v).unsqueeze(1) + v.unsqueeze(1)
 
@@ -1259,7 +1859,7 @@ class UnionAttentionModule(nn.Module):
 
 
 class aggregation(nn.Module):
-    def __init__(self, channel):
+    def __init__(self, channel, gamma=0.1):
         super(aggregation, self).__init__()
         self.relu = nn.ReLU(True)
 
@@ -1274,15 +1874,15 @@ class aggregation(nn.Module):
         self.conv_concat3 = BasicConv2d((channel[0] + channel[1] + channel[2]),
                                         (channel[0] + channel[1] + channel[2]), 3, padding=1)
 
-        self.UAM = UnionAttentionModule(channel[0] + channel[1] + channel[2])
+        self.UAM = UnionAttentionModule(channel[0] + channel[1] + channel[2], gamma=gamma)
 
     def forward(self, e4, e3, e2):
-        e4_1 = e4
-        e3_1 = self.conv_upsample1(self.upsample(e4)) * e3
-        e2_1 = self.conv_upsample2(self.upsample(self.upsample(e4))) \
+        e4_up = self.upsample(e4)  # reused by conv_upsample1, conv_upsample2 and conv_upsample4
+        e3_1 = self.conv_upsample1(e4_up) * e3
+        e2_1 = self.conv_upsample2(self.upsample(e4_up)) \
                * self.conv_upsample3(self.upsample(e3)) * e2
 
-        e3_2 = torch.cat((e3_1, self.conv_upsample4(self.upsample(e4_1))), 1)
+        e3_2 = torch.cat((e3_1, self.conv_upsample4(e4_up)), 1)
         e3_2 = self.conv_concat2(e3_2)
 
         e2_2 = torch.cat((e2_1, self.conv_upsample5(self.upsample(e3_2))), 1)
@@ -1294,9 +1894,10 @@ class aggregation(nn.Module):
 
 
 class ObjectAttention(nn.Module):
-    def __init__(self, channel, kernel_size):
+    def __init__(self, channel, kernel_size, denoise=0.93):
         super(ObjectAttention, self).__init__()
         self.channel = channel
+        self.denoise = denoise
         self.DWSConv = DWSConv(channel, channel // 2, kernel=kernel_size, padding=1, kernels_per_layer=1)
         self.DWConv1 = nn.Sequential(
             DWConv(channel // 2, channel // 2, kernel=1, padding=0, dilation=1),
@@ -1324,20 +1925,20 @@ class ObjectAttention(nn.Module):
         Returns:
             decoder representation: (B, 1, H, W)
         """
-        mask_bg = -1 * torch.sigmoid(decoder_map) + 1  # Sigmoid & Reverse
         mask_ob = torch.sigmoid(decoder_map)  # object attention
-        x = mask_ob.expand(-1, self.channel, -1, -1).mul(encoder_map)
+        mask_bg = -1 * mask_ob + 1  # Sigmoid & Reverse
+        x = mask_ob * encoder_map  # broadcast over the channels
 
-        edge = mask_bg.clone()
-        edge[edge > cfg.denoise] = 0
+        edge = mask_bg.masked_fill(mask_bg > self.denoise, 0)
         x = x + (edge * encoder_map)
 
         x = self.DWSConv(x)
-        skip = x.clone()
+        skip = x
         x = torch.cat([self.DWConv1(x), self.DWConv2(x), self.DWConv3(x), self.DWConv4(x)], dim=1) + skip
         x = torch.relu(self.conv1(x))
 
         return x + decoder_map
+
     
 def to_array(feature_map):
     if feature_map.shape[0] == 1:
@@ -1349,6 +1950,20 @@ def to_array(feature_map):
 def to_tensor(feature_map):
     return torch.as_tensor(feature_map.transpose(0, 3, 1, 2), dtype=torch.float32)
 
+def memory_format_of(x):
+    """torch.channels_last for NHWC feature maps, torch.contiguous_format otherwise."""
+    if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+def autocast(device, precision):
+    """Autocast context of an inference precision: 'fp32' (no autocast) or 'bf16'."""
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError(f'Unknown precision {precision}: use fp32 or bf16')
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=torch.bfloat16)
+
 class AvgMeter(object):
     def __init__(self, num=40):
         self.num = num
@@ -1381,13 +1996,111 @@ url_TRACER = {
 }
 
 
-def load_pretrained(model_name, device):
-    state_dict = model_zoo.load_url(url_TRACER[model_name], map_location = device)
+WEIGHTS_DIR_ENV = 'TRACER_WEIGHTS_DIR'
+MANIFEST = 'sha256sums.txt'
+HASH_REGEX = re.compile(r'-([a-f0-9]{8,})\.')
+
+
+def sha256sum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WeightStore():
+    """
+    Offline weight store (util/weight_store.py): release files looked up by basename in a local directory, each
+    verified against <weights_dir>/sha256sums.txt or the hash prefix in its name before it is deserialized.
+    """
+    def __init__(self, root=None):
+        self.root = root or os.environ.get(WEIGHTS_DIR_ENV)
+        if self.root is None:
+            raise ValueError(f'No weights directory given and ${WEIGHTS_DIR_ENV} is not set')
+        self.manifest = self._read_manifest()
+        self._verified = {}
+
+    @classmethod
+    def from_config(cls, weights_dir=None):
+        """Returns a store for weights_dir or $TRACER_WEIGHTS_DIR, or None to download with model_zoo."""
+        if weights_dir is None and os.environ.get(WEIGHTS_DIR_ENV) is None:
+            return None
+        return cls(weights_dir)
+
+    def _read_manifest(self):
+        manifest = {}
+        path = os.path.join(self.root, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        checksum, filename = line.split(maxsplit=1)
+                        manifest[filename.strip().lstrip('*')] = checksum.lower()
+        return manifest
+
+    def resolve(self, url_or_filename):
+        """Returns the verified local path of a release file."""
+        filename = os.path.basename(urlparse(url_or_filename).path)
+        path = os.path.join(self.root, filename)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'{filename} not found in weight store {self.root}')
+        self.verify(path)
+        return path
+
+    def verify(self, path):
+        """Checks a file against its expected checksum and returns its SHA-256 (not hashed again while unchanged)."""
+        filename = os.path.basename(path)
+        stat = os.stat(path)
+        verified = self._verified.get(path)
+        if verified is not None and verified[:2] == (stat.st_size, stat.st_mtime):
+            return verified[2]
+
+        expected = self.manifest.get(filename)
+        if expected is None:
+            match = HASH_REGEX.search(filename)
+            if match is None:
+                raise RuntimeError(f'No checksum for {filename}: add it to {os.path.join(self.root, MANIFEST)}')
+            expected = match.group(1)
+
+        checksum = sha256sum(path)
+        if not checksum.startswith(expected):
+            raise RuntimeError(f'Checksum mismatch for {path}: expected {expected}, got {checksum}')
+        self._verified[path] = (stat.st_size, stat.st_mtime, checksum)
+        return checksum
+
+    def checksum(self, url_or_filename):
+        """SHA-256 of a verified release file."""
+        return self.verify(self.resolve(url_or_filename))
+
+    def load(self, url_or_filename, map_location=None):
+        return torch.load(self.resolve(url_or_filename), map_location=map_location)
+
+
+def strip_module_prefix(state_dict):
+    """state_dict without the 'module.' prefix of checkpoints saved from nn.DataParallel."""
+    return {key[len('module.'):] if key.startswith('module.') else key: value for key, value in state_dict.items()}
+
+
+def load_pretrained(model_name, device, weights_dir=None):
+    store = WeightStore.from_config(weights_dir)
+    if store is not None:  # offline: local directory or $TRACER_WEIGHTS_DIR
+        state_dict = store.load(url_TRACER[model_name], map_location = device)
+    else:
+        state_dict = model_zoo.load_url(url_TRACER[model_name], map_location = device)
 
     return state_dict
 
 
 
+def fuse_conv_bn(conv, bn):
+    """Returns (conv, bn) with an eval-mode BatchNorm folded into the weights and bias of the preceding conv,
+    and replaced by an identity."""
+    if isinstance(bn, nn.Identity):  # already fused
+        return conv, bn
+    return fuse_conv_bn_eval(conv, bn), nn.Identity()
+
+
 class BasicConv2d(nn.Module):
     def __init__(self, in_channel, out_channel, kernel_size, stride=(1, 1), padding=(0, 0), dilation=(1, 1)):
         super(BasicConv2d, self).__init__()
@@ -1403,6 +2116,23 @@ class BasicConv2d(nn.Module):
 
         return x
 
+    def fuse_bn(self):
+        self.conv, self.bn = fuse_conv_bn(self.conv, self.bn)
+
+
+def merge_basic_convs(convs):
+    """Single BasicConv2d whose output is the concatenation of the outputs of BatchNorm-fused BasicConv2d layers
+    with the same input and kernel."""
+    if not all(isinstance(conv.bn, nn.Identity) for conv in convs):
+        raise ValueError('merge_basic_convs expects BatchNorm-fused layers (fuse_bn)')
+    first = convs[0].conv
+    merged = BasicConv2d(first.in_channels, sum(conv.conv.out_channels for conv in convs),
+                         first.kernel_size, first.stride, first.padding, first.dilation)
+    merged.conv.weight = nn.Parameter(torch.cat([conv.conv.weight for conv in convs]))
+    merged.conv.bias = nn.Parameter(torch.cat([conv.conv.bias for conv in convs]))
+    merged.bn = nn.Identity()
+    return merged.eval()
+
 
 class DWConv(nn.Module):
     def __init__(self, in_channel, out_channel, kernel, dilation, padding):
@@ -1419,6 +2149,9 @@ class DWConv(nn.Module):
 
         return out
 
+    def fuse_bn(self):
+        self.DWConv, self.bn = fuse_conv_bn(self.DWConv, self.bn)
+
 
 class DWSConv(nn.Module):
     def __init__(self, in_channel, out_channel, kernel, padding, kernels_per_layer):
@@ -1438,6 +2171,10 @@ class DWSConv(nn.Module):
         out = self.selu(self.bn2(out))
 
         return out
+
+    def fuse_bn(self):
+        self.DWConv, self.bn = fuse_conv_bn(self.DWConv, self.bn)
+        self.PWConv, self.bn2 = fuse_conv_bn(self.PWConv, self.bn2)
     
 
 
@@ -1471,8 +2208,15 @@ class Inference():
     def __init__(self, args):
         super(Inference, self).__init__()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.transform = get_test_augmentation(img_size=args.img_size)
+        self.input_size = args.img_size
+        self.transform = get_test_augmentation(img_size=self.input_size)
         self.args = args
+        self.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+        if args.letterbox and (args.model_file is not None or args.cascade_arch is not None or args.tile):
+            raise ValueError('letterbox inference runs the eager model (exported models have a fixed input size) '
+                             'without cascade_arch or tile')
+        if args.letterbox: # aspect ratio kept, images batched by their padded shape
+            self.transform = get_letterbox_augmentation(img_size=self.input_size)
 
         self.invTrans = transforms.Compose([ transforms.Normalize(mean=[0., 0., 0.],
                                                                  std=[1/0.229, 1/0.224, 1/0.225]),
@@ -1481,20 +2225,77 @@ class Inference():
                                           ])
 
         # Network
-        self.model = TRACER(args).to(self.device)
-        model_state_dict = load_pretrained(f'TE-{args.arch}', self.device)
-        
-        if 'module.' in list(model_state_dict.keys())[0]:
-            model_state_dict = {k.replace('module.', ''): v for k, v in model_state_dict.items()}
-        self.model.load_state_dict(model_state_dict)
+        if args.model_file is not None: # exported artifact (export.py)
+            if args.model_file.endswith('.onnx'):
+                self.model = OnnxTRACER(args.model_file, args.num_threads)
+            else:
+                self.model = ScriptedTRACER(args.model_file, self.device)
+        else:
+            self.model = self.load_model(args)
+        if args.cascade_arch is not None: # small arch first, low-confidence images again with cascade_arch
+            large_args = copy.copy(args)
+            large_args.arch = args.cascade_arch
+            self.model = CascadeTRACER(self.model, self.load_model(large_args), small_size=args.img_size,
+                                       band=args.cascade_band, max_uncertain=args.cascade_max_uncertain)
+            self.input_size = DummyArgs(args.cascade_arch).img_size
+            self.transform = get_test_augmentation(img_size=self.input_size)
         
         self.model.eval()
+        self.tiler = None
+        if args.tile: # full-resolution masks from a global pass and overlapping tiles
+            self.tiler = TiledPredictor(self.model, self.transform, self.input_size, self.device, self.memory_format,
+                                        args.precision, overlap=args.tile_overlap, batch_size=args.tile_batch_size,
+                                        band=args.tile_band)
+        # results of repeated images by their encoded bytes or pixels (args.cache_size, args.cache_dir)
+        self.cache = ResultCache.from_config(args)
+        self.cache_settings = cache_settings(args, self.input_size, object_format='RGBA') if self.cache is not None else None
         print('###### pre-trained Model restored #####')
 
 
-    def test(self, image):
+    def load_model(self, args):
+        model = TRACER(args, pretrained_backbone=False).to(self.device, memory_format=self.memory_format)
+        model_state_dict = load_pretrained(f'TE-{args.arch}', self.device, args.weights_dir)
+        model.load_state_dict(strip_module_prefix(model_state_dict))
+        model.fuse_for_inference() # fold BatchNorm into the convolutions
+        model.set_swish(memory_efficient=False) # native SiLU
+        return model
+
+
+    def read_image(self, image):
+        """
+        Args:
+            image: PIL image, RGB numpy array, encoded image bytes, path in directory or URL.
+        Returns:
+            encoded image bytes of paths and URLs (not decoded), RGB numpy array of PIL images, other inputs as they are.
+        """
+        if isinstance(image, Image.Image):
+            return np.array(image.convert('RGB'))
+
+        elif isinstance(image, str): # if path or URL
+            if "http" in image or "https" in image:
+                return urllib.request.urlopen(image).read()
+            with open(image, 'rb') as f:
+                return f.read()
+
+        return image
+
+
+    def load_image(self, image):
+        """
+        Args:
+            image: PIL image, RGB numpy array, encoded image bytes, path in directory or URL.
+        Returns:
+            RGB image as a numpy array (H, W, 3).
+        """
         if isinstance(image, Image.Image):
-            image = np.array(image)
+            image = np.array(image.convert('RGB'))
+
+        elif isinstance(image, (bytes, bytearray)): # encoded image, e.g. a Spark binary column
+            buffer = np.frombuffer(image, dtype=np.uint8)
+            image = cv2.imdecode(buffer, cv2.IMREAD_COLOR) if buffer.size else None
+            if image is None:
+                raise ValueError(f'Cannot decode an image of {buffer.size} bytes')
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
         elif isinstance(image, str): # if path or URL
             if "http" in image or "https" in image:
@@ -1506,19 +2307,154 @@ class Inference():
                 image = cv2.imread(image)
             
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+        return image
+
+
+    def test(self, image):
+        outputs, salient_objects = self.test_batch([image])
+        return outputs[0], salient_objects[0]
+
+
+    def predict_masks(self, images, batch_size=None):
+        """
+        Args:
+            images: list of inputs accepted by load_image.
+            batch_size: maximum number of images per forward pass (default: all images at once;
+                        in letterbox mode, all images of the same padded shape).
+        Returns:
+            images: list of decoded RGB images.
+            inputs: list of the normalized model inputs (3, h, w) of the images, without the stride padding in
+                    letterbox mode (empty in tiled mode).
+            masks: list of predicted masks (H, W) as uint8 at the original image sizes.
+        """
+        images = [self.load_image(image) for image in images]
+        if self.tiler is not None: # one image at a time, tiles in batches of args.tile_batch_size
+            return images, [], [self.tiler.predict_mask(image) for image in images]
+        batch_size = batch_size or max(len(images), 1)
+        if self.args.letterbox:
+            batches = group_by_shape([image.shape[:2] for image in images], self.input_size, batch_size)
+        else:
+            batches = [range(start, min(start + batch_size, len(images))) for start in range(0, len(images), batch_size)]
+
+        inputs, masks = [None] * len(images), [None] * len(images)
+        for batch in batches:
+            batch_inputs = torch.stack([self.transform(image=images[idx])['image'] for idx in batch])
+
+            with torch.no_grad():
+                batch_inputs = batch_inputs.to(self.device, dtype=torch.float32, memory_format=self.memory_format)
+                with autocast(self.device, self.args.precision):
+                    output_maps = self.model(batch_inputs, return_aux=False).float()
+
+                for i, idx in enumerate(batch):
+                    h, w = images[idx].shape[:2]
+                    image, output = batch_inputs[i], output_maps[i]
+                    if self.args.letterbox: # crop the stride padding off before resizing back
+                        rows, cols = letterbox_size(h, w, self.input_size)
+                        image, output = image[:, :rows, :cols], output[:, :rows, :cols]
+                    output = F.interpolate(output.unsqueeze(0), size=(h, w), mode='bilinear')
+                    masks[idx] = (output.squeeze().detach().cpu().numpy() * 255.0).astype(np.uint8)  # convert uint8 type
+                    inputs[idx] = image
+
+        return images, inputs, masks
+
+
+    def cached_results(self, images, batch_size=None, need_object=True):
+        """
+        Args:
+            images: list of inputs accepted by load_image.
+            batch_size: maximum number of images per forward pass of the cache misses.
+            need_object: also return the salient objects (otherwise they may be None).
+        Returns:
+            list of (PNG encoded mask, PNG encoded salient object) from the result cache. Encoded images are keyed by
+            their bytes and only decoded and predicted on a cache miss, repeated images are predicted once.
+        """
+        images = [self.read_image(image) for image in images]
+        keys = [self.cache.key(image, *self.cache_settings) for image in images]
+        results, misses = [None] * len(images), {}
+        for idx, key in enumerate(keys):
+            results[idx] = None if key in misses else self.cache.get(key, need_object)
+            if results[idx] is None:
+                misses.setdefault(key, []).append(idx)
+
+        first = [images[indices[0]] for indices in misses.values()]
+        if need_object:
+            masks, objects = self.predict_batch(first, batch_size)
+        else:
+            _, _, masks = self.predict_masks(first, batch_size)
+            objects = [None] * len(masks)
+        for (key, indices), mask, rgba_image in zip(misses.items(), masks, objects):
+            result = (encode_png(mask), None if rgba_image is None else encode_png(rgba_image))
+            self.cache.put(key, *result)
+            for idx in indices:
+                results[idx] = result
+        return results
+
+
+    def test_batch(self, images, batch_size=None):
+        """
+        Args:
+            images: list of PIL images, RGB numpy arrays, encoded image bytes, paths or URLs.
+            batch_size: maximum number of images per forward pass (default: all images at once).
+        Returns:
+            masks: list of predicted masks (H, W) at the original image sizes.
+            salient_objects: list of RGBA salient objects (H, W, 4) at the original image sizes.
+        """
+        if self.cache is None:
+            return self.predict_batch(images, batch_size)
+        results = self.cached_results(images, batch_size)
+        return [decode_png(mask) for mask, _ in results], [decode_png(rgba_image) for _, rgba_image in results]
+
+
+    def predict_batch(self, images, batch_size=None):
+        """test_batch without the result cache."""
+        images, inputs, masks = self.predict_masks(images, batch_size)
+        if self.tiler is not None:
+            return masks, [salient_object(image, mask) for image, mask in zip(images, masks)]
+
+        salient_objects = []
+        for i, (image, mask) in enumerate(zip(images, masks)):
             h, w = image.shape[:2]
+            salient_objects.append(self.post_processing(inputs[i].unsqueeze(0), mask, h, w))
 
-        image = self.transform(image=image)['image']
-       
-        with torch.no_grad():
-                image = torch.tensor(image.unsqueeze(0), device=self.device, dtype=torch.float32)
+        return masks, salient_objects
 
-                output, edge_mask, ds_map = self.model(image)
-                output = F.interpolate(output, size=(h, w), mode='bilinear')
-                output = (output.squeeze().detach().cpu().numpy() * 255.0).astype(np.uint8)  # convert uint8 type
 
-                salient_object = self.post_processing(image, output, h, w)
-                return output, salient_object
+    def encode_masks(self, images, batch_size=None):
+        """
+        Args:
+            images: list of encoded image bytes (or any input accepted by load_image), None for null rows.
+            batch_size: maximum number of images per forward pass (default: all images at once).
+        Returns:
+            list of PNG encoded masks at the original image sizes, None (a null mask) for the images that are None or
+            cannot be decoded.
+        """
+        def encode(rows):
+            if self.cache is not None:
+                return [mask for mask, _ in self.cached_results([images[idx] for idx in rows], batch_size,
+                                                                 need_object=False)]
+            _, _, masks = self.predict_masks([images[idx] for idx in rows], batch_size)
+            return [cv2.imencode('.png', mask)[1].tobytes() for mask in masks]
+
+        def decodes(image):
+            try:
+                self.load_image(image)
+                return True
+            except ValueError:
+                return False
+
+        rows = [idx for idx, image in enumerate(images) if image is not None]
+        try:
+            masks = encode(rows)
+        except ValueError: # images are decoded before any forward pass: drop the undecodable ones and run again
+            decoded = [idx for idx in rows if decodes(images[idx])]
+            print(f'{len(rows) - len(decoded)} of {len(images)} images cannot be decoded and get a null mask')
+            rows, masks = decoded, encode(decoded)
+
+        results = [None] * len(images)
+        for idx, mask in zip(rows, masks):
+            results[idx] = mask
+        return results
 
     
     def post_processing(self, original_image, output_image, height, width, threshold=200):
@@ -1535,4 +2471,76 @@ class Inference():
         edge_y, edge_x, _ = np.where(output_rbga_image <= threshold)  # Edge coordinates
         
         rgba_image[edge_y, edge_x, 3] = 0
-        return rgba_image
\ No newline at end of file
+        return rgba_image
+
+
+###########################################################################################################################################
+# Spark entry points
+#
+# Spark reuses executor Python workers across tasks (spark.python.worker.reuse), so the model is built once per worker
+# and kept in _INFERENCE_CACHE. Each Arrow record batch (spark.sql.execution.arrow.maxRecordsPerBatch, 10000 rows by
+# default) is run in chunks of batch_size images per forward pass; batch_size=None runs a whole record batch as one
+# tensor, which only fits in memory with a small maxRecordsPerBatch. Null rows and rows that cannot be decoded get a
+# null mask. With cache_size (MiB) or cache_dir, masks of images seen before (by their bytes) come from the result
+# cache of the worker, e.g. a cache_dir on a shared volume.
+# With weights_dir (or $TRACER_WEIGHTS_DIR on the executors), checkpoints are read from a local weight store
+# (util/weight_store.py) and verified against their checksums instead of being downloaded.
+#
+# e.g. (local mode)
+#     spark = SparkSession.builder.master('local[2]').getOrCreate()
+#     spark.sparkContext.addPyFile('inference_helper_spark.py')
+#     df = spark.read.format('binaryFile').load('images/')
+#     df.select('path', tracer_mask_udf(arch=7)('content').alias('mask'))
+#     df.mapInPandas(tracer_map_in_pandas(arch=7), schema=df.schema.add('mask', 'binary'))
+
+_INFERENCE_CACHE = {}
+SPARK_BATCH_SIZE = 8 # default images per forward pass of the UDFs
+
+
+def get_inference(arch=7, cache_size=0, cache_dir=None, weights_dir=None):
+    """Returns the Inference instance of the current Python worker, building it on first use."""
+    key = (str(arch), cache_size, cache_dir, weights_dir)
+    if key not in _INFERENCE_CACHE:
+        args = DummyArgs(arch=str(arch))
+        args.cache_size, args.cache_dir, args.weights_dir = cache_size, cache_dir, weights_dir
+        _INFERENCE_CACHE[key] = Inference(args)
+    return _INFERENCE_CACHE[key]
+
+
+def tracer_mask_udf(arch=7, batch_size=SPARK_BATCH_SIZE, cache_size=0, cache_dir=None, weights_dir=None):
+    """Iterator pandas UDF mapping a binary column of encoded images to a binary column of PNG masks."""
+    from typing import Iterator
+    import pandas as pd
+    from pyspark.sql.functions import pandas_udf
+
+    @pandas_udf('binary')
+    def tracer_mask(batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+        inference = get_inference(arch, cache_size, cache_dir, weights_dir)
+        for images in batches:
+            yield pd.Series(inference.encode_masks(list(images), batch_size))
+
+    return tracer_mask
+
+
+def tracer_map_in_pandas(arch=7, input_col='content', output_col='mask', batch_size=SPARK_BATCH_SIZE, cache_size=0,
+                         cache_dir=None, weights_dir=None):
+    """Function for DataFrame.mapInPandas appending a binary column of PNG masks to each record batch."""
+    def tracer_mask(frames):
+        inference = get_inference(arch, cache_size, cache_dir, weights_dir)
+        for frame in frames:
+            frame[output_col] = inference.encode_masks(list(frame[input_col]), batch_size)
+            yield frame
+
+    return tracer_mask
+
+
+if __name__ == '__main__':
+    from pyspark.sql import SparkSession
+
+    spark = SparkSession.builder.master('local[1]').appName('TRACER').getOrCreate()
+    spark.sparkContext.addPyFile(__file__)
+    from inference_helper_spark import tracer_mask_udf, tracer_map_in_pandas # resolve the UDFs from the shipped module
+
+    df = spark.read.format('binaryFile').option('pathGlobFilter', 'test_image.*').load('.')
+    df.select('path', tracer_mask_udf()('content').alias('mask')).show()
+    df.mapInPandas(tracer_map_in_pandas(), schema=df.schema.add('mask', 'binary')).select('path', 'mask').show()
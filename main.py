@@ -9,7 +9,6 @@ from inference import Inference
 
 from config import getConfig
 warnings.filterwarnings('ignore')
-args = getConfig()
 
 
 def main(args):
@@ -52,4 +51,5 @@ def main(args):
 
 
 if __name__ == '__main__':
+    args = getConfig()
     main(args)
\ No newline at end of file
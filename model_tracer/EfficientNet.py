@@ -25,9 +25,8 @@ from util.effi_utils import (
     calculate_output_image_size
 )
 from modules.att_modules import Frequency_Edge_Module
-from config import getConfig
-
-cfg = getConfig()
+from modules.conv_modules import fuse_conv_bn
+from config import DummyArgs
 
 VALID_MODELS = (
     'efficientnet-b0', 'efficientnet-b1', 'efficientnet-b2', 'efficientnet-b3',
@@ -138,24 +137,32 @@ class MBConvBlock(nn.Module):
         return x
 
     def set_swish(self, memory_efficient=True):
-        """Sets swish function as memory efficient (for training) or standard (for export).
+        """Sets swish function as memory efficient (custom autograd Function) or native SiLU (inference and export).
 
         Args:
             memory_efficient (bool): Whether to use memory-efficient version of swish.
         """
         self._swish = MemoryEfficientSwish() if memory_efficient else Swish()
 
+    def fuse_bn(self):
+        """Folds the eval-mode batch norms into the expansion, depthwise and pointwise convolutions."""
+        if self._block_args.expand_ratio != 1:
+            self._expand_conv, self._bn0 = fuse_conv_bn(self._expand_conv, self._bn0)
+        self._depthwise_conv, self._bn1 = fuse_conv_bn(self._depthwise_conv, self._bn1)
+        self._project_conv, self._bn2 = fuse_conv_bn(self._project_conv, self._bn2)
+
 
 class EfficientNet(nn.Module):
-    def __init__(self, blocks_args=None, global_params=None):
+    def __init__(self, blocks_args=None, global_params=None, cfg=None):
         super().__init__()
         assert isinstance(blocks_args, list), 'blocks_args should be a list'
         assert len(blocks_args) > 0, 'block args must be greater than 0'
+        assert cfg is not None, 'cfg (arch, frequency_radius, gamma) must be given'
         self._global_params = global_params
         self._blocks_args = blocks_args
-        self.block_idx, self.channels = get_model_shape()
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
         self.Frequency_Edge_Module1 = Frequency_Edge_Module(radius=cfg.frequency_radius,
-                                                            channel=self.channels[0])
+                                                            channel=self.channels[0], gamma=cfg.gamma)
         # Batch norm parameters
         bn_mom = 1 - self._global_params.batch_norm_momentum
         bn_eps = self._global_params.batch_norm_epsilon
@@ -194,7 +201,7 @@ class EfficientNet(nn.Module):
         self._swish = MemoryEfficientSwish()
 
     def set_swish(self, memory_efficient=True):
-        """Sets swish function as memory efficient (for training) or standard (for export).
+        """Sets swish function as memory efficient (custom autograd Function) or native SiLU (inference and export).
 
         Args:
             memory_efficient (bool): Whether to use memory-efficient version of swish.
@@ -204,29 +211,9 @@ class EfficientNet(nn.Module):
         for block in self._blocks:
             block.set_swish(memory_efficient)
 
-    def extract_endpoints(self, inputs):
-        endpoints = dict()
-
-        # Stem
-        x = self._swish(self._bn0(self._conv_stem(inputs)))
-        prev_x = x
-
-        # Blocks
-        for idx, block in enumerate(self._blocks):
-            drop_connect_rate = self._global_params.drop_connect_rate
-            if drop_connect_rate:
-                drop_connect_rate *= float(idx) / len(self._blocks)  # scale drop connect_rate
-            x = block(x, drop_connect_rate=drop_connect_rate)
-            if prev_x.size(2) > x.size(2):
-                endpoints['reduction_{}'.format(len(endpoints) + 1)] = prev_x
-            prev_x = x
-
-        # Head
-        x = self._swish(self._bn1(self._conv_head(x)))
-        endpoints['reduction_{}'.format(len(endpoints) + 1)] = x
-
-        return endpoints
-
+    def fuse_bn(self):
+        """Folds the eval-mode batch norm of the stem into its convolution (the blocks fuse their own)."""
+        self._conv_stem, self._bn0 = fuse_conv_bn(self._conv_stem, self._bn0)
 
     def initial_conv(self, inputs):
         # Stem
@@ -235,7 +222,12 @@ class EfficientNet(nn.Module):
         return x
 
 
-    def get_blocks(self, x, H, W):
+    def get_blocks(self, x, H, W, return_edge=True):
+        """
+        Returns the four TRACER feature maps and the edge map upsampled to (H, W).
+        With return_edge=False (inference) the edge map is not upsampled. The feature maps are not copied: no later
+        operation modifies them in place.
+        """
         # Blocks
         for idx, block in enumerate(self._blocks):
             drop_connect_rate = self._global_params.drop_connect_rate
@@ -246,25 +238,29 @@ class EfficientNet(nn.Module):
 
             if idx == self.block_idx[0]:
                 x, edge = self.Frequency_Edge_Module1(x)
-                edge = F.interpolate(edge, size=(H, W), mode='bilinear')
-                x1 = x.clone()
+                if return_edge:
+                    edge = F.interpolate(edge, size=(H, W), mode='bilinear')
+                x1 = x
             if idx == self.block_idx[1]:
-                x2 = x.clone()
+                x2 = x
             if idx == self.block_idx[2]:
-                x3 = x.clone()
+                x3 = x
             if idx == self.block_idx[3]:
-                x4 = x.clone()
+                x4 = x
 
         return (x1, x2, x3, x4), edge
 
 
     @classmethod
-    def from_name(cls, model_name, in_channels=3, **override_params):
+    def from_name(cls, model_name, in_channels=3, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
             model_name (str): Name for efficientnet.
             in_channels (int): Input data's channel number.
+            cfg (None or config.DummyArgs):
+                TRACER configuration (arch, frequency_radius, gamma).
+                None: the default configuration of the model's scale.
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -279,13 +275,13 @@ class EfficientNet(nn.Module):
         """
         cls._check_model_name_is_valid(model_name)
         blocks_args, global_params = get_model_params(model_name, override_params)
-        model = cls(blocks_args, global_params)
+        model = cls(blocks_args, global_params, cfg if cfg is not None else DummyArgs(model_name[-1]))
         model._change_in_channels(in_channels)
         return model
 
     @classmethod
     def from_pretrained(cls, model_name, weights_path=None, advprop=False,
-                        in_channels=3, num_classes=1000, **override_params):
+                        in_channels=3, num_classes=1000, weights_dir=None, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
@@ -300,6 +296,9 @@ class EfficientNet(nn.Module):
             num_classes (int):
                 Number of categories for classification.
                 It controls the output size for final linear layer.
+            weights_dir (None or str):
+                Local weight store directory used instead of downloading (valid when weights_path is None).
+            cfg (None or config.DummyArgs): TRACER configuration, see from_name.
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -312,8 +311,9 @@ class EfficientNet(nn.Module):
         Returns:
             A pretrained TRACER-EfficientNet model.
         """
-        model = cls.from_name(model_name, num_classes=num_classes, **override_params)
-        load_pretrained_weights(model, model_name, weights_path=weights_path, advprop=advprop)
+        model = cls.from_name(model_name, num_classes=num_classes, cfg=cfg, **override_params)
+        load_pretrained_weights(model, model_name, weights_path=weights_path, advprop=advprop,
+                                weights_dir=weights_dir)
         model._change_in_channels(in_channels)
         return model
 
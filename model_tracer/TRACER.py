@@ -12,10 +12,20 @@ from modules.att_modules import RFB_Block, aggregation, ObjectAttention
 
 
 class TRACER(nn.Module):
-    def __init__(self, cfg):
+    def __init__(self, cfg, pretrained_backbone=True):
+        """
+        Args:
+            cfg: model configuration (see config.DummyArgs).
+            pretrained_backbone: load ImageNet (advprop) backbone weights. Set False when a full TRACER
+                                 checkpoint is loaded afterwards anyway, so each weight is loaded only once.
+        """
         super().__init__()
-        self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True)
-        self.block_idx, self.channels = get_model_shape()
+        if pretrained_backbone:
+            self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True,
+                                                      weights_dir=cfg.weights_dir, cfg=cfg)
+        else:
+            self.model = EfficientNet.from_name(f'efficientnet-b{cfg.arch}', cfg=cfg)
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
 
         # Receptive Field Blocks
         channels = [int(arg_c) for arg_c in cfg.RFB_aggregated_channel]
@@ -24,35 +34,75 @@ class TRACER(nn.Module):
         self.rfb4 = RFB_Block(self.channels[3], channels[2])
 
         # Multi-level aggregation
-        self.agg = aggregation(channels)
+        self.agg = aggregation(channels, gamma=cfg.gamma)
 
         # Object Attention
-        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3)
-        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3)
+        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3, denoise=cfg.denoise)
+        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3, denoise=cfg.denoise)
+        self.low_res_average = cfg.low_res_average
 
-    def forward(self, inputs):
+    def forward(self, inputs, return_aux=True):
+        """
+        Args:
+            inputs: (B, 3, H, W)
+            return_aux: also return the edge map and the deep supervision maps (training and validation).
+                        When False, only the final saliency map (B, 1, H, W) is computed and returned
+                        (averaged at 1/4 resolution with cfg.low_res_average).
+        """
         B, C, H, W = inputs.size()
 
-        # EfficientNet backbone Encoder
-        x = self.model.initial_conv(inputs)
-        features, edge = self.model.get_blocks(x, H, W)
+        # EfficientNet backbone Encoder (the stem output is not kept alive through the blocks)
+        features, edge = self.model.get_blocks(self.model.initial_conv(inputs), H, W, return_aux)
 
         x3_rfb = self.rfb2(features[1])
         x4_rfb = self.rfb3(features[2])
         x5_rfb = self.rfb4(features[3])
 
         D_0 = self.agg(x5_rfb, x4_rfb, x3_rfb)
-
-        ds_map0 = F.interpolate(D_0, scale_factor=8, mode='bilinear')
-
         D_1 = self.ObjectAttention2(D_0, features[1])
-        ds_map1 = F.interpolate(D_1, scale_factor=8, mode='bilinear')
-
         ds_map = F.interpolate(D_1, scale_factor=2, mode='bilinear')
         D_2 = self.ObjectAttention1(ds_map, features[0])
-        ds_map2 = F.interpolate(D_2, scale_factor=4, mode='bilinear')
 
+        if not return_aux:
+            if self.low_res_average:  # average at 1/4 resolution and upsample once (approximation)
+                low_res_map = (F.interpolate(D_0, scale_factor=2, mode='bilinear') + ds_map + D_2) / 3
+                return torch.sigmoid(F.interpolate(low_res_map, scale_factor=4, mode='bilinear'))
+            # bilinear upsampling is linear, so D_0 and D_1 (both at 1/8 resolution) are upsampled together
+            final_map = (F.interpolate(D_2, scale_factor=4, mode='bilinear')
+                         + F.interpolate(D_0 + D_1, scale_factor=8, mode='bilinear')) / 3
+            return torch.sigmoid(final_map)
+
+        ds_map0 = F.interpolate(D_0, scale_factor=8, mode='bilinear')
+        ds_map1 = F.interpolate(D_1, scale_factor=8, mode='bilinear')
+        ds_map2 = F.interpolate(D_2, scale_factor=4, mode='bilinear')
         final_map = (ds_map2 + ds_map1 + ds_map0) / 3
 
         return torch.sigmoid(final_map), torch.sigmoid(edge), \
-               (torch.sigmoid(ds_map0), torch.sigmoid(ds_map1), torch.sigmoid(ds_map2))
\ No newline at end of file
+               (torch.sigmoid(ds_map0), torch.sigmoid(ds_map1), torch.sigmoid(ds_map2))
+
+    def fuse_for_inference(self, branches=True):
+        """Folds every BatchNorm that follows a convolution (backbone stem and MBConvBlocks, BasicConv2d, DWConv,
+        DWSConv) into the convolution weights and bias, in place. With branches, the parallel 1x1 convolutions at the
+        input of each RFB block are then merged into one (RFB_Block.fuse_branches).
+        The model is put in eval mode and can no longer be trained. Returns self."""
+        self.eval()
+        for module in list(self.modules()):
+            if hasattr(module, 'fuse_bn'):
+                module.fuse_bn()
+        if branches:
+            for module in list(self.modules()):
+                if hasattr(module, 'fuse_branches'):
+                    module.fuse_branches()
+        return self
+
+    def set_swish(self, memory_efficient=True):
+        """Sets the backbone swish as memory efficient (custom autograd Function, training only) or native SiLU,
+        which is faster in inference and can be traced. Returns self."""
+        self.model.set_swish(memory_efficient)
+        return self
+
+    def set_onnx_compatible(self, enabled=True):
+        """Replaces the FFT in the Frequency Edge Modules, which has no ONNX export, by an equivalent matmul DFT."""
+        for module in self.modules():
+            if hasattr(module, 'onnx_compatible'):
+                module.onnx_compatible = enabled
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""
+Cascade of a small and a large TRACER behind the TRACER inference interface.
+
+The small model predicts every image. Images whose saliency map has too many pixels in the uncertain band around the
+post-processing threshold are predicted again by the large model.
+"""
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+POST_PROCESSING_THRESHOLD = 200 / 255  # alpha cut of Inference.post_processing
+
+
+def uncertain_fraction(maps, threshold=POST_PROCESSING_THRESHOLD, band=0.15):
+    """Per-image fraction of the pixels of saliency maps (B, 1, H, W) within band of threshold."""
+    return ((maps.float() - threshold).abs() < band).flatten(1).float().mean(1)
+
+
+class CascadeTRACER(nn.Module):
+    """
+    Runs small on every image and large on the images whose uncertain fraction exceeds max_uncertain, as a drop-in
+    for TRACER(inputs, return_aux=False). Inputs come at the input size of large; the small model runs on them
+    resized to small_size (None: as they are). Counts images, escalations and the time of each stage (see report).
+    """
+    def __init__(self, small, large, small_size=None, band=0.15, max_uncertain=0.05,
+                 threshold=POST_PROCESSING_THRESHOLD):
+        super().__init__()
+        self.small = small
+        self.large = large
+        self.small_size = small_size
+        self.band = band
+        self.max_uncertain = max_uncertain
+        self.threshold = threshold
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {'images': 0, 'escalated': 0, 'small_time': 0.0, 'large_time': 0.0}
+
+    def forward(self, inputs, return_aux=False):
+        if return_aux:
+            raise ValueError('cascade TRACER models only return the final saliency map')
+        H, W = inputs.shape[-2:]
+
+        t = self._clock(inputs)
+        small_inputs = inputs
+        if self.small_size is not None and (H, W) != (self.small_size, self.small_size):
+            small_inputs = F.interpolate(inputs, size=(self.small_size, self.small_size), mode='bilinear',
+                                         antialias=True)
+        outputs = self.small(small_inputs, return_aux=False)
+        if outputs.shape[-2:] != (H, W):
+            outputs = F.interpolate(outputs, size=(H, W), mode='bilinear')
+        escalate = uncertain_fraction(outputs, self.threshold, self.band) > self.max_uncertain
+        self.counters['small_time'] += self._clock(inputs) - t
+
+        if escalate.any():
+            t = self._clock(inputs)
+            outputs[escalate] = self.large(inputs[escalate], return_aux=False).to(outputs.dtype)
+            self.counters['large_time'] += self._clock(inputs) - t
+
+        self.counters['images'] += inputs.size(0)
+        self.counters['escalated'] += int(escalate.sum())
+        return outputs
+
+    @staticmethod
+    def _clock(inputs):
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def report(self):
+        """Prints the per-stage counters and the throughput against running the large model on every image
+        (estimated from the per-image time of the large stage)."""
+        images, escalated = self.counters['images'], self.counters['escalated']
+        small_time, large_time = self.counters['small_time'], self.counters['large_time']
+        if images == 0:
+            print('cascade: no images')
+            return
+        total = small_time + large_time
+        print(f'{"stage":>8} {"images":>7} {"share":>7} {"time(s)":>8} {"ms/image":>9}')
+        print(f'{"small":>8} {images:>7} {1:>7.1%} {small_time:>8.2f} {small_time / images * 1000:>9.2f}')
+        large_per_image = large_time / escalated if escalated else float('nan')
+        print(f'{"large":>8} {escalated:>7} {escalated / images:>7.1%} {large_time:>8.2f} '
+              f'{large_per_image * 1000:>9.2f}')
+        print(f'{"cascade":>8} {images:>7} {"":>7} {total:>8.2f} {total / images * 1000:>9.2f}')
+        if escalated:
+            large_only = large_per_image * images
+            print(f'throughput: {images / total:.2f} images/s, large model only (estimated): '
+                  f'{images / large_only:.2f} images/s, cascade speedup: {large_only / total:.2f}x')
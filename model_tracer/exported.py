@@ -0,0 +1,78 @@
+"""
+Exported TRACER artifacts (see export.py) behind the TRACER inference interface.
+"""
+import zipfile
+import torch
+import torch.nn as nn
+
+QUANTIZED_ENGINE_FILE = 'quantized_engine'  # extra file of int8 TorchScript artifacts (quantize.py)
+
+
+class TRACERPredictor(nn.Module):
+    """Inference-only view of TRACER used for export: (B, 3, H, W) -> saliency map (B, 1, H, W)."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs):
+        return self.model(inputs, return_aux=False)
+
+
+class ScriptedTRACER(nn.Module):
+    """Runs a frozen TorchScript artifact as a drop-in for TRACER(inputs, return_aux=False)."""
+    def __init__(self, path, device):
+        super().__init__()
+        engine = read_extra_file(path, QUANTIZED_ENGINE_FILE)
+        previous_engine = torch.backends.quantized.engine
+        if engine is not None:
+            # int8 weights are packed for the quantized engine when the artifact is loaded and keep it afterwards,
+            # so the process-wide engine is only switched while loading
+            torch.backends.quantized.engine = engine
+        try:
+            self.model = torch.jit.load(path, map_location=device)
+        finally:
+            torch.backends.quantized.engine = previous_engine
+        if device.type == 'cpu' and engine is None:
+            # oneDNN weight layouts; applied after loading because they are not serializable
+            self.model = torch.jit.optimize_for_inference(self.model)
+
+    def forward(self, inputs, return_aux=False):
+        if return_aux:
+            raise ValueError('exported TRACER models only return the final saliency map')
+        return self.model(inputs)
+
+
+class OnnxTRACER(nn.Module):
+    """Runs an ONNX artifact with onnxruntime's CPU provider as a drop-in for TRACER(inputs, return_aux=False)."""
+    def __init__(self, path, num_threads=None):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, inputs, return_aux=False):
+        if return_aux:
+            raise ValueError('exported TRACER models only return the final saliency map')
+        outputs = self.session.run(None, {self.input_name: inputs.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(outputs).to(inputs.device)
+
+
+def read_extra_file(path, name):
+    """Reads an extra file of a TorchScript archive without deserializing the model, or returns None."""
+    with zipfile.ZipFile(path) as archive:
+        for entry in archive.namelist():
+            if entry.endswith(f'/extra/{name}'):
+                return archive.read(entry).decode()
+    return None
+
+
+def load_exported(path, device, num_threads=None):
+    """Loads an artifact of export.py: ONNX (.onnx) with onnxruntime, otherwise TorchScript."""
+    if path.endswith('.onnx'):
+        return OnnxTRACER(path, num_threads)
+    return ScriptedTRACER(path, device)
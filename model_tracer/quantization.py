@@ -0,0 +1,71 @@
+"""
+Post-training static int8 quantization of the TRACER convolution stacks (see quantize.py).
+
+Each quantized stack is an FX graph with its own quantize/dequantize at the boundaries, so the attention modules
+(Frequency Edge Module, Union Attention, Object Attention softmaxes) keep running in fp32 between them.
+"""
+import copy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# fbgemm (and the x86 engine built on it) runs the depthwise convolutions of EfficientNet far slower than fp32
+DEFAULT_ENGINE = 'onednn'
+
+
+class QuantizedStack(nn.Module):
+    """Traced in place of a target to keep the call signature of MBConvBlock (drop_connect_rate is unused at
+    inference)."""
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x, drop_connect_rate=None):
+        return self.module(x)
+
+
+def quantization_targets(model):
+    """(parent, name) of the stacks quantized to int8: backbone MBConvBlocks, RFB blocks, the convolutions of the
+    aggregation decoder and the DWConv/DWSConv layers of the Object Attention decoders."""
+    targets = [(model.model._blocks, str(idx)) for idx in range(len(model.model._blocks))]
+    targets += [(model, name) for name in ['rfb2', 'rfb3', 'rfb4']]
+    targets += [(model.agg, name) for name in ['conv_upsample1', 'conv_upsample2', 'conv_upsample3', 'conv_upsample4',
+                                               'conv_upsample5', 'conv_concat2', 'conv_concat3']]
+    for decoder in [model.ObjectAttention2, model.ObjectAttention1]:
+        targets += [(decoder, name) for name in ['DWSConv', 'DWConv1', 'DWConv2', 'DWConv3', 'DWConv4']]
+    return targets
+
+
+def prepare_int8(model, engine=DEFAULT_ENGINE):
+    """Returns a copy of an eval TRACER with observers in the quantization targets, to be run on calibration data."""
+    torch.backends.quantized.engine = engine
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    model = copy.deepcopy(model).fuse_for_inference(branches=False)  # the targets keep their per-branch layers
+    model.model.set_swish(memory_efficient=False)  # the custom autograd Function cannot be traced
+
+    for parent, name in quantization_targets(model):
+        module = QuantizedStack(getattr(parent, name))
+        example = torch.randn(1, first_conv(module).in_channels, 8, 8)
+        setattr(parent, name, prepare_fx(module, qconfig_mapping, (example,)))
+    return model
+
+
+def convert_int8(model):
+    """Converts the calibrated targets of prepare_int8 to int8 in place."""
+    for parent, name in quantization_targets(model):
+        setattr(parent, name, convert_fx(getattr(parent, name)))
+    return model
+
+
+def quantize_int8(model, calibration_batches, engine=DEFAULT_ENGINE):
+    """Static post-training quantization: observes activation ranges on calibration_batches (B, 3, H, W)."""
+    model = prepare_int8(model, engine)
+    with torch.no_grad():
+        for images in calibration_batches:
+            model(images, return_aux=False)
+    return convert_int8(model)
+
+
+def first_conv(module):
+    return next(m for m in module.modules() if isinstance(m, nn.Conv2d))
@@ -0,0 +1,118 @@
+"""
+Tiled high-resolution inference: a global pass at img_size plus overlapping img_size tiles of the original image.
+
+The tiles keep the detail that resizing a large image to img_size throws away. They run in batches of a fixed size,
+so the memory of the forward passes does not grow with the image size. Tile maps are blended with weights that ramp
+down over the overlaps and with the global map, which also fills in the tiles that are skipped because the global map
+is already confident there.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+from model_tracer.cascade import POST_PROCESSING_THRESHOLD
+from util.utils import autocast
+
+
+def tile_starts(length, size, overlap):
+    """Start offsets of tiles of size covering [0, length) with at least the overlap fraction between neighbours."""
+    stride = max(int(size * (1 - overlap)), 1)
+    starts = list(range(0, length - size + 1, stride))
+    if starts[-1] != length - size:
+        starts.append(length - size)
+    return starts
+
+
+def blend_ramp(start, size, length, ramp):
+    """1-D blending weights of a tile: linear ramps of ramp pixels on the sides that are not on the image border."""
+    weight = torch.ones(size)
+    ramp = min(ramp, size // 2)
+    if ramp > 0:
+        up = torch.arange(1, ramp + 1, dtype=torch.float32) / (ramp + 1)
+        if start > 0:
+            weight[:ramp] = up
+        if start + size < length:
+            weight[-ramp:] = up.flip(0)
+    return weight
+
+
+def salient_object(image, mask, threshold=200):
+    """RGBA salient object (H, W, 4) of an RGB image: transparent where the uint8 mask is <= threshold."""
+    rgba = np.concatenate([image, np.full(image.shape[:2] + (1,), 255, dtype=np.uint8)], axis=2)
+    rgba[mask <= threshold, 3] = 0
+    return rgba
+
+
+class TiledPredictor():
+    """
+    Saliency maps at the original resolution of RGB images (H, W, 3), from any TRACER(inputs, return_aux=False).
+
+    Args:
+        transform: test transform of the model (dataloader.get_test_augmentation(img_size)).
+        img_size: input size of the model, used for the global pass and as the tile size.
+        overlap: minimum overlap fraction of neighbouring tiles.
+        batch_size: tiles per forward pass.
+        band: only tiles where the global map has pixels within band of the post-processing threshold are predicted
+              (None: every tile).
+        global_weight: blending weight of the global map against the weight 1 of a tile centre.
+    """
+    def __init__(self, model, transform, img_size, device, memory_format=torch.contiguous_format, precision='fp32',
+                 overlap=0.25, batch_size=4, band=0.15, global_weight=0.25):
+        self.model = model
+        self.img_size = img_size
+        self.device = device
+        self.memory_format = memory_format
+        self.precision = precision
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.band = band
+        self.global_weight = global_weight
+        self.transform = transform
+        self.counters = {'images': 0, 'tiles': 0, 'skipped_tiles': 0}
+
+    def forward(self, crops):
+        """Saliency maps (h, w) on the CPU of RGB crops, each resized to img_size for the model and back."""
+        inputs = torch.stack([self.transform(image=crop)['image'] for crop in crops])
+        with torch.no_grad():
+            inputs = inputs.to(self.device, dtype=torch.float32, memory_format=self.memory_format)
+            with autocast(self.device, self.precision):
+                outputs = self.model(inputs, return_aux=False).float()
+            return [F.interpolate(outputs[i].unsqueeze(0), size=crop.shape[:2], mode='bilinear')[0, 0].cpu()
+                    for i, crop in enumerate(crops)]
+
+    def boxes(self, height, width, global_map):
+        """(top, left, tile height, tile width) of the tiles to predict."""
+        tile_h, tile_w = min(self.img_size, height), min(self.img_size, width)
+        boxes = [(top, left, tile_h, tile_w) for top in tile_starts(height, tile_h, self.overlap)
+                 for left in tile_starts(width, tile_w, self.overlap)]
+        if self.band is None:
+            return boxes
+        uncertain = (global_map - POST_PROCESSING_THRESHOLD).abs() < self.band
+        selected = [box for box in boxes if uncertain[box[0]:box[0] + box[2], box[1]:box[1] + box[3]].any()]
+        self.counters['skipped_tiles'] += len(boxes) - len(selected)
+        return selected
+
+    def predict(self, image):
+        """Saliency map (H, W) in [0, 1] of an RGB image (H, W, 3)."""
+        height, width = image.shape[:2]
+        global_map = self.forward([image])[0]
+        self.counters['images'] += 1
+        if height <= self.img_size and width <= self.img_size:  # the global pass is already at full resolution
+            return global_map
+
+        blended = global_map * self.global_weight
+        weights = torch.full_like(global_map, self.global_weight)
+        ramp = int(self.img_size * self.overlap)
+        boxes = self.boxes(height, width, global_map)
+        for start in range(0, len(boxes), self.batch_size):
+            batch = boxes[start:start + self.batch_size]
+            maps = self.forward([image[top:top + h, left:left + w] for top, left, h, w in batch])
+            for (top, left, h, w), tile_map in zip(batch, maps):
+                weight = torch.outer(blend_ramp(top, h, height, ramp), blend_ramp(left, w, width, ramp))
+                blended[top:top + h, left:left + w] += weight * tile_map
+                weights[top:top + h, left:left + w] += weight
+        self.counters['tiles'] += len(boxes)
+        return blended / weights
+
+    def predict_mask(self, image):
+        """uint8 mask (H, W) of an RGB image (H, W, 3)."""
+        return (self.predict(image).numpy() * 255.0).astype(np.uint8)
@@ -0,0 +1,177 @@
+"""
+Video and frame-sequence inference with temporal reuse.
+
+Frames are decoded with OpenCV (a video file through cv2.VideoCapture, or a directory of frames in name order) and
+predicted in batches. Only keyframes run the model: a frame becomes a keyframe when its size differs from the last
+keyframe or the mean absolute difference of its thumbnail from the thumbnail of the last keyframe reaches the
+tolerance, otherwise it reuses the keyframe mask. A batch is flushed early when the next keyframe has another input
+shape (letterbox: another padded size).
+"""
+import os
+import cv2
+import glob
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from dataloader import letterbox_size, padded_size
+from util.utils import autocast
+
+
+def read_frames(source):
+    """
+    Returns (frames, fps) of a video file or a directory of frames: a generator of RGB frames (H, W, 3) and the frame
+    rate of the video (None for a directory).
+    """
+    if os.path.isdir(source):
+        paths = sorted(glob.glob(os.path.join(source, '*')))
+        return (cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in paths), None
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f'Cannot open video {source}')
+    fps = capture.get(cv2.CAP_PROP_FPS) or None
+
+    def frames():
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        finally:
+            capture.release()
+
+    return frames(), fps
+
+
+class MaskWriter():
+    """Writes uint8 masks (H, W) as a video (.mp4/.avi path) or as numbered PNG files of a directory."""
+    def __init__(self, path, fps=None):
+        self.path = path
+        self.fps = fps or 25.0
+        self.writer = None
+        self.index = 0
+        if not self.is_video:
+            os.makedirs(path, exist_ok=True)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @property
+    def is_video(self):
+        return os.path.splitext(self.path)[1].lower() in ('.mp4', '.avi')
+
+    def write(self, mask):
+        if not self.is_video:
+            cv2.imwrite(os.path.join(self.path, f'{self.index:06d}.png'), mask)
+        else:
+            if self.writer is None:
+                fourcc = cv2.VideoWriter_fourcc(*('mp4v' if self.path.lower().endswith('.mp4') else 'MJPG'))
+                self.writer = cv2.VideoWriter(self.path, fourcc, self.fps, (mask.shape[1], mask.shape[0]))
+            self.writer.write(cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR))
+        self.index += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+class VideoPredictor():
+    """
+    uint8 masks of a frame sequence from any TRACER(inputs, return_aux=False), reusing the mask of the last keyframe
+    for the frames that barely differ from it.
+
+    Args:
+        transform: test transform of the model (dataloader.get_test_augmentation or get_letterbox_augmentation).
+        img_size: input size of the model.
+        letterbox: the transform is the letterbox one (the stride padding is cropped off the outputs).
+        batch_size: keyframes per forward pass.
+        tolerance: mean absolute difference (0-255) of the thumbnails from which a frame is a keyframe
+                   (0: every frame is predicted).
+        thumbnail: width of the thumbnails the frames are compared on.
+        max_pending: frames held back at most while a batch of keyframes fills up.
+    """
+    def __init__(self, model, transform, img_size, device, memory_format=torch.contiguous_format, precision='fp32',
+                 letterbox=False, batch_size=4, tolerance=2.0, thumbnail=64, max_pending=32):
+        self.model = model
+        self.transform = transform
+        self.img_size = img_size
+        self.device = device
+        self.memory_format = memory_format
+        self.precision = precision
+        self.letterbox = letterbox
+        self.batch_size = batch_size
+        self.tolerance = tolerance
+        self.thumbnail = thumbnail
+        self.max_pending = max(max_pending, batch_size)
+        self.counters = {'frames': 0, 'keyframes': 0, 'time': 0.0}
+
+    def forward(self, frames):
+        """uint8 masks (H, W) of RGB frames."""
+        inputs = torch.stack([self.transform(image=frame)['image'] for frame in frames])
+        with torch.no_grad():
+            inputs = inputs.to(self.device, dtype=torch.float32, memory_format=self.memory_format)
+            with autocast(self.device, self.precision):
+                outputs = self.model(inputs, return_aux=False).float()
+
+            masks = []
+            for output, frame in zip(outputs, frames):
+                h, w = frame.shape[:2]
+                if self.letterbox:  # crop the stride padding off before resizing back
+                    rows, cols = letterbox_size(h, w, self.img_size)
+                    output = output[:, :rows, :cols]
+                output = F.interpolate(output.unsqueeze(0), size=(h, w), mode='bilinear')
+                masks.append((output.squeeze().cpu().numpy() * 255.0).astype(np.uint8))
+        return masks
+
+    def input_shape(self, frame):
+        """(rows, cols) of the model input of a frame."""
+        if self.letterbox:
+            return padded_size(*frame.shape[:2], self.img_size)
+        return self.img_size, self.img_size
+
+    def make_thumbnail(self, frame):
+        h, w = frame.shape[:2]
+        size = (self.thumbnail, max(round(self.thumbnail * h / w), 1))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def predict(self, frames):
+        """Yields (frame, mask) for each RGB frame of an iterable, in order."""
+        t = time.perf_counter()
+        pending, keyframes = [], []  # pending: (frame, index of its keyframe in keyframes, -1: previous batch)
+        key_frame, key_thumbnail, last_mask = None, None, None
+        for frame in frames:
+            thumbnail = self.make_thumbnail(frame)
+            if key_frame is None or frame.shape != key_frame.shape or \
+                    np.abs(thumbnail - key_thumbnail).mean() >= self.tolerance:
+                if keyframes and self.input_shape(frame) != self.input_shape(keyframes[0]):
+                    # the inputs of a batch are stacked, so they need one shape
+                    last_mask = yield from self._flush(pending, keyframes, last_mask, t)
+                    pending, keyframes = [], []
+                    t = time.perf_counter()
+                key_frame, key_thumbnail = frame, thumbnail
+                keyframes.append(frame)
+            pending.append((frame, len(keyframes) - 1))
+
+            if len(keyframes) == self.batch_size or len(pending) >= self.max_pending:
+                last_mask = yield from self._flush(pending, keyframes, last_mask, t)
+                pending, keyframes = [], []
+                t = time.perf_counter()
+        yield from self._flush(pending, keyframes, last_mask, t)
+
+    def _flush(self, pending, keyframes, last_mask, t):
+        masks = self.forward(keyframes) if keyframes else []
+        self.counters['frames'] += len(pending)
+        self.counters['keyframes'] += len(keyframes)
+        self.counters['time'] += time.perf_counter() - t  # decoding and prediction, not the consumer
+        for frame, key in pending:
+            yield frame, masks[key] if key >= 0 else last_mask
+        return masks[-1] if masks else last_mask
+
+    def report(self):
+        frames, keyframes, elapsed = self.counters['frames'], self.counters['keyframes'], self.counters['time']
+        if frames == 0:
+            print('video: no frames')
+            return
+        print(f'video: {frames} frames, {keyframes} predicted, {frames - keyframes} skipped '
+              f'({(frames - keyframes) / frames:.1%}), {frames / elapsed:.2f} fps')
@@ -1,23 +1,24 @@
 """
 author: Min Seok Lee and Wooseok Shin
 """
-import numpy as np
+import math
 import torch.nn as nn
-from torch.fft import fft2, fftshift, ifft2, ifftshift
+from torch.fft import fft2, ifft2, ifftshift, rfft2, irfft2
 from util.utils import *
 import torch.nn.functional as F
-from config import getConfig
-from modules.conv_modules import BasicConv2d, DWConv, DWSConv
+from modules.conv_modules import BasicConv2d, DWConv, DWSConv, merge_basic_convs
 
 
-cfg = getConfig()
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
 class Frequency_Edge_Module(nn.Module):
-    def __init__(self, radius, channel):
+    def __init__(self, radius, channel, gamma=0.1):
         super(Frequency_Edge_Module, self).__init__()
         self.radius = radius
-        self.UAM = UnionAttentionModule(channel, only_channel_tracing=True)
+        self.mask_cache = {}  # (rows, cols, radius, device) -> radial mask
+        self.high_pass_cache = {}  # (rows, cols, radius, device, rfft) -> high-pass filter in unshifted frequency order
+        self.dft_cache = {}  # (rows, cols, radius, device) -> DFT bases of the low frequencies (ONNX export)
+        self.real_fft = True
+        self.onnx_compatible = False  # FFT-free high-pass, see TRACER.set_onnx_compatible
+        self.UAM = UnionAttentionModule(channel, only_channel_tracing=True, gamma=gamma)
 
         # DWS + DWConv
         self.DWSConv = DWSConv(channel, channel, kernel=3, padding=1, kernels_per_layer=1)
@@ -39,20 +40,80 @@ class Frequency_Edge_Module(nn.Module):
         )
         self.conv = BasicConv2d(channel, 1, 1)
 
-    def distance(self, i, j, imageSize, r):
-        dis = np.sqrt((i - imageSize / 2) ** 2 + (j - imageSize / 2) ** 2)
-        if dis < r:
-            return 1.0
-        else:
-            return 0
-
     def mask_radial(self, img, r):
+        """Radial mask (1 inside radius r around the centre of the shifted spectrum), cached per shape and device."""
+        batch, channels, rows, cols = img.shape
+        key = (rows, cols, r, img.device)
+        if key not in self.mask_cache:
+            i = torch.arange(rows, dtype=torch.float64).unsqueeze(1)
+            j = torch.arange(cols, dtype=torch.float64).unsqueeze(0)
+            dis = torch.sqrt((i - rows / 2) ** 2 + (j - rows / 2) ** 2)
+            self.mask_cache[key] = (dis < r).to(device=img.device, dtype=torch.float32)
+        return self.mask_cache[key]
+
+    def rfft_applicable(self, rows, cols):
+        # The radial mask is centred on rows / 2 along both axes, so it is symmetric under f -> -f (and the filtered
+        # spectrum of a real input stays Hermitian) only for square maps of even size.
+        return self.real_fft and rows == cols and rows % 2 == 0
+
+    def high_pass_filter(self, img, r):
+        """(1 - radial mask) moved to unshifted frequency order, so neither fftshift nor ifftshift is needed.
+        Only the non-redundant half (cols // 2 + 1) is kept when the rfft path applies."""
+        batch, channels, rows, cols = img.shape
+        key = (rows, cols, r, img.device, self.rfft_applicable(rows, cols))
+        if key not in self.high_pass_cache:
+            high_pass = ifftshift(1 - self.mask_radial(img, r))
+            if self.rfft_applicable(rows, cols):
+                high_pass = high_pass[:, :cols // 2 + 1].contiguous()
+            self.high_pass_cache[key] = high_pass
+        return self.high_pass_cache[key]
+
+    def high_pass(self, x):
+        """|IFFT(FFT(x) * high-pass filter)| over the spatial dimensions."""
+        rows, cols = x.shape[-2:]
+        high_pass = self.high_pass_filter(x, self.radius)
+        if self.rfft_applicable(rows, cols):
+            x_fft = rfft2(x, dim=(-2, -1))
+            x_fft.mul_(high_pass)
+            return torch.abs(irfft2(x_fft, s=(rows, cols), dim=(-2, -1)))
+
+        x_fft = fft2(x, dim=(-2, -1))
+        x_fft.mul_(high_pass)
+        return torch.abs(ifft2(x_fft, dim=(-2, -1)))
+
+    def low_pass_dft_bases(self, img, r):
+        """Real DFT bases (cos, sin) restricted to the rows/columns of frequencies kept by the radial mask,
+        and the mask over those frequencies."""
         batch, channels, rows, cols = img.shape
-        mask = torch.zeros((rows, cols), dtype=torch.float32)
-        for i in range(rows):
-            for j in range(cols):
-                mask[i, j] = self.distance(i, j, imageSize=rows, r=r)
-        return mask
+        rows, cols = int(rows), int(cols)  # sizes are traced as tensors during ONNX export
+        key = (rows, cols, r, img.device)
+        if key not in self.dft_cache:
+            mask = ifftshift(self.mask_radial(img, r))  # unshifted frequency order, 1 = low frequency
+            k_y = torch.nonzero(mask.sum(1)).flatten()
+            k_x = torch.nonzero(mask.sum(0)).flatten()
+            angle_y = 2 * math.pi * torch.outer(k_y, torch.arange(rows, device=img.device)).double() / rows
+            angle_x = 2 * math.pi * torch.outer(k_x, torch.arange(cols, device=img.device)).double() / cols
+            bases = [torch.cos(angle_y), torch.sin(angle_y), torch.cos(angle_x), torch.sin(angle_x)]
+            self.dft_cache[key] = [basis.float() for basis in bases] + [mask[k_y][:, k_x] / (rows * cols)]
+        return self.dft_cache[key]
+
+    def high_pass_dft(self, x):
+        """Same result as high_pass without FFT operators (which have no ONNX export): the few low frequencies are
+        computed with matmuls against the DFT bases and subtracted, |x - IDFT(DFT(x) * mask)|."""
+        cos_y, sin_y, cos_x, sin_x, mask = self.low_pass_dft_bases(x, self.radius)
+
+        # DFT(x) = (cos_y - i sin_y) x (cos_x - i sin_x)^T at the kept frequencies
+        p, q = torch.matmul(cos_y, x), torch.matmul(sin_y, x)
+        real = (torch.matmul(p, cos_x.t()) - torch.matmul(q, sin_x.t())) * mask
+        imag = -(torch.matmul(p, sin_x.t()) + torch.matmul(q, cos_x.t())) * mask
+
+        # IDFT = (cos_y + i sin_y)^T Z (cos_x + i sin_x)
+        u_real = torch.matmul(cos_y.t(), real) - torch.matmul(sin_y.t(), imag)
+        u_imag = torch.matmul(cos_y.t(), imag) + torch.matmul(sin_y.t(), real)
+        low_real = torch.matmul(u_real, cos_x) - torch.matmul(u_imag, sin_x)
+        low_imag = torch.matmul(u_real, sin_x) + torch.matmul(u_imag, cos_x)
+
+        return torch.sqrt((x - low_real) ** 2 + low_imag ** 2)
 
     def forward(self, x):
         """
@@ -61,19 +122,16 @@ class Frequency_Edge_Module(nn.Module):
         Returns:
             Edge refined representation: X + edge (B, C, H, W)
         """
-        x_fft = fft2(x, dim=(-2, -1))
-        x_fft = fftshift(x_fft)
-
-        # Mask -> low, high separate
-        mask = self.mask_radial(img=x, r=self.radius).to(device)
-        high_frequency = x_fft * (1 - mask)
-        x_fft = ifftshift(high_frequency)
-        x_fft = ifft2(x_fft, dim=(-2, -1))
-        x_H = torch.abs(x_fft)
+        # Mask -> low, high separate (in fp32 under bfloat16 autocast)
+        if self.onnx_compatible:
+            x_H = self.high_pass_dft(x.float())
+        else:
+            x_H = self.high_pass(x.float())
+        x_H = x_H.to(x.dtype, memory_format=memory_format_of(x))  # the FFT returns NCHW for channels_last inputs
 
         x_H, _ = self.UAM.Channel_Tracer(x_H)
         edge_maks = self.DWSConv(x_H)
-        skip = edge_maks.clone()
+        skip = edge_maks
 
         edge_maks = torch.cat([self.DWConv1(edge_maks), self.DWConv2(edge_maks),
                                self.DWConv3(edge_maks), self.DWConv4(edge_maks)], dim=1) + skip
@@ -84,6 +142,7 @@ class Frequency_Edge_Module(nn.Module):
         return x, edge
 
 
+
 class RFB_Block(nn.Module):
     def __init__(self, in_channel, out_channel):
         super(RFB_Block, self).__init__()
@@ -111,18 +170,34 @@ class RFB_Block(nn.Module):
         )
         self.conv_cat = BasicConv2d(4 * out_channel, out_channel, 3, padding=1)
         self.conv_res = BasicConv2d(in_channel, out_channel, 1)
+        self.out_channel = out_channel
+        self.heads = None  # first 1x1 convolutions of the branches and conv_res in one, see fuse_branches
 
     def forward(self, x):
-        x0 = self.branch0(x)
-        x1 = self.branch1(x)
-        x2 = self.branch2(x)
-        x3 = self.branch3(x)
+        if self.heads is None:
+            x0 = x1 = x2 = x3 = x_res = x
+        else:
+            x0, x1, x2, x3, x_res = torch.split(self.heads(x), self.out_channel, dim=1)
+        x0 = self.branch0(x0)
+        x1 = self.branch1(x1)
+        x2 = self.branch2(x2)
+        x3 = self.branch3(x3)
         x_cat = torch.cat((x0, x1, x2, x3), 1)
         x_cat = self.conv_cat(x_cat)
 
-        x = self.relu(x_cat + self.conv_res(x))
+        x = self.relu(x_cat + self.conv_res(x_res))
         return x
 
+    def fuse_branches(self):
+        """Runs the five 1x1 convolutions over the block input (first layer of each branch and conv_res) as one
+        wider convolution whose output is split between the branches. Requires fuse_bn."""
+        if self.heads is not None:
+            return
+        self.heads = merge_basic_convs([self.branch0[0], self.branch1[0], self.branch2[0], self.branch3[0],
+                                        self.conv_res])
+        self.branch0[0], self.branch1[0], self.branch2[0], self.branch3[0] = (nn.Identity() for _ in range(4))
+        self.conv_res = nn.Identity()
+
 
 class GlobalAvgPool(nn.Module):
     def __init__(self, flatten=False):
@@ -138,10 +213,10 @@ class GlobalAvgPool(nn.Module):
 
 
 class UnionAttentionModule(nn.Module):
-    def __init__(self, n_channels, only_channel_tracing=False):
+    def __init__(self, n_channels, only_channel_tracing=False, gamma=0.1):
         super(UnionAttentionModule, self).__init__()
         self.GAP = GlobalAvgPool()
-        self.confidence_ratio = cfg.gamma
+        self.confidence_ratio = gamma
         self.bn = nn.BatchNorm2d(n_channels)
         self.norm = nn.Sequential(
             nn.BatchNorm2d(n_channels),
@@ -166,13 +241,21 @@ class UnionAttentionModule(nn.Module):
                                        padding=0, bias=False)
         self.sigmoid = nn.Sigmoid()
 
+    def quantile_threshold(self, mask):
+        """torch.quantile(mask, confidence_ratio, dim=-1, keepdim=True) from a partial selection of the smallest
+        values (TopK) instead of a full sort, bit-identical to quantile and exportable to ONNX."""
+        # same rank and weight rounding as torch.quantile: q in the input dtype, rank in double precision
+        rank = torch.tensor(self.confidence_ratio, dtype=mask.dtype).item() * (mask.size(-1) - 1)
+        below, above = int(math.floor(rank)), int(math.ceil(rank))
+        values = torch.topk(mask, above + 1, dim=-1, largest=False, sorted=True).values
+        weight = torch.tensor(rank - below, dtype=mask.dtype, device=mask.device)
+        return torch.lerp(values[..., below:below + 1], values[..., above:above + 1], weight)
+
     def masking(self, x, mask):
-        mask = mask.squeeze(3).squeeze(2)
-        threshold = torch.quantile(mask, self.confidence_ratio, dim=-1, keepdim=True)
-        mask[mask <= threshold] = 0.0
-        mask = mask.unsqueeze(2).unsqueeze(3)
-        mask = mask.expand(-1, x.shape[1], x.shape[2], x.shape[3]).contiguous()
-        masked_x = x * mask
+        mask = mask.squeeze(3).squeeze(2).float()  # fp32 threshold under bfloat16 autocast
+        threshold = self.quantile_threshold(mask)
+        mask = mask.masked_fill(mask <= threshold, 0.0).unsqueeze(2).unsqueeze(3)
+        masked_x = x * mask.to(x.dtype)  # broadcast over (H, W) keeps the memory format of x
 
         return masked_x
 
@@ -186,7 +269,7 @@ class UnionAttentionModule(nn.Module):
 
         # softmax(Q*K^T)
         QK_T = torch.matmul(q, k.transpose(1, 2))
-        alpha = F.softmax(QK_T, dim=-1)
+        alpha = F.softmax(QK_T.float(), dim=-1)  # fp32 under bfloat16 autocast
 
         # a*v
         att = torch.matmul(alpha, v).unsqueeze(-1)
@@ -194,9 +277,8 @@ class UnionAttentionModule(nn.Module):
         att = self.sigmoid(att)
 
         output = (x * att) + x
-        alpha_mask = att.clone()
 
-        return output, alpha_mask
+        return output, att  # masking does not modify the mask in place
 
     def forward(self, x):
         X_c, alpha_mask = self.Channel_Tracer(x)
@@ -209,7 +291,7 @@ class UnionAttentionModule(nn.Module):
 
         # softmax(Q*K^T)
         QK_T = torch.matmul(q, k.transpose(1, 2))
-        alpha = F.softmax(QK_T, dim=-1)
+        alpha = F.softmax(QK_T.float(), dim=-1)  # fp32 under bfloat16 autocast
 
         output = torch.matmul(alpha, v).unsqueeze(1) + v.unsqueeze(1)
 
@@ -217,7 +299,7 @@ class UnionAttentionModule(nn.Module):
 
 
 class aggregation(nn.Module):
-    def __init__(self, channel):
+    def __init__(self, channel, gamma=0.1):
         super(aggregation, self).__init__()
         self.relu = nn.ReLU(True)
 
@@ -232,15 +314,15 @@ class aggregation(nn.Module):
         self.conv_concat3 = BasicConv2d((channel[0] + channel[1] + channel[2]),
                                         (channel[0] + channel[1] + channel[2]), 3, padding=1)
 
-        self.UAM = UnionAttentionModule(channel[0] + channel[1] + channel[2])
+        self.UAM = UnionAttentionModule(channel[0] + channel[1] + channel[2], gamma=gamma)
 
     def forward(self, e4, e3, e2):
-        e4_1 = e4
-        e3_1 = self.conv_upsample1(self.upsample(e4)) * e3
-        e2_1 = self.conv_upsample2(self.upsample(self.upsample(e4))) \
+        e4_up = self.upsample(e4)  # reused by conv_upsample1, conv_upsample2 and conv_upsample4
+        e3_1 = self.conv_upsample1(e4_up) * e3
+        e2_1 = self.conv_upsample2(self.upsample(e4_up)) \
                * self.conv_upsample3(self.upsample(e3)) * e2
 
-        e3_2 = torch.cat((e3_1, self.conv_upsample4(self.upsample(e4_1))), 1)
+        e3_2 = torch.cat((e3_1, self.conv_upsample4(e4_up)), 1)
         e3_2 = self.conv_concat2(e3_2)
 
         e2_2 = torch.cat((e2_1, self.conv_upsample5(self.upsample(e3_2))), 1)
@@ -252,9 +334,10 @@ class aggregation(nn.Module):
 
 
 class ObjectAttention(nn.Module):
-    def __init__(self, channel, kernel_size):
+    def __init__(self, channel, kernel_size, denoise=0.93):
         super(ObjectAttention, self).__init__()
         self.channel = channel
+        self.denoise = denoise
         self.DWSConv = DWSConv(channel, channel // 2, kernel=kernel_size, padding=1, kernels_per_layer=1)
         self.DWConv1 = nn.Sequential(
             DWConv(channel // 2, channel // 2, kernel=1, padding=0, dilation=1),
@@ -282,16 +365,15 @@ class ObjectAttention(nn.Module):
         Returns:
             decoder representation: (B, 1, H, W)
         """
-        mask_bg = -1 * torch.sigmoid(decoder_map) + 1  # Sigmoid & Reverse
         mask_ob = torch.sigmoid(decoder_map)  # object attention
-        x = mask_ob.expand(-1, self.channel, -1, -1).mul(encoder_map)
+        mask_bg = -1 * mask_ob + 1  # Sigmoid & Reverse
+        x = mask_ob * encoder_map  # broadcast over the channels
 
-        edge = mask_bg.clone()
-        edge[edge > cfg.denoise] = 0
+        edge = mask_bg.masked_fill(mask_bg > self.denoise, 0)
         x = x + (edge * encoder_map)
 
         x = self.DWSConv(x)
-        skip = x.clone()
+        skip = x
         x = torch.cat([self.DWConv1(x), self.DWConv2(x), self.DWConv3(x), self.DWConv4(x)], dim=1) + skip
         x = torch.relu(self.conv1(x))
 
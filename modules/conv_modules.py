@@ -1,7 +1,17 @@
 """
 author: Min Seok Lee and Wooseok Shin
 """
+import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fuse_conv_bn(conv, bn):
+    """Returns (conv, bn) with an eval-mode BatchNorm folded into the weights and bias of the preceding conv,
+    and replaced by an identity."""
+    if isinstance(bn, nn.Identity):  # already fused
+        return conv, bn
+    return fuse_conv_bn_eval(conv, bn), nn.Identity()
 
 
 class BasicConv2d(nn.Module):
@@ -19,6 +29,23 @@ class BasicConv2d(nn.Module):
 
         return x
 
+    def fuse_bn(self):
+        self.conv, self.bn = fuse_conv_bn(self.conv, self.bn)
+
+
+def merge_basic_convs(convs):
+    """Single BasicConv2d whose output is the concatenation of the outputs of BatchNorm-fused BasicConv2d layers
+    with the same input and kernel."""
+    if not all(isinstance(conv.bn, nn.Identity) for conv in convs):
+        raise ValueError('merge_basic_convs expects BatchNorm-fused layers (fuse_bn)')
+    first = convs[0].conv
+    merged = BasicConv2d(first.in_channels, sum(conv.conv.out_channels for conv in convs),
+                         first.kernel_size, first.stride, first.padding, first.dilation)
+    merged.conv.weight = nn.Parameter(torch.cat([conv.conv.weight for conv in convs]))
+    merged.conv.bias = nn.Parameter(torch.cat([conv.conv.bias for conv in convs]))
+    merged.bn = nn.Identity()
+    return merged.eval()
+
 
 class DWConv(nn.Module):
     def __init__(self, in_channel, out_channel, kernel, dilation, padding):
@@ -35,6 +62,9 @@ class DWConv(nn.Module):
 
         return out
 
+    def fuse_bn(self):
+        self.DWConv, self.bn = fuse_conv_bn(self.DWConv, self.bn)
+
 
 class DWSConv(nn.Module):
     def __init__(self, in_channel, out_channel, kernel, padding, kernels_per_layer):
@@ -53,4 +83,8 @@ class DWSConv(nn.Module):
         out = self.PWConv(x)
         out = self.selu(self.bn2(out))
 
-        return out
\ No newline at end of file
+        return out
+
+    def fuse_bn(self):
+        self.DWConv, self.bn = fuse_conv_bn(self.DWConv, self.bn)
+        self.PWConv, self.bn2 = fuse_conv_bn(self.PWConv, self.bn2)
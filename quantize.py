@@ -0,0 +1,78 @@
+"""
+Post-training static int8 quantization of TRACER for CPU inference.
+
+The backbone MBConvBlocks, RFB blocks and decoder convolutions are quantized (model_tracer/quantization.py) with
+activation ranges calibrated on a folder of images; the attention modules stay in fp32. The int8 model is saved as a
+frozen TorchScript artifact that the inference classes load with --model_file, checked against the fp32 model on
+the sample images and, given a labelled test set, on MAE / max-F / S-measure.
+
+e.g.
+    python quantize.py --arch 7 --calib_dir data/DUTS/Train/images --num_calib 64 \
+                       --image_dir data/DUTS/Test/images --mask_dir data/DUTS/Test/masks
+    python main.py inference ... --model_file TE-7_640_int8.pt
+"""
+import argparse
+import itertools
+import warnings
+import torch
+from config import DummyArgs
+from dataloader import get_test_augmentation, get_loader
+from evaluate import get_eval_loader, evaluate, report
+from export import build_eager_model, sample_inputs, check_parity, compare_latency
+from model_tracer.exported import TRACERPredictor, QUANTIZED_ENGINE_FILE, load_exported
+from model_tracer.quantization import DEFAULT_ENGINE, quantize_int8
+
+
+def calibration_batches(calib_dir, img_size, num_calib, batch_size, device):
+    loader = get_loader(calib_dir, None, edge_folder=None, phase='test', batch_size=batch_size, shuffle=False,
+                        num_workers=4, transform=get_test_augmentation(img_size=img_size))
+    for images, original_size, image_name in itertools.islice(loader, -(-num_calib // batch_size)):
+        yield images.to(device, dtype=torch.float32)
+
+
+def save_int8(model, img_size, output, engine):
+    example = torch.randn(1, 3, img_size, img_size)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(TRACERPredictor(model).eval(), example)
+    frozen = torch.jit.freeze(traced)
+    frozen.save(output, _extra_files={QUANTIZED_ENGINE_FILE: engine})
+    print(f'Saved int8 TRACER ({engine}) to {output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of TRACER')
+    parser.add_argument('--arch', type=str, default='7')
+    parser.add_argument('--img_size', type=int, default=None, help='default: the arch input size')
+    parser.add_argument('--calib_dir', type=str, required=True, help='calibration images')
+    parser.add_argument('--num_calib', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--engine', type=str, default=DEFAULT_ENGINE, choices=['onednn', 'x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--checkpoint', type=str, default=None, help='local TRACER checkpoint (default: TE-x)')
+    parser.add_argument('--weights_dir', type=str, default=None)
+    parser.add_argument('--image_dir', type=str, default=None, help='labelled test images for the accuracy report')
+    parser.add_argument('--mask_dir', type=str, default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='max |diff| of the saliency maps allowed against fp32 (default: report only)')
+    cli = parser.parse_args()
+
+    args = DummyArgs(arch=cli.arch)
+    args.img_size = cli.img_size or args.img_size
+    args.checkpoint, args.weights_dir = cli.checkpoint, cli.weights_dir
+    output = cli.output or f'TE-{args.arch}_{args.img_size}_int8.pt'
+    device = torch.device('cpu')
+
+    eager = build_eager_model(args, device)
+    batches = calibration_batches(cli.calib_dir, args.img_size, cli.num_calib, cli.batch_size, device)
+    save_int8(quantize_int8(eager, batches, cli.engine), args.img_size, output, cli.engine)
+
+    quantized = load_exported(output, device).eval()
+    inputs = sample_inputs(args.img_size, device)
+    check_parity(eager, quantized, inputs, cli.tolerance)
+    compare_latency({'fp32': eager, 'int8': quantized}, inputs, cli.repeat)
+
+    if cli.image_dir is not None and cli.mask_dir is not None:
+        loader = get_eval_loader(cli.image_dir, cli.mask_dir, args.img_size, cli.batch_size)
+        report({'fp32': evaluate(eager, loader, device), 'int8': evaluate(quantized, loader, device)})
@@ -0,0 +1,31 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inference_helper_spark as spark
+from util.weight_store import write_manifest
+from legacy import random_tracer
+
+
+@pytest.fixture(scope='session')
+def tracer_te0():
+    return random_tracer(0)
+
+
+@pytest.fixture
+def weights_dir(tmp_path, monkeypatch):
+    """Weight store with a random TE-0 checkpoint and EfficientNet-b0 backbone; downloads fail."""
+    model = random_tracer(0)
+    torch.save({f'module.{key}': value for key, value in model.state_dict().items()},
+               str(tmp_path / 'TRACER-Efficient-0.pth'))
+    torch.save(model.model.state_dict(), str(tmp_path / 'adv-efficientnet-b0-b64d5a18.pth'))
+    write_manifest(str(tmp_path))
+
+    def download(*args, **kwargs):
+        raise AssertionError('downloaded with a weight store configured')
+    monkeypatch.setattr(spark.model_zoo, 'load_url', download)
+    monkeypatch.delenv('TRACER_WEIGHTS_DIR', raising=False)
+    return str(tmp_path)
@@ -0,0 +1,123 @@
+"""
+Reference implementations replaced by the optimizations of the model code, kept to check that the optimized paths
+give the same outputs (tests/) and to time them against the old ones (benchmark.py), and random-weight TRACERs to
+run both on without checkpoints.
+"""
+import copy
+import math
+import functools
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.fft import fft2, fftshift, ifft2, ifftshift
+from config import DummyArgs
+from model_tracer.TRACER import TRACER
+from util.effi_utils import Conv2dDynamicSamePadding, Conv2dStaticSamePadding
+
+
+def randomize_batchnorm(model):
+    """Puts non-trivial statistics and affine parameters in every BatchNorm2d of a model. Returns it in eval mode."""
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.1, 0.1)
+    return model.eval()
+
+
+def random_tracer(arch):
+    """TRACER of an arch in eval mode with random weights and non-trivial BatchNorm statistics (no checkpoint)."""
+    torch.manual_seed(0)
+    return randomize_batchnorm(TRACER(DummyArgs(arch), pretrained_backbone=False))
+
+
+def legacy_mask_radial(img, r):
+    """Per-pixel Python loop used by Frequency_Edge_Module before the mask cache."""
+    batch, channels, rows, cols = img.shape
+    mask = torch.zeros((rows, cols), dtype=torch.float32)
+    for i in range(rows):
+        for j in range(cols):
+            dis = np.sqrt((i - rows / 2) ** 2 + (j - rows / 2) ** 2)
+            mask[i, j] = 1.0 if dis < r else 0
+    return mask.to(img.device)
+
+
+def legacy_high_pass(fem, x):
+    """Full complex FFT high-pass used by Frequency_Edge_Module before the rfft path."""
+    x_fft = fftshift(fft2(x, dim=(-2, -1)))
+    high_frequency = x_fft * (1 - fem.mask_radial(img=x, r=fem.radius))
+    return torch.abs(ifft2(ifftshift(high_frequency), dim=(-2, -1)))
+
+
+def legacy_masking(uam, x, mask):
+    """UnionAttentionModule.masking before the TopK threshold: full-sort quantile and an expanded mask copy."""
+    mask = mask.squeeze(3).squeeze(2).clone()
+    threshold = torch.quantile(mask, uam.confidence_ratio, dim=-1, keepdim=True)
+    mask[mask <= threshold] = 0.0
+    mask = mask.unsqueeze(2).unsqueeze(3)
+    mask = mask.expand(-1, x.shape[1], x.shape[2], x.shape[3]).contiguous()
+    return x * mask
+
+
+def legacy_aggregation(agg, e4, e3, e2):
+    """aggregation.forward before the upsampled e4 was reused."""
+    e3_1 = agg.conv_upsample1(agg.upsample(e4)) * e3
+    e2_1 = agg.conv_upsample2(agg.upsample(agg.upsample(e4))) * agg.conv_upsample3(agg.upsample(e3)) * e2
+    e3_2 = agg.conv_concat2(torch.cat((e3_1, agg.conv_upsample4(agg.upsample(e4))), 1))
+    e2_2 = torch.cat((e2_1, agg.conv_upsample5(agg.upsample(e3_2))), 1)
+    return agg.UAM(agg.conv_concat3(e2_2))
+
+
+def legacy_object_attention(oa, decoder_map, encoder_map, denoise):
+    """ObjectAttention.forward before the expanded mask and the mask/skip copies were dropped."""
+    mask_bg = -1 * torch.sigmoid(decoder_map) + 1
+    mask_ob = torch.sigmoid(decoder_map)
+    x = mask_ob.expand(-1, oa.channel, -1, -1).mul(encoder_map)
+    edge = mask_bg.clone()
+    edge[edge > denoise] = 0
+    x = oa.DWSConv(x + (edge * encoder_map))
+    skip = x.clone()
+    x = torch.cat([oa.DWConv1(x), oa.DWConv2(x), oa.DWConv3(x), oa.DWConv4(x)], dim=1) + skip
+    return torch.relu(oa.conv1(x)) + decoder_map
+
+
+def legacy_tracer(model, inputs, denoise):
+    """TRACER inference forward before the decoder changes: three full-resolution maps are averaged."""
+    B, C, H, W = inputs.size()
+    x = model.model.initial_conv(inputs)
+    features, edge = model.model.get_blocks(x, H, W, return_edge=False)
+    D_0 = legacy_aggregation(model.agg, model.rfb4(features[3]), model.rfb3(features[2]), model.rfb2(features[1]))
+    ds_map0 = F.interpolate(D_0, scale_factor=8, mode='bilinear')
+    D_1 = legacy_object_attention(model.ObjectAttention2, D_0, features[1], denoise)
+    ds_map1 = F.interpolate(D_1, scale_factor=8, mode='bilinear')
+    ds_map = F.interpolate(D_1, scale_factor=2, mode='bilinear')
+    D_2 = legacy_object_attention(model.ObjectAttention1, ds_map, features[0], denoise)
+    ds_map2 = F.interpolate(D_2, scale_factor=4, mode='bilinear')
+    return torch.sigmoid((ds_map2 + ds_map1 + ds_map0) / 3)
+
+
+def legacy_dynamic_conv(conv, x):
+    """Conv2dDynamicSamePadding.forward before the padding cache: padding recomputed and applied with F.pad per call."""
+    ih, iw = x.size()[-2:]
+    kh, kw = conv.weight.size()[-2:]
+    sh, sw = conv.stride
+    oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
+    pad_h = max((oh - 1) * conv.stride[0] + (kh - 1) * conv.dilation[0] + 1 - ih, 0)
+    pad_w = max((ow - 1) * conv.stride[1] + (kw - 1) * conv.dilation[1] + 1 - iw, 0)
+    if pad_h > 0 or pad_w > 0:
+        x = F.pad(x, [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2])
+    return F.conv2d(x, conv.weight, conv.bias, conv.stride, (0, 0), conv.dilation, conv.groups)
+
+
+def legacy_padding(backbone):
+    """Copy of an EfficientNet backbone whose 'SAME' convolutions always pad with an explicit padded copy."""
+    legacy = copy.deepcopy(backbone)
+    for module in legacy.modules():
+        if isinstance(module, Conv2dDynamicSamePadding):
+            module.forward = functools.partial(legacy_dynamic_conv, module)
+        elif isinstance(module, Conv2dStaticSamePadding) and tuple(module.padding) != (0, 0):
+            pad_h, pad_w = module.padding
+            module.static_padding = torch.nn.ZeroPad2d((pad_w, pad_w, pad_h, pad_h))
+            module.padding = (0, 0)
+    return legacy
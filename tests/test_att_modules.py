@@ -0,0 +1,51 @@
+import copy
+import types
+import pytest
+import torch
+from config import DummyArgs
+from util.effi_utils import get_model_shape
+from modules.att_modules import Frequency_Edge_Module, RFB_Block, UnionAttentionModule
+from legacy import legacy_high_pass, legacy_mask_radial, legacy_masking, randomize_batchnorm
+
+
+@pytest.mark.parametrize('shape', [(2, 8, 44, 44), (2, 8, 33, 33), (2, 8, 40, 56), (1, 4, 48, 30)])
+@pytest.mark.parametrize('real_fft', [True, False])
+def test_high_pass_matches_legacy(shape, real_fft):
+    torch.manual_seed(0)
+    x = torch.randn(shape)
+    fem = Frequency_Edge_Module(radius=16, channel=shape[1]).eval()
+    fem.real_fft = real_fft
+    legacy = types.SimpleNamespace(radius=fem.radius, mask_radial=legacy_mask_radial)  # per-pixel loop mask
+
+    with torch.no_grad():
+        torch.testing.assert_close(fem.high_pass(x), legacy_high_pass(legacy, x), atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(fem.high_pass(x), legacy_high_pass(legacy, x), atol=1e-5, rtol=1e-5)  # cached
+
+
+@pytest.mark.parametrize('arch', range(8))
+def test_masking_matches_legacy(arch):
+    torch.manual_seed(arch)
+    rfb_channels = sum(int(channel) for channel in DummyArgs(arch).RFB_aggregated_channel)
+    # Frequency Edge Module UAM on the first block, aggregation UAM on the RFB outputs
+    for channels in (get_model_shape(arch)[1][0], rfb_channels):
+        uam = UnionAttentionModule(channels).eval()
+        x = torch.randn(2, channels, 12, 10)
+        for mask in (torch.rand(2, channels, 1, 1), torch.randint(0, 8, (2, channels, 1, 1)) / 8):  # with ties
+            with torch.no_grad():
+                assert torch.equal(uam.masking(x, mask), legacy_masking(uam, x, mask))
+
+
+@pytest.mark.parametrize('in_channel, out_channel', [(40, 32), (112, 64), (320, 128)])
+def test_fuse_branches_matches_unmerged(in_channel, out_channel):
+    torch.manual_seed(0)
+    rfb = randomize_batchnorm(RFB_Block(in_channel, out_channel))
+    for module in list(rfb.modules()):
+        if hasattr(module, 'fuse_bn'):
+            module.fuse_bn()
+    merged = copy.deepcopy(rfb)
+    merged.fuse_branches()
+    x = torch.randn(2, in_channel, 20, 24)
+
+    assert merged.heads is not None
+    with torch.no_grad():
+        torch.testing.assert_close(merged(x), rfb(x), atol=1e-6, rtol=1e-5)
@@ -0,0 +1,98 @@
+import pytest
+import torch
+import torch.nn as nn
+from model_tracer.cascade import CascadeTRACER, POST_PROCESSING_THRESHOLD
+
+
+class FractionMap(nn.Module):
+    """Small model stub: the first inputs[i, 0, 0, 0] of the pixels of map i sit offset above the threshold, the
+    rest at 0."""
+    def __init__(self, offset):
+        super().__init__()
+        self.offset = offset
+        self.shapes = []
+
+    def forward(self, inputs, return_aux=False):
+        self.shapes.append(tuple(inputs.shape))
+        B, _, H, W = inputs.shape
+        pixels = torch.arange(H * W).expand(B, -1) < (inputs[:, 0, 0, 0:1] * H * W).round()
+        return (pixels.float() * (POST_PROCESSING_THRESHOLD + self.offset)).view(B, 1, H, W)
+
+
+class OnesMap(nn.Module):
+    """Large model stub: all-ones maps, recording the images it is run on."""
+    def __init__(self):
+        super().__init__()
+        self.inputs = []
+
+    def forward(self, inputs, return_aux=False):
+        self.inputs.append(inputs)
+        return torch.ones(inputs.size(0), 1, *inputs.shape[-2:])
+
+
+def fraction_inputs(fractions, size=20):
+    inputs = torch.rand(len(fractions), 3, size, size)
+    inputs[:, 0, 0, 0] = torch.tensor(fractions)
+    return inputs
+
+
+@pytest.mark.parametrize('offset, band, max_uncertain, escalated', [
+    (0.1, 0.15, 0.05, [2, 3]),  # within the band: escalated past max_uncertain
+    (0.1, 0.15, 0.3, [3]),
+    (0.1, 0.05, 0.05, []),  # outside of a narrower band: never uncertain
+    (-0.1, 0.15, 0.0, [1, 2, 3]),  # below the threshold too; a map without uncertain pixels stays at 0
+])
+def test_escalation(offset, band, max_uncertain, escalated):
+    fractions = [0.0, 0.04, 0.06, 0.5]
+    inputs = fraction_inputs(fractions)
+    large = OnesMap()
+    cascade = CascadeTRACER(FractionMap(offset), large, band=band, max_uncertain=max_uncertain)
+
+    expected = FractionMap(offset)(inputs)
+    expected[escalated] = 1  # large model maps for the escalated images, small model maps for the others
+    assert torch.equal(cascade(inputs), expected)
+    if escalated:
+        assert len(large.inputs) == 1 and torch.equal(large.inputs[0], inputs[escalated])
+    else:
+        assert not large.inputs
+    assert cascade.counters['images'] == len(fractions) and cascade.counters['escalated'] == len(escalated)
+
+
+def test_small_size():
+    small = FractionMap(0.1)
+    cascade = CascadeTRACER(small, OnesMap(), small_size=10)
+    assert cascade(fraction_inputs([0.0, 0.0], size=20)).shape == (2, 1, 20, 20)
+    assert small.shapes == [(2, 3, 10, 10)]
+    with pytest.raises(ValueError):
+        cascade(fraction_inputs([0.0]), return_aux=True)
+
+
+def test_counters_and_report(capsys):
+    cascade = CascadeTRACER(FractionMap(0.1), OnesMap())
+    cascade.report()
+    assert capsys.readouterr().out.strip() == 'cascade: no images'
+
+    cascade(fraction_inputs([0.0, 0.5, 0.0]))
+    cascade(fraction_inputs([0.0, 0.0]))
+    assert cascade.counters['images'] == 5 and cascade.counters['escalated'] == 1
+    assert cascade.counters['small_time'] > 0 and cascade.counters['large_time'] > 0
+
+    cascade.report()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1].split()[:3] == ['small', '5', '100.0%']
+    assert lines[2].split()[:3] == ['large', '1', '20.0%']
+    assert lines[3].split()[:2] == ['cascade', '5']
+    assert lines[4].startswith('throughput:')
+
+    cascade.reset_counters()
+    assert cascade.counters == {'images': 0, 'escalated': 0, 'small_time': 0.0, 'large_time': 0.0}
+
+
+def test_report_without_escalations(capsys):
+    large = OnesMap()
+    cascade = CascadeTRACER(FractionMap(0.1), large)
+    cascade(fraction_inputs([0.0, 0.01]))
+    cascade.report()
+    lines = capsys.readouterr().out.splitlines()
+    assert not large.inputs and cascade.counters['large_time'] == 0
+    assert lines[2].split()[:3] == ['large', '0', '0.0%'] and len(lines) == 4  # no throughput estimate
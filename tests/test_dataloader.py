@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+from dataloader import ShapeBatchSampler, get_letterbox_augmentation, group_by_shape, letterbox_size, padded_size
+
+SIZES = [(480, 640), (640, 480), (100, 100), (720, 1280), (481, 640), (1080, 1920), (300, 900), (50, 400),
+         (640, 480), (333, 333), (1000, 10), (479, 640)]
+
+
+@pytest.mark.parametrize('img_size, batch_size', [(320, 1), (320, 3), (640, 4), (352, 16)])
+def test_group_by_shape(img_size, batch_size):
+    batches = group_by_shape(SIZES, img_size, batch_size)
+    assert sorted(idx for batch in batches for idx in batch) == list(range(len(SIZES)))  # each index exactly once
+    for batch in batches:
+        assert 0 < len(batch) <= batch_size
+        assert len({padded_size(*SIZES[idx], img_size) for idx in batch}) == 1
+    shapes = len({padded_size(*size, img_size) for size in SIZES})
+    assert len(batches) >= shapes and (batch_size < len(SIZES) or len(batches) == shapes)
+
+    sampler = ShapeBatchSampler(SIZES, img_size, batch_size)
+    assert list(sampler) == batches and len(sampler) == len(batches)
+
+
+@pytest.mark.parametrize('stride', [32, 16])
+@pytest.mark.parametrize('img_size', [320, 352, 640])
+def test_letterbox_and_padded_sizes(img_size, stride):
+    for height, width in SIZES:
+        rows, cols = letterbox_size(height, width, img_size)
+        scale = img_size / max(height, width)
+        assert max(rows, cols) == img_size and abs(rows - height * scale) <= 0.5 and abs(cols - width * scale) <= 0.5
+        padded = padded_size(height, width, img_size, stride)
+        assert all(dim % stride == 0 and 0 <= dim - size < stride for dim, size in zip(padded, (rows, cols)))
+
+
+@pytest.mark.parametrize('img_size', [320, 352])
+def test_letterbox_crop_removes_the_pad(img_size):
+    rng = np.random.RandomState(0)
+    for height, width in SIZES:
+        image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        inputs = get_letterbox_augmentation(img_size)(image=image)['image']
+        rows, cols = letterbox_size(height, width, img_size)
+
+        assert tuple(inputs.shape[1:]) == padded_size(height, width, img_size)
+        padding = torch.ones_like(inputs, dtype=torch.bool)
+        padding[:, :rows, :cols] = False
+        assert not inputs[padding].any()  # zero padding at the bottom and right only
+        assert inputs[:, :rows, :cols].abs().sum(0).gt(0).all()  # image content up to the last row and column
@@ -0,0 +1,39 @@
+import pytest
+import torch
+from model_tracer.EfficientNet import EfficientNet
+from util.effi_utils import Conv2dDynamicSamePadding, same_padding, split_same_padding
+from legacy import legacy_padding
+
+
+def test_split_same_padding():
+    assert split_same_padding((1, 1, 2, 2)) == ((2, 1), None)  # left to the convolution
+    assert split_same_padding((0, 1, 0, 1)) == ((0, 0), [0, 1, 0, 1])
+    assert split_same_padding((1, 1, 0, 1)) == ((0, 0), [1, 1, 0, 1])
+
+
+@pytest.mark.parametrize('padding', ['dynamic', 'static'])
+@pytest.mark.parametrize('img_size', [321, 352])
+def test_padding_matches_legacy(padding, img_size):
+    torch.manual_seed(0)
+    override = {'image_size': None} if padding == 'dynamic' else {}
+    backbone = EfficientNet.from_name('efficientnet-b0', **override).eval()
+    legacy = legacy_padding(backbone)
+    x = torch.randn(1, 3, img_size, img_size)
+
+    def features(model):
+        return model.get_blocks(model.initial_conv(x), img_size, img_size, return_edge=False)[0]
+
+    with torch.no_grad():
+        for _ in range(2):  # computes, then reuses the memoized padding
+            for feature, reference in zip(features(backbone), features(legacy)):
+                torch.testing.assert_close(feature, reference, atol=1e-5, rtol=0)
+
+    convs = [module for module in backbone.modules() if isinstance(module, Conv2dDynamicSamePadding)]
+    assert bool(convs) == (padding == 'dynamic')
+    for conv in convs:
+        assert len(conv.padding_cache) == 1  # one input size per convolution
+        for key, cached in conv.padding_cache.items():
+            assert cached == split_same_padding(same_padding(key, conv.weight.size()[-2:], conv.stride, conv.dilation))
+    if convs:  # 321 only halves to odd sizes, padded symmetrically by the convolution; 352 also needs F.pad
+        expected = {True} if img_size % 2 else {True, False}
+        assert {pad is None for conv in convs for _, pad in conv.padding_cache.values()} == expected
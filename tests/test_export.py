@@ -0,0 +1,78 @@
+import pytest
+import torch
+import inference_helper_spark as spark
+from export import export_torchscript, export_onnx, check_parity
+from model_tracer.exported import QUANTIZED_ENGINE_FILE, ScriptedTRACER, load_exported
+from model_tracer.quantization import DEFAULT_ENGINE, quantize_int8
+from quantize import save_int8
+from legacy import random_tracer
+
+IMG_SIZE = 160
+
+
+@pytest.fixture(scope='module')
+def eager():
+    return random_tracer(0).set_swish(memory_efficient=False)
+
+
+@pytest.fixture(scope='module')
+def inputs():
+    torch.manual_seed(0)
+    return torch.randn(2, 3, IMG_SIZE, IMG_SIZE)
+
+
+def test_torchscript_parity(eager, inputs, tmp_path):
+    output = str(tmp_path / 'TE-0.pt')
+    export_torchscript(eager, IMG_SIZE, output, torch.device('cpu'))
+
+    exported = load_exported(output, torch.device('cpu')).eval()
+    assert isinstance(exported, ScriptedTRACER)
+    assert check_parity(eager, exported, inputs, tolerance=1e-5) <= 1e-5
+    with pytest.raises(RuntimeError):
+        check_parity(eager, lambda x: exported(x) + 1e-3, inputs, tolerance=1e-5)
+
+
+def test_onnx_parity(eager, inputs, tmp_path):
+    pytest.importorskip('onnxruntime')
+    output = str(tmp_path / 'TE-0.onnx')
+    export_onnx(eager, IMG_SIZE, output, torch.device('cpu'))
+
+    exported = load_exported(output, torch.device('cpu')).eval()
+    assert check_parity(eager, exported, inputs, tolerance=1e-4) <= 1e-4
+
+
+
+def test_int8_parity(eager, inputs, tmp_path):
+    output = str(tmp_path / 'TE-0_int8.pt')
+    previous = torch.backends.quantized.engine
+    torch.manual_seed(1)
+    try:
+        quantized = quantize_int8(eager, [torch.rand(2, 3, IMG_SIZE, IMG_SIZE) for _ in range(2)])
+        save_int8(quantized, IMG_SIZE, output, DEFAULT_ENGINE)
+    finally:
+        torch.backends.quantized.engine = previous
+
+    exported = load_exported(output, torch.device('cpu')).eval()
+    assert torch.backends.quantized.engine == previous
+    with torch.no_grad():
+        torch.testing.assert_close(exported(inputs), quantized(inputs, return_aux=False), atol=1e-5, rtol=0)
+    assert check_parity(eager, exported, inputs, tolerance=5e-2) <= 5e-2
+
+
+@pytest.mark.parametrize('scripted_tracer', [ScriptedTRACER, spark.ScriptedTRACER])
+@pytest.mark.parametrize('engine', [None, 'qnnpack'])
+def test_scripted_quantized_engine(scripted_tracer, engine, tmp_path, monkeypatch):
+    output = str(tmp_path / 'model.pt')
+    frozen = torch.jit.freeze(torch.jit.script(torch.nn.Conv2d(3, 1, 1).eval()))
+    frozen.save(output, _extra_files={QUANTIZED_ENGINE_FILE: engine} if engine is not None else {})
+    optimized = []
+    monkeypatch.setattr(torch.jit, 'optimize_for_inference', lambda model: optimized.append(model) or model)
+    engines, jit_load = [], torch.jit.load
+    monkeypatch.setattr(torch.jit, 'load', lambda *args, **kwargs: engines.append(
+        torch.backends.quantized.engine) or jit_load(*args, **kwargs))
+    previous = torch.backends.quantized.engine
+
+    scripted_tracer(output, torch.device('cpu'))
+    assert engines == [engine or previous]  # packed for the engine of the artifact
+    assert torch.backends.quantized.engine == previous
+    assert len(optimized) == (engine is None)  # oneDNN layouts for fp32 only
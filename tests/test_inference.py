@@ -0,0 +1,106 @@
+import os
+import threading
+import cv2
+import numpy as np
+import pytest
+import inference
+from config import DummyArgs
+from legacy import random_tracer
+
+
+@pytest.fixture
+def dataset_dir(tmp_path, monkeypatch):
+    """a.png and a.jpeg share a file stem with different content; b.png repeats the bytes of a.png."""
+    rng = np.random.RandomState(0)
+    folder = tmp_path / 'data' / 'ds'
+    os.makedirs(str(folder))
+    cv2.imwrite(str(folder / 'a.png'), rng.randint(0, 256, (60, 80, 3), dtype=np.uint8))
+    cv2.imwrite(str(folder / 'a.jpeg'), rng.randint(0, 256, (70, 50, 3), dtype=np.uint8))
+    with open(str(folder / 'a.png'), 'rb') as src, open(str(folder / 'b.png'), 'wb') as dst:
+        dst.write(src.read())
+    state_dict = random_tracer(0).state_dict()
+    monkeypatch.setattr(inference, 'load_pretrained', lambda name, device, weights_dir=None: state_dict)
+    monkeypatch.chdir(str(tmp_path))  # masks and objects are written to ./mask and ./object
+    return str(tmp_path / 'data')
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_cache_with_shared_stems(dataset_dir, pipeline):
+    args = DummyArgs(0)
+    args.data_path, args.dataset, args.batch_size, args.num_workers, args.save_map = dataset_dir, 'ds', 2, 0, True
+    args.cache_size, args.pipeline = 16, pipeline
+
+    model = inference.Inference(args, None)
+    model.test()
+    assert model.cache.counters['misses'] == 2  # b.png is a duplicate of a.png within the run
+    assert not model.cache_keys and not model.duplicates
+    assert sorted(os.listdir(os.path.join('mask', 'ds'))) == ['a.png', 'b.png']
+
+    model.test()  # every image from the in-memory tier
+    assert model.cache.counters['memory_hits'] == 3
+    assert model.cache.counters['misses'] == 2
+
+
+def run_pipeline(pipeline, timeout=30):
+    """Runs a Pipeline in a thread and returns the exception of run(), failing if it does not return in time."""
+    errors = []
+    thread = threading.Thread(target=lambda: errors.append(capture(pipeline.run)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'Pipeline.run() hangs'
+    return errors[0]
+
+
+def capture(fn):
+    try:
+        fn()
+    except Exception as e:
+        return e
+
+
+def test_pipeline_stage_error():
+    def fail(item):
+        if item == 3:
+            raise KeyError(item)
+        yield item
+
+    written = []
+    stages = [(lambda item: [item], 2), (fail, 2), (lambda item: written.append(item) or [], 1)]
+    pipeline = inference.Pipeline(iter(range(100)), stages, queue_size=1)  # blocks unless the failing stage drains
+    assert isinstance(run_pipeline(pipeline), KeyError)
+    assert 3 not in written
+
+
+def test_pipeline_source_error():
+    def source():
+        yield 0
+        raise OSError('unreadable image')
+
+    pipeline = inference.Pipeline(source(), [(lambda item: [item], 2), (lambda item: [], 1)], queue_size=1)
+    assert isinstance(run_pipeline(pipeline), OSError)
+
+
+def read_outputs():
+    return {os.path.join(folder, name): cv2.imread(os.path.join(folder, name), cv2.IMREAD_UNCHANGED)
+            for folder in (os.path.join('mask', 'ds'), os.path.join('object', 'ds'))
+            for name in sorted(os.listdir(folder))}
+
+
+def test_pipeline_matches_sequential(dataset_dir, tmp_path, monkeypatch):
+    os.remove(os.path.join(dataset_dir, 'ds', 'a.jpeg'))  # two writers would race on the mask of the shared stem
+    rng = np.random.RandomState(1)
+    for idx, size in enumerate([(90, 40), (33, 65), (64, 64)]):
+        cv2.imwrite(os.path.join(dataset_dir, 'ds', f'c{idx}.jpg'), rng.randint(0, 256, size + (3,), dtype=np.uint8))
+    outputs = {}
+    for pipeline in (False, True):
+        os.makedirs(str(tmp_path / str(pipeline)))
+        monkeypatch.chdir(str(tmp_path / str(pipeline)))
+        args = DummyArgs(0)
+        args.data_path, args.dataset, args.batch_size, args.num_workers = dataset_dir, 'ds', 2, 0
+        args.save_map, args.pipeline, args.num_writers = True, pipeline, 2
+        inference.Inference(args, None).test()
+        outputs[pipeline] = read_outputs()
+
+    assert outputs[True].keys() == outputs[False].keys() and len(outputs[True]) == 2 * 5
+    for name, image in outputs[False].items():
+        assert np.array_equal(outputs[True][name], image), name
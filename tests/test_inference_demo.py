@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from PIL import Image
+import inference_demo_helper
+from config import DummyArgs
+from legacy import random_tracer
+
+
+@pytest.fixture(scope='module')
+def state_dict():
+    return random_tracer(0).state_dict()
+
+
+@pytest.fixture
+def demo(state_dict, monkeypatch):
+    """Builds a demo Inference of TE-0 (random weights) with the given options."""
+    monkeypatch.setattr(inference_demo_helper, 'load_pretrained', lambda name, device, weights_dir=None: state_dict)
+
+    def build(**options):
+        args = DummyArgs(0)
+        for name, value in options.items():
+            setattr(args, name, value)
+        return inference_demo_helper.Inference(args)
+    return build
+
+
+class ContentMap(nn.Module):
+    """Model stub: 1 where the input has image content, 0 on the zero padding of letterbox inputs."""
+    def forward(self, inputs, return_aux=False):
+        return inputs.abs().sum(1, keepdim=True).gt(0).float()
+
+
+def test_letterbox_crop(demo):
+    model = demo(letterbox=True)
+    model.model = ContentMap()
+    rng = np.random.RandomState(0)
+    images = [rng.randint(1, 256, size + (3,), dtype=np.uint8) for size in [(480, 640), (481, 640), (50, 400),
+                                                                           (1000, 10), (333, 333), (640, 479)]]
+    masks, objects = model.test_batch(images, batch_size=2)
+    for image, mask, rgba_image in zip(images, masks, objects):
+        assert mask.shape == rgba_image.shape[:2] == image.shape[:2]
+        assert (mask == 255).all()  # no row or column of padding left before resizing back
+        assert (rgba_image[..., 3] == 255).all()
+
+
+def mixed_inputs(folder):
+    """The same four images of mixed sizes as a PIL image, a path, an RGB array and encoded bytes."""
+    rng = np.random.RandomState(0)
+    rgb = [rng.randint(0, 256, size + (3,), dtype=np.uint8) for size in [(200, 300), (320, 320), (500, 90), (64, 80)]]
+    path = str(folder / 'image.png')
+    cv2.imwrite(path, cv2.cvtColor(rgb[1], cv2.COLOR_RGB2BGR))
+    return [Image.fromarray(rgb[0]), path, rgb[2], cv2.imencode('.png', cv2.cvtColor(rgb[3], cv2.COLOR_RGB2BGR))[1].tobytes()]
+
+
+@pytest.mark.parametrize('batch_size', [None, 3])
+def test_batch_matches_single_images(demo, tmp_path, batch_size):
+    model = demo()
+    images = mixed_inputs(tmp_path)
+    masks, objects = model.test_batch(images, batch_size)
+    for image, mask, rgba_image in zip(images, masks, objects):
+        single_mask, single_object = model.test(image)
+        assert mask.shape == single_mask.shape and rgba_image.shape == single_object.shape
+        assert np.abs(mask.astype(int) - single_mask).max() <= 1  # batched convolutions round differently
+        assert np.mean(rgba_image != single_object) < 1e-3  # up to pixels flipping at the alpha cut
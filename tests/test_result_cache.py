@@ -0,0 +1,70 @@
+import os
+import time
+import pytest
+from config import DummyArgs
+from util.result_cache import ResultCache, cache_settings
+from util.weight_store import write_manifest
+
+
+def disk_size(cache_dir):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(cache_dir) for name in names)
+
+
+def test_settings_follow_the_weights(tmp_path, monkeypatch):
+    monkeypatch.delenv('TRACER_WEIGHTS_DIR', raising=False)
+    args = DummyArgs(0)
+    downloaded = cache_settings(args, 320)
+    args.cascade_arch = '7'
+    assert cache_settings(args, 320) != downloaded
+
+    for arch in ('0', '7'):
+        with open(str(tmp_path / f'TRACER-Efficient-{arch}.pth'), 'wb') as f:
+            f.write(arch.encode())
+    write_manifest(str(tmp_path))
+    args.weights_dir = str(tmp_path)
+    stored = cache_settings(args, 320)
+    assert stored != cache_settings(DummyArgs(0), 320)
+    with open(str(tmp_path / 'TRACER-Efficient-7.pth'), 'wb') as f:  # another TE-7 checkpoint
+        f.write(b'retrained')
+    write_manifest(str(tmp_path))
+    assert cache_settings(args, 320) != stored
+
+    args.model_file = str(tmp_path / 'TE-0.pt')
+    with open(args.model_file, 'wb') as f:
+        f.write(b'fp32')
+    exported = cache_settings(args, 320)
+    with open(args.model_file, 'wb') as f:  # re-exported to the same path
+        f.write(b'int8')
+    assert cache_settings(args, 320) != exported
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    data = b'\0' * 1000
+    cache = ResultCache(max_bytes=0, cache_dir=cache_dir, max_disk_bytes=10000)  # 5 results of 2 files
+    keys = [ResultCache.key(bytes([i])) for i in range(12)]
+    for i, key in enumerate(keys):
+        cache.put(key, data, data)
+        past = time.time() - 100 + i  # distinct modification times
+        for suffix in ('mask', 'object'):
+            os.utime(cache._path(key, suffix), (past, past))
+        if i == 3:
+            assert cache.get(keys[0]) is not None  # last use of keys[0] is now
+
+    assert disk_size(cache_dir) <= 10000
+    assert cache.counters['disk_evictions'] > 0
+    assert cache.get(keys[0]) is not None  # recently used
+    assert cache.get(keys[1]) is None  # least recently used
+    assert cache.get(keys[-1]) is not None
+
+    unbounded = ResultCache(max_bytes=0, cache_dir=str(tmp_path / 'unbounded'))
+    for key in keys:
+        unbounded.put(key, data, data)
+    assert disk_size(str(tmp_path / 'unbounded')) == 24000
+
+
+@pytest.mark.parametrize('cache_disk_size, expected', [(0, None), (2, 2 * 2 ** 20)])
+def test_from_config(cache_disk_size, expected, tmp_path):
+    args = DummyArgs(0)
+    args.cache_dir, args.cache_disk_size = str(tmp_path), cache_disk_size
+    assert ResultCache.from_config(args).max_disk_bytes == expected
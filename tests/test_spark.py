@@ -0,0 +1,87 @@
+import os
+import cv2
+import numpy as np
+import pytest
+import inference_helper_spark as spark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = [os.path.join(ROOT, name) for name in ('test_image.png', 'test_image.jpeg')]
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def assert_masks(masks, paths):
+    """PNG encoded masks that decode to the sizes of the images at paths."""
+    assert len(masks) == len(paths)
+    for mask, path in zip(masks, paths):
+        decoded = cv2.imdecode(np.frombuffer(mask, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        assert decoded is not None and decoded.dtype == np.uint8
+        assert decoded.shape == cv2.imread(path).shape[:2]
+
+
+class BatchSizes():
+    """Wraps the model of an Inference to record the size of each forward pass."""
+    def __init__(self, inference):
+        self.model, self.sizes = inference.model, []
+        inference.model = self
+
+    def __call__(self, inputs, return_aux=False):
+        self.sizes.append(inputs.size(0))
+        return self.model(inputs, return_aux=return_aux)
+
+
+@pytest.mark.parametrize('cache_size', [0, 16])
+def test_null_and_undecodable_rows(weights_dir, cache_size):
+    inference = spark.get_inference(0, cache_size=cache_size, weights_dir=weights_dir)
+    png, jpeg = (read_bytes(path) for path in SAMPLES)
+    masks = inference.encode_masks([png, None, b'not an image', b'', jpeg[:100], jpeg], batch_size=2)
+
+    assert masks[1:5] == [None] * 4
+    assert_masks([masks[0], masks[5]], SAMPLES)
+    assert [masks[0], masks[5]] == inference.encode_masks([png, jpeg])
+
+
+def test_map_in_pandas_chunks_record_batches(weights_dir):
+    pd = pytest.importorskip('pandas')
+    recorder = BatchSizes(spark.get_inference(0, weights_dir=weights_dir))
+    images = [read_bytes(path) for path in SAMPLES] * 5 + [None]
+    frame = pd.DataFrame({'path': SAMPLES * 5 + ['missing'], 'content': images})
+
+    frames = list(spark.tracer_map_in_pandas(arch=0, weights_dir=weights_dir)(iter([frame])))
+    assert max(recorder.sizes) <= spark.SPARK_BATCH_SIZE and sum(recorder.sizes) == 10
+    assert frames[0]['mask'].iloc[-1] is None
+    assert_masks(list(frames[0]['mask'].iloc[:-1]), SAMPLES * 5)
+
+
+@pytest.fixture(scope='module')
+def session():
+    pytest.importorskip('pyspark')
+    from pyspark.sql import SparkSession
+
+    session = SparkSession.builder.master('local[1]').appName('TRACER tests').getOrCreate()
+    session.sparkContext.addPyFile(spark.__file__)
+    yield session
+    session.stop()
+
+
+def test_udfs(session, weights_dir):
+    from pyspark.sql.types import BinaryType, StructField, StructType
+
+    df = session.read.format('binaryFile').load(SAMPLES).select('path', 'content')
+    rows = df.select('path', spark.tracer_mask_udf(arch=0, weights_dir=weights_dir)('content').alias('mask')).collect()
+    assert_masks([row.mask for row in rows], [row.path.replace('file:', '') for row in rows])
+
+    schema = StructType(df.schema.fields + [StructField('mask', BinaryType())])
+    rows = df.mapInPandas(spark.tracer_map_in_pandas(arch=0, weights_dir=weights_dir), schema=schema).collect()
+    assert_masks([row.mask for row in rows], [row.path.replace('file:', '') for row in rows])
+
+
+def test_udf_null_rows(session, weights_dir):
+    df = session.createDataFrame([(read_bytes(SAMPLES[0]),), (None,), (b'not an image',)], 'content binary')
+    masks = [row.mask for row in df.select(spark.tracer_mask_udf(arch=0, weights_dir=weights_dir)('content')
+                                           .alias('mask')).collect()]
+    assert masks[1:] == [None, None]
+    assert_masks(masks[:1], SAMPLES[:1])
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from dataloader import get_test_augmentation
+from model_tracer.tiling import TiledPredictor, blend_ramp, tile_starts
+
+IMG_SIZE = 64
+
+
+class ConstantMap(nn.Module):
+    """Model stub: maps of one value, recording the batch size of each forward pass."""
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+        self.batches = []
+
+    def forward(self, inputs, return_aux=False):
+        self.batches.append(inputs.size(0))
+        return torch.full((inputs.size(0), 1) + tuple(inputs.shape[-2:]), self.value)
+
+
+def tiled(value, **kwargs):
+    return TiledPredictor(ConstantMap(value), get_test_augmentation(IMG_SIZE), IMG_SIZE, torch.device('cpu'), **kwargs)
+
+
+def image(height, width):
+    return np.random.RandomState(0).randint(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('length', [64, 65, 100, 150, 257])
+@pytest.mark.parametrize('overlap', [0.0, 0.25, 0.5])
+def test_blend_weights_cover_every_pixel(length, overlap):
+    starts = tile_starts(length, IMG_SIZE, overlap)
+    assert starts[0] == 0 and starts[-1] == length - IMG_SIZE
+    assert all(0 < b - a <= IMG_SIZE * (1 - overlap) for a, b in zip(starts, starts[1:]))
+    coverage = torch.zeros(length)
+    for start in starts:
+        coverage[start:start + IMG_SIZE] += blend_ramp(start, IMG_SIZE, length, int(IMG_SIZE * overlap))
+    assert (coverage > 0).all()
+
+
+@pytest.mark.parametrize('size', [(150, 100), (257, 70), (40, 200)])
+def test_constant_maps_blend_without_seams(size):
+    predictor = tiled(0.75, band=None)
+    assert torch.allclose(predictor.predict(image(*size)), torch.full(size, 0.75))
+    assert predictor.counters['tiles'] > 0
+
+
+@pytest.mark.parametrize('size', [(40, 50), (IMG_SIZE, IMG_SIZE), (IMG_SIZE, 30)])
+def test_small_images_use_the_global_pass(size):
+    predictor = tiled(0.75, band=None)
+    assert predictor.predict(image(*size)).shape == size
+    assert predictor.model.batches == [1] and predictor.counters['tiles'] == 0
+
+
+@pytest.mark.parametrize('size', [(IMG_SIZE + 1, IMG_SIZE), (150, 100)])
+def test_large_images_are_tiled(size):
+    predictor = tiled(0.75, band=None, overlap=0.25)
+    assert predictor.predict_mask(image(*size)).shape == size
+    rows, cols = (len(tile_starts(length, min(IMG_SIZE, length), 0.25)) for length in size)
+    assert predictor.counters['tiles'] == rows * cols
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 4])
+def test_tile_batches_are_bounded(batch_size):
+    predictor = tiled(0.75, band=None, batch_size=batch_size)
+    predictor.predict(image(257, 150))
+    global_pass, *tile_batches = predictor.model.batches
+    assert global_pass == 1 and max(tile_batches) <= batch_size
+    assert sum(tile_batches) == predictor.counters['tiles'] and len(tile_batches) == -(-sum(tile_batches) // batch_size)
+
+
+def test_band_selects_uncertain_tiles():
+    every_tile = tiled(0.75, band=None)
+    uncertain = tiled(0.75, band=0.15)  # 0.75 is within the band of the threshold: every tile is predicted
+    confident = tiled(0.0, band=0.15)  # no tile is predicted, the global map is returned as it is
+    for predictor in (every_tile, uncertain, confident):
+        predictor.predict(image(150, 100))
+    assert every_tile.counters['tiles'] == uncertain.counters['tiles'] > 0 == uncertain.counters['skipped_tiles']
+    assert confident.counters['tiles'] == 0 and confident.counters['skipped_tiles'] == every_tile.counters['tiles']
+    assert confident.model.batches == [1]
+
+    global_map = torch.zeros(150, 100)
+    global_map[140:, :10] = 0.75  # only the bottom-left corner is uncertain
+    boxes = uncertain.boxes(150, 100, global_map)
+    assert boxes and all(top + h > 140 and left < 10 for top, left, h, w in boxes)
+    assert len(boxes) < len(every_tile.boxes(150, 100, global_map))
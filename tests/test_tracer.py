@@ -0,0 +1,59 @@
+import copy
+import pytest
+import torch
+import inference_helper_spark as spark
+from config import DummyArgs
+from model_tracer.TRACER import TRACER
+from util.effi_utils import get_model_shape
+from legacy import legacy_aggregation, legacy_tracer, random_tracer
+
+
+@pytest.mark.parametrize('arch', [0, 7])
+def test_fuse_for_inference_matches_unfused(arch):
+    model = random_tracer(arch)
+    fused = copy.deepcopy(model).fuse_for_inference(branches=False)
+    x = torch.randn(2, 3, 160, 160)
+
+    with torch.no_grad():
+        torch.testing.assert_close(fused(x, return_aux=False), model(x, return_aux=False), atol=1e-5, rtol=0)
+        for fused_map, map in zip(fused(x), model(x)):  # edge and deep supervision maps
+            torch.testing.assert_close(fused_map, map, atol=1e-5, rtol=0)
+    assert sum(isinstance(module, torch.nn.BatchNorm2d) for module in fused.modules()) < \
+        sum(isinstance(module, torch.nn.BatchNorm2d) for module in model.modules())
+
+
+
+
+@pytest.mark.parametrize('low_res_average, atol', [(False, 1e-5), (True, 2e-2)])
+def test_inference_forward_matches_legacy(tracer_te0, low_res_average, atol):
+    model = copy.deepcopy(tracer_te0)
+    model.low_res_average = low_res_average  # averages at 1/4 resolution: an approximation of the legacy maps
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, 160, 160)
+
+    with torch.no_grad():
+        torch.testing.assert_close(model(x, return_aux=False), legacy_tracer(model, x, DummyArgs(0).denoise),
+                                   atol=atol, rtol=0)
+
+
+def test_aggregation_matches_legacy(tracer_te0):
+    torch.manual_seed(0)
+    channels = [int(channel) for channel in DummyArgs(0).RFB_aggregated_channel]
+    e4, e3, e2 = (torch.randn(2, channel, 5 * scale, 5 * scale) for channel, scale in zip(channels[::-1], (1, 2, 4)))
+
+    with torch.no_grad():
+        torch.testing.assert_close(tracer_te0.agg(e4, e3, e2), legacy_aggregation(tracer_te0.agg, e4, e3, e2),
+                                   atol=1e-6, rtol=0)
+
+
+@pytest.mark.parametrize('tracer, args', [(TRACER, DummyArgs), (spark.TRACER, spark.DummyArgs)])
+def test_archs_in_one_process(tracer, args, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # no ./arch.txt: every shape comes from the configuration passed in
+    x = torch.randn(1, 3, 64, 64)
+    for arch in (0, 7, 0):
+        model = tracer(args(arch), pretrained_backbone=False).eval()
+        block_idx, channels = get_model_shape(arch)
+        assert (model.block_idx, model.channels) == (block_idx, channels)
+        assert [model.model._blocks[idx]._project_conv.out_channels for idx in block_idx] == channels
+        with torch.no_grad():
+            assert model(x, return_aux=False).shape == (1, 1, 64, 64)
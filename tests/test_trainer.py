@@ -0,0 +1,57 @@
+import os
+import cv2
+import numpy as np
+import torch
+import trainer
+from config import DummyArgs
+from model_tracer.EfficientNet import EfficientNet
+
+DATASETS = ['DUTS', 'DUT-O', 'HKU-IS', 'ECSSD', 'PASCAL-S']  # tested after training
+
+
+def write_dataset(root, phase, num_images, edges):
+    rng = np.random.RandomState(0)
+    folders = ['images', 'masks'] + (['edges'] if edges else [])
+    for folder in folders:
+        os.makedirs(os.path.join(root, phase, folder))
+    for i in range(num_images):
+        mask = np.zeros((80, 96), dtype=np.uint8)
+        mask[20:60, 30:70] = 255
+        cv2.imwrite(os.path.join(root, phase, 'images', f'{i}.png'), rng.randint(0, 256, (80, 96, 3), dtype=np.uint8))
+        cv2.imwrite(os.path.join(root, phase, 'masks', f'{i}.png'), mask)
+        if edges:
+            cv2.imwrite(os.path.join(root, phase, 'edges', f'{i}.png'), cv2.Canny(mask, 100, 200))
+
+
+def test_trainer_channels_last_step(tmp_path, monkeypatch):
+    write_dataset(str(tmp_path / 'data' / 'DUTS'), 'Train', num_images=4, edges=True)  # 3 train, 1 val image
+    for dataset in DATASETS:
+        write_dataset(str(tmp_path / 'data' / dataset), 'Test', num_images=1, edges=False)
+
+    calls = []
+
+    class RecordingTRACER(trainer.TRACER):
+        def forward(self, inputs, return_aux=True):
+            calls.append((self.training, inputs.is_contiguous(memory_format=torch.channels_last)))
+            return super().forward(inputs, return_aux)
+
+    # random backbone instead of the ImageNet weights
+    monkeypatch.setattr(EfficientNet, 'from_pretrained',
+                        classmethod(lambda cls, name, cfg=None, **kwargs: cls.from_name(name, cfg=cfg)))
+    monkeypatch.setattr(trainer, 'TRACER', RecordingTRACER)
+
+    args = DummyArgs(0)
+    args.img_size, args.channels_last, args.swish = 96, True, 'auto'
+    args.data_path, args.dataset, args.aug_ver, args.seed = str(tmp_path / 'data'), 'DUTS', 1, 42
+    args.batch_size, args.num_workers, args.epochs, args.patience = 2, 0, 1, 5
+    args.optimizer, args.lr, args.weight_decay, args.scheduler, args.criterion = 'Adam', 1e-4, 1e-4, 'Step', 'API'
+    args.clipping = 2
+    save_path = str(tmp_path / 'results')
+    os.makedirs(save_path)
+
+    trainer.Trainer(args, save_path)
+
+    assert (True, True) in calls  # one NHWC training step (3 images, batch 2, drop_last)
+    assert all(channels_last for _, channels_last in calls)
+    state = torch.load(os.path.join(save_path, 'best_model.pth'))
+    assert all(torch.isfinite(v).all() for v in state.values() if v.is_floating_point())
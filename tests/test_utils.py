@@ -0,0 +1,46 @@
+import pytest
+import torch
+from util.effi_utils import Swish, MemoryEfficientSwish
+from util.utils import autocast, select_swish
+from legacy import random_tracer
+
+
+def swish_types(model):
+    return {type(module._swish) for module in model.modules() if hasattr(module, '_swish')}
+
+
+@pytest.mark.parametrize('swish, expected', [('memory_efficient', True), ('native', False)])
+def test_select_swish_fixed(swish, expected):
+    model = random_tracer(0)
+    assert select_swish(model, swish, 1, 64, torch.device('cpu')) is expected
+    assert swish_types(model) == {MemoryEfficientSwish if expected else Swish}
+
+
+def test_select_swish_auto_keeps_model_untouched():
+    model = random_tracer(0).train()
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    memory_efficient = select_swish(model, 'auto', 2, 64, torch.device('cpu'), repeat=1)
+    assert swish_types(model) == {MemoryEfficientSwish if memory_efficient else Swish}
+    assert all(torch.equal(state[k], v) for k, v in model.state_dict().items())
+    assert all(p.grad is None for p in model.parameters())
+
+
+def test_select_swish_auto_single_image():
+    model = random_tracer(0)
+    assert select_swish(model, 'auto', 1, 64, torch.device('cpu'), repeat=1) in (True, False)
+
+
+def test_select_swish_unknown():
+    with pytest.raises(ValueError):
+        select_swish(random_tracer(0), 'fast', 1, 64, torch.device('cpu'))
+
+
+def test_autocast():
+    x = torch.randn(2, 4)
+    with autocast(torch.device('cpu'), 'fp32'):
+        assert not torch.is_autocast_enabled('cpu')
+        assert (x @ x.T).dtype == torch.float32
+    with autocast(torch.device('cpu'), 'bf16'):
+        assert (x @ x.T).dtype == torch.bfloat16
+    with pytest.raises(ValueError):
+        autocast(torch.device('cpu'), 'fp16')
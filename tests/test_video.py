@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import torch
+from dataloader import get_test_augmentation, get_letterbox_augmentation
+from model_tracer.video import VideoPredictor
+
+IMG_SIZE = 64
+
+
+class MeanMap(torch.nn.Module):
+    """Stands in for TRACER(inputs, return_aux=False): sigmoid of the channel mean."""
+    def __init__(self):
+        super().__init__()
+        self.shapes = []
+
+    def forward(self, inputs, return_aux=False):
+        self.shapes.append(tuple(inputs.shape))
+        return torch.sigmoid(inputs.mean(1, keepdim=True))
+
+
+@pytest.mark.parametrize('letterbox', [False, True])
+@pytest.mark.parametrize('tolerance', [0.0, 1e9])
+def test_mixed_frame_sizes(letterbox, tolerance):
+    rng = np.random.RandomState(0)
+    sizes = [(48, 64), (48, 64), (64, 48), (30, 90), (30, 90), (48, 64), (96, 128), (47, 64)]
+    frames = [rng.randint(0, 256, (h, w, 3), dtype=np.uint8) for h, w in sizes]
+    transform = get_letterbox_augmentation(IMG_SIZE) if letterbox else get_test_augmentation(IMG_SIZE)
+    model = MeanMap()
+    predictor = VideoPredictor(model, transform, IMG_SIZE, torch.device('cpu'), letterbox=letterbox, batch_size=4,
+                               tolerance=tolerance)
+
+    results = list(predictor.predict(iter(frames)))
+    assert [frame.shape[:2] for frame, _ in results] == sizes
+    assert [mask.shape for _, mask in results] == sizes  # reused masks come from a keyframe of the same size
+    assert predictor.counters['frames'] == len(frames)
+    if letterbox:
+        assert len({shape[2:] for shape in model.shapes}) > 1
@@ -0,0 +1,49 @@
+import os
+import pytest
+import torch
+import inference_helper_spark as spark
+from config import DummyArgs
+from model_tracer.EfficientNet import EfficientNet
+from util.effi_utils import load_pretrained_weights
+from util.weight_store import WeightStore
+from legacy import random_tracer
+
+
+def test_checksum_mismatch(weights_dir):
+    with open(os.path.join(weights_dir, 'TRACER-Efficient-0.pth'), 'ab') as f:
+        f.write(b'\0')
+    with pytest.raises(RuntimeError):
+        WeightStore(weights_dir).resolve(spark.url_TRACER['TE-0'])
+    with pytest.raises(RuntimeError):
+        spark.load_pretrained('TE-0', torch.device('cpu'), weights_dir)
+
+
+def test_spark_loads_from_weight_store(weights_dir, monkeypatch):
+    state_dict = spark.load_pretrained('TE-0', torch.device('cpu'), weights_dir)
+    assert all(key.startswith('module.') for key in state_dict)
+
+    monkeypatch.setenv('TRACER_WEIGHTS_DIR', weights_dir)
+    args = spark.DummyArgs(0)
+    backbone = spark.TRACER(args).model  # pretrained_backbone from $TRACER_WEIGHTS_DIR
+    expected = random_tracer(0).model.state_dict()
+    assert all(torch.equal(value, expected[key]) for key, value in backbone.state_dict().items())
+    inference = spark.Inference(args)  # TE-0 checkpoint from $TRACER_WEIGHTS_DIR
+    assert inference.model.training is False
+
+
+
+@pytest.mark.parametrize('helper', [False, True])
+def test_load_pretrained_weights_drops_head(helper, tmp_path, capsys):
+    state_dict = dict(random_tracer(0).model.state_dict())
+    head = {'_conv_head.weight': torch.randn(1280, 320, 1, 1), '_bn1.weight': torch.ones(1280),
+            '_fc.weight': torch.randn(1000, 1280), '_fc.bias': torch.zeros(1000)}
+    torch.save({**state_dict, **head}, str(tmp_path / 'adv-efficientnet-b0.pth'))
+
+    if helper:  # the self-contained Spark copy
+        backbone = spark.EfficientNet.from_name('efficientnet-b0', cfg=spark.DummyArgs(0))
+        spark.load_pretrained_weights(backbone, 'efficientnet-b0', weights_path=str(tmp_path / 'adv-efficientnet-b0.pth'))
+    else:
+        backbone = EfficientNet.from_name('efficientnet-b0', cfg=DummyArgs(0))
+        load_pretrained_weights(backbone, 'efficientnet-b0', weights_path=str(tmp_path / 'adv-efficientnet-b0.pth'))
+    assert '4 unused tensors dropped' in capsys.readouterr().out
+    assert all(torch.equal(value, state_dict[key]) for key, value in backbone.state_dict().items())
@@ -10,10 +10,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from tqdm import tqdm
 from dataloader import get_train_augmentation, get_test_augmentation, get_loader, gt_to_tensor
-from util.utils import AvgMeter
+from util.utils import AvgMeter, select_swish
 from util.metrics import Evaluation_metrics
 from util.losses import Optimizer, Scheduler, Criterion
-from model.TRACER import TRACER
+from model_tracer.TRACER import TRACER
 
 
 class Trainer():
@@ -21,6 +21,7 @@ class Trainer():
         super(Trainer, self).__init__()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.size = args.img_size
+        self.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
 
         self.tr_img_folder = os.path.join(args.data_path, args.dataset, 'Train/images/')
         self.tr_gt_folder = os.path.join(args.data_path, args.dataset, 'Train/masks/')
@@ -37,7 +38,12 @@ class Trainer():
                                      transform=self.test_transform, seed=args.seed)
 
         # Network
-        self.model = TRACER(args).to(self.device)
+        self.model = TRACER(args).to(self.device, memory_format=self.memory_format)
+        # nn.DataParallel splits each batch over the GPUs: 'auto' times the batch of one device
+        num_devices = torch.cuda.device_count() if args.multi_gpu and torch.cuda.is_available() else 1
+        memory_efficient = select_swish(self.model, args.swish, -(-args.batch_size // num_devices), args.img_size,
+                                        self.device, self.memory_format)
+        print(f'Swish: {"memory efficient" if memory_efficient else "native SiLU"}')
 
         if args.multi_gpu:
             self.model = nn.DataParallel(self.model).to(self.device)
@@ -97,7 +103,7 @@ class Trainer():
         train_mae = AvgMeter()
 
         for images, masks, edges in tqdm(self.train_loader):
-            images = torch.tensor(images, device=self.device, dtype=torch.float32)
+            images = torch.tensor(images, device=self.device, dtype=torch.float32).contiguous(memory_format=self.memory_format)
             masks = torch.tensor(masks, device=self.device, dtype=torch.float32)
             edges = torch.tensor(edges, device=self.device, dtype=torch.float32)
 
@@ -134,7 +140,7 @@ class Trainer():
 
         with torch.no_grad():
             for images, masks, edges in tqdm(self.val_loader):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
+                images = torch.tensor(images, device=self.device, dtype=torch.float32).contiguous(memory_format=self.memory_format)
                 masks = torch.tensor(masks, device=self.device, dtype=torch.float32)
                 edges = torch.tensor(edges, device=self.device, dtype=torch.float32)
 
@@ -179,13 +185,13 @@ class Trainer():
 
         with torch.no_grad():
             for i, (images, masks, original_size, image_name) in enumerate(tqdm(test_loader)):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
+                images = torch.tensor(images, device=self.device, dtype=torch.float32).contiguous(memory_format=self.memory_format)
 
-                outputs, edge_mask, ds_map = self.model(images)
+                outputs = self.model(images, return_aux=False)
                 H, W = original_size
 
                 for i in range(images.size(0)):
-                    mask = gt_to_tensor(masks[i])
+                    mask = gt_to_tensor(masks[i], self.device)
 
                     h, w = H[i].item(), W[i].item()
 
@@ -219,9 +225,11 @@ class Tester():
         self.test_transform = get_test_augmentation(img_size=args.img_size)
         self.args = args
         self.save_path = save_path
+        self.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
 
         # Network
-        self.model = TRACER(args).to(self.device)
+        self.model = TRACER(args, pretrained_backbone=False).to(self.device, memory_format=self.memory_format)
+        self.model.set_swish(memory_efficient=False) # native SiLU
         if args.multi_gpu:
             self.model = nn.DataParallel(self.model).to(self.device)
 
@@ -254,13 +262,13 @@ class Tester():
 
         with torch.no_grad():
             for i, (images, masks, original_size, image_name) in enumerate(tqdm(self.test_loader)):
-                images = torch.tensor(images, device=self.device, dtype=torch.float32)
+                images = torch.tensor(images, device=self.device, dtype=torch.float32).contiguous(memory_format=self.memory_format)
 
-                outputs, edge_mask, ds_map = self.model(images)
+                outputs = self.model(images, return_aux=False)
                 H, W = original_size
 
                 for i in range(images.size(0)):
-                    mask = gt_to_tensor(masks[i])
+                    mask = gt_to_tensor(masks[i], self.device)
                     h, w = H[i].item(), W[i].item()
 
                     output = F.interpolate(outputs[i].unsqueeze(0), size=(h, w), mode='bilinear')
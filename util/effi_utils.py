@@ -14,33 +14,34 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.utils import model_zoo
-from config import getConfig
+from util.weight_store import WeightStore
 
-cfg = getConfig()
 
-def get_model_shape():
-    if cfg.arch == '0':
+def get_model_shape(arch):
+    """(indices of the four TRACER feature blocks, their channels) of an EfficientNet scale (0 to 7)."""
+    arch = str(arch)
+    if arch == '0':
         block_idx = [2, 4, 10, 15]
         channels = [24, 40, 112, 320]
-    elif cfg.arch == '1':
+    elif arch == '1':
         block_idx = [4, 7, 15, 22]
         channels = [24, 40, 112, 320]
-    elif cfg.arch == '2':
+    elif arch == '2':
         block_idx = [4, 7, 15, 22]
         channels = [24, 48, 120, 352]
-    elif cfg.arch == '3':
+    elif arch == '3':
         block_idx = [4, 7, 17, 25]
         channels = [32, 48, 136, 384]
-    elif cfg.arch == '4':
+    elif arch == '4':
         block_idx = [5, 9, 21, 31]
         channels = [32, 56, 160, 448]
-    elif cfg.arch == '5':
+    elif arch == '5':
         block_idx = [7, 12, 26, 38]
         channels = [40, 64, 176, 512]
-    elif cfg.arch == '6':
+    elif arch == '6':
         block_idx = [8, 14, 30, 44]
         channels = [40, 72, 200, 576]
-    elif cfg.arch == '7':
+    elif arch == '7':
         block_idx = [10, 17, 37, 54]
         channels = [48, 80, 224, 640]
 
@@ -84,7 +85,7 @@ BlockArgs.__new__.__defaults__ = (None,) * len(BlockArgs._fields)
 # An ordinary implementation of Swish function
 class Swish(nn.Module):
     def forward(self, x):
-        return x * torch.sigmoid(x)
+        return F.silu(x)  # native fused kernel, traceable
 
 
 # A memory-efficient implementation of Swish function
@@ -238,9 +239,29 @@ def get_same_padding_conv2d(image_size=None):
         return partial(Conv2dStaticSamePadding, image_size=image_size)
 
 
+def same_padding(input_size, kernel_size, stride, dilation):
+    """TensorFlow 'SAME' padding (left, right, top, bottom) of a convolution over an input of input_size (H, W)."""
+    ih, iw = input_size
+    kh, kw = kernel_size
+    sh, sw = stride
+    oh, ow = math.ceil(ih / sh), math.ceil(iw / sw) # change the output size according to stride ! ! !
+    pad_h = max((oh - 1) * sh + (kh - 1) * dilation[0] + 1 - ih, 0)
+    pad_w = max((ow - 1) * sw + (kw - 1) * dilation[1] + 1 - iw, 0)
+    return pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2
+
+
+def split_same_padding(pad):
+    """(convolution padding, explicit F.pad amounts or None) of a 'SAME' padding. Symmetric padding is left to the
+    convolution, which pads without allocating a padded copy of its input."""
+    left, right, top, bottom = pad
+    if left == right and top == bottom:
+        return (top, left), None
+    return (0, 0), list(pad)
+
+
 class Conv2dDynamicSamePadding(nn.Conv2d):
     """2D Convolutions like TensorFlow, for a dynamic image size.
-       The padding is operated in forward function by calculating dynamically.
+       The padding is calculated in forward function and memoized per input size.
     """
 
     # Tips for 'SAME' mode padding.
@@ -258,17 +279,18 @@ class Conv2dDynamicSamePadding(nn.Conv2d):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, groups=1, bias=True):
         super().__init__(in_channels, out_channels, kernel_size, stride, 0, dilation, groups, bias)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
+        self.padding_cache = {}  # (ih, iw) -> (convolution padding, explicit F.pad amounts or None)
 
     def forward(self, x):
         ih, iw = x.size()[-2:]
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw) # change the output size according to stride ! ! !
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            x = F.pad(x, [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2])
-        return F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+        key = (int(ih), int(iw))  # sizes are traced as tensors during ONNX export
+        if key not in self.padding_cache:
+            pad = same_padding(key, self.weight.size()[-2:], self.stride, self.dilation)
+            self.padding_cache[key] = split_same_padding(pad)
+        padding, pad = self.padding_cache[key]
+        if pad is not None:
+            x = F.pad(x, pad)
+        return F.conv2d(x, self.weight, self.bias, self.stride, padding, self.dilation, self.groups)
 
 
 class Conv2dStaticSamePadding(nn.Conv2d):
@@ -282,17 +304,13 @@ class Conv2dStaticSamePadding(nn.Conv2d):
         super().__init__(in_channels, out_channels, kernel_size, stride, **kwargs)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
 
-        # Calculate padding based on image size and save it
+        # Calculate padding based on image size and save it (symmetric padding is done by the convolution itself)
         assert image_size is not None
         ih, iw = (image_size, image_size) if isinstance(image_size, int) else image_size
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            self.static_padding = nn.ZeroPad2d((pad_w // 2, pad_w - pad_w // 2,
-                                                pad_h // 2, pad_h - pad_h // 2))
+        pad = same_padding((ih, iw), self.weight.size()[-2:], self.stride, self.dilation)
+        self.padding, pad = split_same_padding(pad)
+        if pad is not None:
+            self.static_padding = nn.ZeroPad2d(tuple(pad))
         else:
             self.static_padding = nn.Identity()
 
@@ -603,7 +621,7 @@ url_map_advprop = {
     'efficientnet-b8': 'https://github.com/lukemelas/EfficientNet-PyTorch/releases/download/1.0/adv-efficientnet-b8-22a8fe65.pth',
 }
 
-def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True, advprop=False):
+def load_pretrained_weights(model, model_name, weights_path=None, advprop=False, weights_dir=None):
     """Loads pretrained weights from weights path or download using url.
 
     Args:
@@ -612,27 +630,29 @@ def load_pretrained_weights(model, model_name, weights_path=None, load_fc=True,
         weights_path (None or str):
             str: path to pretrained weights file on the local disk.
             None: use pretrained weights downloaded from the Internet.
-        load_fc (bool): Whether to load pretrained weights for fc layer at the end of the model.
         advprop (bool): Whether to load pretrained weights
                         trained with advprop (valid when weights_path is None).
+        weights_dir (None or str): Local weight store directory (falls back to $TRACER_WEIGHTS_DIR).
+                                   When set, weights are read from there instead of being downloaded.
+    Only the tensors of the model are kept: the ImageNet head (_conv_head, _bn1, _fc) is dropped right after loading.
     """
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    store = WeightStore.from_config(weights_dir)
     if isinstance(weights_path, str):
-        state_dict = torch.load(weights_path, strict=False, map_location = device)
+        state_dict = torch.load(weights_path, map_location = device)
     else:
         # AutoAugment or Advprop (different preprocessing)
         url_map_ = url_map_advprop if advprop else url_map
-        state_dict = model_zoo.load_url(url_map_[model_name], map_location=device)
+        if store is not None:
+            state_dict = store.load(url_map_[model_name], map_location=device)
+        else:
+            state_dict = model_zoo.load_url(url_map_[model_name], map_location=device)
 
-    if load_fc:
-        ret = model.load_state_dict(state_dict, strict=False)
-        # assert not ret.missing_keys, 'Missing keys when loading pretrained weights: {}'.format(ret.missing_keys)
-    else:
-        state_dict.pop('_fc.weight')
-        state_dict.pop('_fc.bias')
-        ret = model.load_state_dict(state_dict, strict=False)
-        # assert set(ret.missing_keys) == set(
-        #     ['_fc.weight', '_fc.bias']), 'Missing keys when loading pretrained weights: {}'.format(ret.missing_keys)
-    # assert not ret.unexpected_keys, 'Missing keys when loading pretrained weights: {}'.format(ret.unexpected_keys)
-
-    print('Loaded pretrained weights for {}'.format(model_name))
+    model_keys = model.state_dict().keys()
+    unused = [key for key in state_dict if key not in model_keys]
+    for key in unused:
+        del state_dict[key]
+    # strict=False: the Frequency Edge Module is not part of the ImageNet backbone
+    model.load_state_dict(state_dict, strict=False)
+
+    print('Loaded pretrained weights for {} ({} unused tensors dropped)'.format(model_name, len(unused)))
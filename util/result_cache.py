@@ -0,0 +1,226 @@
+"""
+Content-addressed cache of TRACER results for images that are submitted again (re-crawls, variants, retries).
+
+Keys are SHA-256 digests of the image and of the settings the result depends on (cache_settings: arch, input size,
+alpha threshold of the salient object, the inference options that change the mask and the identity of the weights).
+Encoded images (file or request bytes) are hashed as they are, so a hit skips both decoding and the model; images
+that are already decoded (RGB arrays, PIL images) are hashed over their pixels.
+
+Results are stored as PNG files (lossless compression): the mask and, when it was computed, the salient object.
+    - in-memory tier: LRU bounded by the total size of the PNG files (evictions are counted).
+    - on-disk tier (optional): <cache_dir>/<key[:2]>/<key>.mask.png and <key>.object.png, shared by processes and kept
+      across runs. Optionally bounded by the total size of the files: once it is exceeded, the least recently used
+      results (file modification time, refreshed on hits) are deleted down to 90% of the bound.
+"""
+import os
+import cv2
+import hashlib
+import threading
+import collections
+import numpy as np
+from util.utils import url_TRACER
+from util.weight_store import WeightStore, sha256sum
+
+# options of config.DummyArgs that change the mask of an image
+CACHE_OPTIONS = ('arch', 'model_file', 'precision', 'low_res_average', 'cascade_arch', 'cascade_band',
+                 'cascade_max_uncertain', 'tile', 'tile_overlap', 'tile_band', 'letterbox')
+
+
+def weights_fingerprint(args):
+    """
+    Identity of the weights behind the results: SHA-256 of the model_file artifact, or of the TE-x checkpoints (arch
+    and cascade_arch) in the weight store (weights_dir or $TRACER_WEIGHTS_DIR). Without a weight store, the release
+    URLs of the checkpoints, which model_zoo downloads once.
+    """
+    if args.model_file is not None:
+        return sha256sum(args.model_file)
+    store = WeightStore.from_config(args.weights_dir)
+    urls = [url_TRACER[f'TE-{arch}'] for arch in [args.arch, args.cascade_arch] if arch is not None]
+    return tuple(url if store is None else store.checksum(url) for url in urls)
+
+
+def cache_settings(args, img_size, threshold=200, object_format='BGRA'):
+    """
+    Settings of a cache key.
+    Args:
+        img_size: model input size (the large arch input size of a cascade).
+        threshold: alpha cut of the salient object (post_processing).
+        object_format: channel order of the cached salient objects ('BGRA': inference.py, 'RGBA': the helpers).
+    """
+    return (img_size, threshold, object_format, weights_fingerprint(args)) + \
+        tuple(getattr(args, option) for option in CACHE_OPTIONS)
+
+
+def encode_png(image):
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def decode_png(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+class ResultCache():
+    """
+    Two-tier cache of (mask PNG, salient object PNG or None) by key, safe to share between threads.
+
+    Args:
+        max_bytes: size bound of the in-memory tier (0: no in-memory tier).
+        cache_dir: directory of the on-disk tier (None: no on-disk tier).
+        max_disk_bytes: size bound of the on-disk tier (None: unbounded). The size is tracked by each process from
+                        its own writes and the directory is scanned again when the bound is exceeded.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20, cache_dir=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.disk_size = None  # scanned on the first write
+        self.lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+
+    @classmethod
+    def from_config(cls, args):
+        """
+        Returns the cache of args.cache_size (MiB), args.cache_dir and args.cache_disk_size (MiB, 0: unbounded), or
+        None when both tiers are off.
+        """
+        if not args.cache_size and args.cache_dir is None:
+            return None
+        max_disk_bytes = int(args.cache_disk_size * 2 ** 20) if args.cache_disk_size else None
+        return cls(int(args.cache_size * 2 ** 20), args.cache_dir, max_disk_bytes)
+
+    @staticmethod
+    def key(image, *settings):
+        """Key of encoded image bytes or of a decoded image array, under settings (cache_settings)."""
+        digest = hashlib.sha256()
+        if isinstance(image, np.ndarray):
+            digest.update(f'{image.shape}{image.dtype.str}'.encode())
+            image = np.ascontiguousarray(image)
+        digest.update(memoryview(image).cast('B'))
+        digest.update(repr(settings).encode())
+        return digest.hexdigest()
+
+    def get(self, key, need_object=True):
+        """
+        Returns the cached (mask PNG, salient object PNG) of key, or None on a miss (also when need_object and only
+        the mask was cached). Disk hits are moved into the in-memory tier.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is not None or not need_object):
+                self.entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return entry
+
+        entry = self._read(key, need_object)
+        with self.lock:
+            self.counters['disk_hits' if entry is not None else 'misses'] += 1
+        if entry is not None:
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key, mask, salient_object=None):
+        """Caches the PNG encoded mask (and salient object) of key in both tiers."""
+        entry = (mask, salient_object)
+        self._insert(key, entry)
+        if self.cache_dir is not None:
+            os.makedirs(os.path.join(self.cache_dir, key[:2]), exist_ok=True)
+            for suffix, data in zip(('mask', 'object'), entry):
+                if data is not None:
+                    path = self._path(key, suffix)
+                    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)  # readers never see a partial file
+            if self.max_disk_bytes is not None:
+                self._evict_disk(sum(len(data) for data in entry if data is not None))
+
+    def _insert(self, key, entry):
+        size = sum(len(data) for data in entry if data is not None)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= sum(len(data) for data in old if data is not None)
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= sum(len(data) for data in evicted if data is not None)
+                self.counters['evictions'] += 1
+
+    def _evict_disk(self, written):
+        """Deletes the least recently used results of the on-disk tier down to 90% of max_disk_bytes, so that the
+        directory is not scanned on every write once the bound is reached."""
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for _, size, _ in self._disk_files())
+            else:
+                self.disk_size += written
+            if self.disk_size <= self.max_disk_bytes:
+                return
+
+            results = {}  # key -> (last use, size, paths)
+            for mtime, size, path in self._disk_files():
+                key = os.path.basename(path).split('.')[0]
+                last_use, total, paths = results.get(key, (0, 0, []))
+                results[key] = (max(last_use, mtime), total + size, paths + [path])
+            self.disk_size = sum(total for _, total, _ in results.values())
+            for last_use, total, paths in sorted(results.values(), key=lambda result: result[0]):
+                if self.disk_size <= 0.9 * self.max_disk_bytes:
+                    break
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:  # evicted by another process
+                        pass
+                self.disk_size -= total
+                self.counters['disk_evictions'] += 1
+
+    def _disk_files(self):
+        """(modification time, size, path) of the PNG files of the on-disk tier."""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.png'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:  # evicted by another process
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{suffix}.png')
+
+    def _read(self, key, need_object):
+        if self.cache_dir is None or not os.path.exists(self._path(key, 'mask')):
+            return None
+        object_path = self._path(key, 'object')
+        if need_object and not os.path.exists(object_path):
+            return None
+        try:
+            with open(self._path(key, 'mask'), 'rb') as f:
+                mask = f.read()
+            salient_object = None
+            if os.path.exists(object_path):
+                with open(object_path, 'rb') as f:
+                    salient_object = f.read()
+            if self.max_disk_bytes is not None:  # last use of the LRU eviction
+                for path in (self._path(key, 'mask'), object_path):
+                    if os.path.exists(path):
+                        os.utime(path)
+        except FileNotFoundError:  # evicted meanwhile
+            return None
+        return mask, salient_object
+
+    def report(self):
+        hits = self.counters['memory_hits'] + self.counters['disk_hits']
+        lookups = hits + self.counters['misses']
+        print(f'cache: {hits}/{lookups} hits ({hits / max(lookups, 1):.1%}; memory: {self.counters["memory_hits"]}, '
+              f'disk: {self.counters["disk_hits"]}), misses: {self.counters["misses"]}, '
+              f'evictions: {self.counters["evictions"]}, in memory: {len(self.entries)} results '
+              f'({self.size / 2 ** 20:.1f} MiB), disk evictions: {self.counters["disk_evictions"]}')
@@ -1,5 +1,9 @@
+import contextlib
+import copy
+import time
 import torch
 from torch.utils import model_zoo
+from util.weight_store import WeightStore, strip_module_prefix
 
 def to_array(feature_map):
     if feature_map.shape[0] == 1:
@@ -11,6 +15,59 @@ def to_array(feature_map):
 def to_tensor(feature_map):
     return torch.as_tensor(feature_map.transpose(0, 3, 1, 2), dtype=torch.float32)
 
+def memory_format_of(x):
+    """torch.channels_last for NHWC feature maps, torch.contiguous_format otherwise."""
+    if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+def autocast(device, precision):
+    """Autocast context of an inference precision: 'fp32' (no autocast) or 'bf16'."""
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError(f'Unknown precision {precision}: use fp32 or bf16')
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=torch.bfloat16)
+
+def select_swish(model, swish, batch_size, img_size, device, memory_format=torch.contiguous_format, repeat=3):
+    """Sets the backbone swish of a TRACER for training: 'memory_efficient' (custom autograd Function that only
+    saves its input), 'native' (SiLU) or 'auto', which times training steps of both on a copy of the model at
+    batch_size (the batch of one device with nn.DataParallel, at least 2 images since the BatchNorms of the 1x1
+    channel attention cannot train on a single one) and keeps the faster one. The copy and its activations come on
+    top of the memory of the model. Returns whether the memory efficient swish is used."""
+    if swish not in ('auto', 'memory_efficient', 'native'):
+        raise ValueError(f'Unknown swish {swish}: use auto, memory_efficient or native')
+    if swish != 'auto':
+        model.set_swish(swish == 'memory_efficient')
+        return swish == 'memory_efficient'
+
+    trial = copy.deepcopy(model).train()  # keeps the BatchNorm statistics and gradients of the model untouched
+    batch_size = max(batch_size, 2)
+    inputs = torch.randn(batch_size, 3, img_size, img_size, device=device).contiguous(memory_format=memory_format)
+
+    def step():
+        outputs, edge, ds_map = trial(inputs)
+        (outputs.mean() + edge.mean() + sum(ds.mean() for ds in ds_map)).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    times = {}
+    for memory_efficient in (True, False):
+        trial.set_swish(memory_efficient)
+        step()  # warm-up
+        t = time.perf_counter()
+        for _ in range(repeat):
+            step()
+        times[memory_efficient] = time.perf_counter() - t
+    del trial
+
+    memory_efficient = times[True] <= times[False]
+    print(f'Swish timing ({repeat} training steps of batch {batch_size}): memory efficient {times[True]:.2f}s, '
+          f'native SiLU {times[False]:.2f}s')
+    model.set_swish(memory_efficient)
+    return memory_efficient
+
+
 class AvgMeter(object):
     def __init__(self, num=40):
         self.num = num
@@ -43,7 +100,11 @@ url_TRACER = {
 }
 
 
-def load_pretrained(model_name, device):
-    state_dict = model_zoo.load_url(url_TRACER[model_name], map_location = device)
+def load_pretrained(model_name, device, weights_dir=None):
+    store = WeightStore.from_config(weights_dir)
+    if store is not None:  # offline: local directory or $TRACER_WEIGHTS_DIR
+        state_dict = store.load(url_TRACER[model_name], map_location = device)
+    else:
+        state_dict = model_zoo.load_url(url_TRACER[model_name], map_location = device)
 
     return state_dict
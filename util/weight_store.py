@@ -0,0 +1,143 @@
+"""
+Offline weight store for TRACER (TE-x) checkpoints and EfficientNet backbones.
+
+Files are looked up by the basename of their release URL (e.g. TRACER-Efficient-7.pth,
+adv-efficientnet-b7-4652b6dd.pth) in a local directory given explicitly or through $TRACER_WEIGHTS_DIR.
+Every file is verified against a SHA-256 checksum before it is deserialized:
+    - the entry of the file in <weights_dir>/sha256sums.txt ('<sha256>  <filename>' per line), or
+    - the hash prefix embedded in the file name (torch.hub convention, e.g. '-4652b6dd.pth').
+
+Create the manifest of a directory with:
+    python -m util.weight_store checksum <weights_dir>
+
+Rewrite a checkpoint without the nn.DataParallel 'module.' prefix and the unused ImageNet head of the EfficientNet
+backbone (_conv_head, _bn1, _fc), then checksum the directory again:
+    python -m util.weight_store slim TRACER-Efficient-7.pth <weights_dir>/TRACER-Efficient-7.pth
+"""
+import os
+import re
+import hashlib
+import argparse
+import torch
+from urllib.parse import urlparse
+
+WEIGHTS_DIR_ENV = 'TRACER_WEIGHTS_DIR'
+MANIFEST = 'sha256sums.txt'
+HASH_REGEX = re.compile(r'-([a-f0-9]{8,})\.')
+UNUSED_REGEX = re.compile(r'^(model\.)?(_conv_head|_bn1|_fc)\.')  # backbone head, TRACER stops at the last block
+
+
+def sha256sum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WeightStore():
+    def __init__(self, root=None):
+        self.root = root or os.environ.get(WEIGHTS_DIR_ENV)
+        if self.root is None:
+            raise ValueError(f'No weights directory given and ${WEIGHTS_DIR_ENV} is not set')
+        self.manifest = self._read_manifest()
+        self._verified = {}
+
+    @classmethod
+    def from_config(cls, weights_dir=None):
+        """Returns a store for weights_dir or $TRACER_WEIGHTS_DIR, or None to download with model_zoo."""
+        if weights_dir is None and os.environ.get(WEIGHTS_DIR_ENV) is None:
+            return None
+        return cls(weights_dir)
+
+    def _read_manifest(self):
+        manifest = {}
+        path = os.path.join(self.root, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        checksum, filename = line.split(maxsplit=1)
+                        manifest[filename.strip().lstrip('*')] = checksum.lower()
+        return manifest
+
+    def resolve(self, url_or_filename):
+        """Returns the verified local path of a release file."""
+        filename = os.path.basename(urlparse(url_or_filename).path)
+        path = os.path.join(self.root, filename)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'{filename} not found in weight store {self.root}')
+        self.verify(path)
+        return path
+
+    def verify(self, path):
+        """Checks a file against its expected checksum and returns its SHA-256 (not hashed again while unchanged)."""
+        filename = os.path.basename(path)
+        stat = os.stat(path)
+        verified = self._verified.get(path)
+        if verified is not None and verified[:2] == (stat.st_size, stat.st_mtime):
+            return verified[2]
+
+        expected = self.manifest.get(filename)
+        if expected is None:
+            match = HASH_REGEX.search(filename)
+            if match is None:
+                raise RuntimeError(f'No checksum for {filename}: add it to {os.path.join(self.root, MANIFEST)}')
+            expected = match.group(1)
+
+        checksum = sha256sum(path)
+        if not checksum.startswith(expected):
+            raise RuntimeError(f'Checksum mismatch for {path}: expected {expected}, got {checksum}')
+        self._verified[path] = (stat.st_size, stat.st_mtime, checksum)
+        return checksum
+
+    def checksum(self, url_or_filename):
+        """SHA-256 of a verified release file."""
+        return self.verify(self.resolve(url_or_filename))
+
+    def load(self, url_or_filename, map_location=None):
+        return torch.load(self.resolve(url_or_filename), map_location=map_location)
+
+
+def strip_module_prefix(state_dict):
+    """state_dict without the 'module.' prefix of checkpoints saved from nn.DataParallel."""
+    return {key[len('module.'):] if key.startswith('module.') else key: value for key, value in state_dict.items()}
+
+
+def slim_checkpoint(path, output):
+    """Saves the checkpoint at path to output without the DataParallel prefix and the unused backbone head.
+    Returns the number of dropped tensors."""
+    state_dict = strip_module_prefix(torch.load(path, map_location='cpu'))
+    slim = {key: value for key, value in state_dict.items() if not UNUSED_REGEX.match(key)}
+    torch.save(slim, output)
+    return len(state_dict) - len(slim)
+
+
+def write_manifest(root):
+    """Writes sha256sums.txt for every .pth file in root."""
+    lines = []
+    for filename in sorted(os.listdir(root)):
+        if filename.endswith('.pth'):
+            lines.append(f'{sha256sum(os.path.join(root, filename))}  {filename}\n')
+    with open(os.path.join(root, MANIFEST), 'w') as f:
+        f.writelines(lines)
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TRACER weight store utilities')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    checksum_parser = subparsers.add_parser('checksum', help='write sha256sums.txt for a weights directory')
+    checksum_parser.add_argument('weights_dir')
+    slim_parser = subparsers.add_parser('slim', help='rewrite a checkpoint without the module. prefix and backbone head')
+    slim_parser.add_argument('checkpoint')
+    slim_parser.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'checksum':
+        for line in write_manifest(args.weights_dir):
+            print(line, end='')
+    elif args.command == 'slim':
+        dropped = slim_checkpoint(args.checkpoint, args.output)
+        print(f'{args.output}: {dropped} tensors dropped, '
+              f'{os.path.getsize(args.checkpoint) / 2 ** 20:.1f} -> {os.path.getsize(args.output) / 2 ** 20:.1f} MiB')
@@ -25,9 +25,7 @@ from util.effi_utils import (
     calculate_output_image_size
 )
 
-from config import getConfig
-
-cfg = getConfig()
+from config import DummyArgs
 
 VALID_MODELS = (
     'efficientnet-b0', 'efficientnet-b1', 'efficientnet-b2', 'efficientnet-b3',
@@ -147,13 +145,14 @@ class MBConvBlock(nn.Module):
 
 
 class EfficientNet(nn.Module):
-    def __init__(self, blocks_args=None, global_params=None):
+    def __init__(self, blocks_args=None, global_params=None, cfg=None):
         super().__init__()
         assert isinstance(blocks_args, list), 'blocks_args should be a list'
         assert len(blocks_args) > 0, 'block args must be greater than 0'
+        assert cfg is not None, 'cfg (arch) must be given'
         self._global_params = global_params
         self._blocks_args = blocks_args
-        self.block_idx, self.channels = get_model_shape()
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
 
         # Batch norm parameters
         bn_mom = 1 - self._global_params.batch_norm_momentum
@@ -256,12 +255,15 @@ class EfficientNet(nn.Module):
 
 
     @classmethod
-    def from_name(cls, model_name, in_channels=3, **override_params):
+    def from_name(cls, model_name, in_channels=3, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
             model_name (str): Name for efficientnet.
             in_channels (int): Input data's channel number.
+            cfg (None or config.DummyArgs):
+                TRACER configuration (arch).
+                None: the default configuration of the model's scale.
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -276,13 +278,13 @@ class EfficientNet(nn.Module):
         """
         cls._check_model_name_is_valid(model_name)
         blocks_args, global_params = get_model_params(model_name, override_params)
-        model = cls(blocks_args, global_params)
+        model = cls(blocks_args, global_params, cfg if cfg is not None else DummyArgs(model_name[-1]))
         model._change_in_channels(in_channels)
         return model
 
     @classmethod
     def from_pretrained(cls, model_name, weights_path=None, advprop=False,
-                        in_channels=3, num_classes=1000, **override_params):
+                        in_channels=3, num_classes=1000, cfg=None, **override_params):
         """create an efficientnet model according to name.
 
         Args:
@@ -297,6 +299,7 @@ class EfficientNet(nn.Module):
             num_classes (int):
                 Number of categories for classification.
                 It controls the output size for final linear layer.
+            cfg (None or config.DummyArgs): TRACER configuration, see from_name.
             override_params (other key word params):
                 Params to override model's global_params.
                 Optional key:
@@ -309,7 +312,7 @@ class EfficientNet(nn.Module):
         Returns:
             A pretrained TRACER-EfficientNet model.
         """
-        model = cls.from_name(model_name, num_classes=num_classes, **override_params)
+        model = cls.from_name(model_name, num_classes=num_classes, cfg=cfg, **override_params)
         load_pretrained_weights(model, model_name, weights_path=weights_path, advprop=advprop)
         model._change_in_channels(in_channels)
         return model
@@ -14,8 +14,8 @@ from modules.att_modules import RFB_Block, aggregation, ObjectAttention
 class TRACER(nn.Module):
     def __init__(self, cfg):
         super().__init__()
-        self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True)
-        self.block_idx, self.channels = get_model_shape()
+        self.model = EfficientNet.from_pretrained(f'efficientnet-b{cfg.arch}', advprop=True, cfg=cfg)
+        self.block_idx, self.channels = get_model_shape(cfg.arch)
 
         # Receptive Field Blocks
         channels = [int(arg_c) for arg_c in cfg.RFB_aggregated_channel]
@@ -24,11 +24,11 @@ class TRACER(nn.Module):
         self.rfb4 = RFB_Block(self.channels[3], channels[2])
 
         # Multi-level aggregation
-        self.agg = aggregation(channels)
+        self.agg = aggregation(channels, gamma=cfg.gamma)
 
         # Object Attention
-        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3)
-        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3)
+        self.ObjectAttention2 = ObjectAttention(channel=self.channels[1], kernel_size=3, denoise=cfg.denoise)
+        self.ObjectAttention1 = ObjectAttention(channel=self.channels[0], kernel_size=3, denoise=cfg.denoise)
 
     def forward(self, inputs):
         B, C, H, W = inputs.size()